@@ -0,0 +1,279 @@
+import sqlite3
+import time
+from typing import List, NamedTuple, Optional, Tuple
+
+from persistence import StateFile
+
+# Keyed on the question number: each group numbers its messages separately,
+# so message ids repeat across the groups questions are routed to.
+_PENDING_TABLE = """
+CREATE TABLE IF NOT EXISTS pending_questions (
+  number INTEGER PRIMARY KEY,
+  message_id INTEGER NOT NULL,
+  chat_id INTEGER NOT NULL,
+  asker_id INTEGER NOT NULL,
+  preview TEXT NOT NULL,
+  submitted_at REAL NOT NULL,
+  claimed_by INTEGER,
+  reminded_at REAL,
+  assigned_to INTEGER,
+  assigned_at REAL
+)"""
+
+_SCHEMA = _PENDING_TABLE + """;
+CREATE TABLE IF NOT EXISTS responders (
+  chat_id INTEGER NOT NULL,
+  user_id INTEGER NOT NULL,
+  name TEXT NOT NULL,
+  available INTEGER NOT NULL DEFAULT 1,
+  last_assigned_at REAL NOT NULL DEFAULT 0,
+  PRIMARY KEY (chat_id, user_id)
+);
+"""
+
+# (table, column, declaration) added after the table was first released
+_ADDED_COLUMNS = [
+  ("pending_questions", "assigned_to", "INTEGER"),
+  ("pending_questions", "assigned_at", "REAL"),
+]
+
+_INDEXES = """
+CREATE INDEX IF NOT EXISTS pending_questions_submitted ON pending_questions (submitted_at, number);
+CREATE INDEX IF NOT EXISTS pending_questions_assigned ON pending_questions (assigned_to);
+"""
+
+_COLUMNS = "message_id, chat_id, number, asker_id, preview, submitted_at, claimed_by, assigned_to"
+
+Cursor = Tuple[float, int]
+
+
+def _create_tables(conn: sqlite3.Connection) -> None:
+  conn.executescript(_SCHEMA)
+  for table, column, declaration in _ADDED_COLUMNS:
+    columns = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+    if column not in columns:
+      conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {declaration}")
+  _rekey(conn)
+  conn.executescript(_INDEXES)
+
+
+def _rekey(conn: sqlite3.Connection) -> None:
+  """Moves the rows of a table keyed on the message id to one keyed on the
+  question number."""
+  primary_key = {row[1]: row[5] for row in conn.execute("PRAGMA table_info(pending_questions)")}
+  if not primary_key.get("message_id"):
+    return
+  conn.execute("BEGIN IMMEDIATE")
+  try:
+    conn.execute("ALTER TABLE pending_questions RENAME TO pending_questions_by_message")
+    conn.execute(_PENDING_TABLE)
+    columns = "number, message_id, chat_id, asker_id, preview, submitted_at, claimed_by, reminded_at, assigned_to, assigned_at"
+    conn.execute(
+      f"INSERT OR IGNORE INTO pending_questions ({columns}) SELECT {columns} FROM pending_questions_by_message"
+    )
+    # its indexes go with it
+    conn.execute("DROP TABLE pending_questions_by_message")
+    conn.execute("COMMIT")
+  except BaseException:
+    conn.execute("ROLLBACK")
+    raise
+
+
+class PendingQuestion(NamedTuple):
+  message_id: int
+  chat_id: int
+  number: int
+  asker_id: int
+  preview: str
+  submitted_at: float
+  claimed_by: Optional[int]
+  assigned_to: Optional[int]
+
+  @property
+  def cursor(self) -> Cursor:
+    return (self.submitted_at, self.number)
+
+
+class Responder(NamedTuple):
+  user_id: int
+  name: str
+
+
+class PendingQuestions:
+  """The questions in the research group that have not been replied to yet.
+
+  A table in the bot's state file indexed on submission time, holding only
+  open questions: a reply deletes the row. Every update is a B-tree insert
+  or delete, and pages are read with keyset pagination, so neither depends
+  on how many questions were ever asked.
+
+  Committee members who said they are available to answer questions in a
+  group are kept in ``responders``. Each new question is assigned to the one
+  with the fewest open assignments, and an assignment nobody has started on
+  in time moves to the next one.
+  """
+
+  def __init__(self, filepath: str):
+    self.state = StateFile.open(filepath)
+    self.state.register(_create_tables)
+
+  async def add(self, message_id: int, chat_id: int, number: int, asker_id: int, preview: str) -> None:
+    await self.state.run(
+      self.state.conn.execute,
+      "INSERT OR REPLACE INTO pending_questions (message_id, chat_id, number, asker_id, preview, submitted_at)"
+      " VALUES (?, ?, ?, ?, ?, ?)",
+      (message_id, chat_id, number, asker_id, preview, time.time())
+    )
+
+  async def remove(self, number: int) -> None:
+    await self.state.run(self.state.conn.execute, "DELETE FROM pending_questions WHERE number = ?", (number,))
+
+  async def claim(self, number: int, user_id: Optional[int]) -> None:
+    """Records who is replying to a question, ``None`` once they cancel."""
+    await self.state.run(
+      self.state.conn.execute, "UPDATE pending_questions SET claimed_by = ? WHERE number = ?", (user_id, number)
+    )
+
+  def _count(self) -> int:
+    return self.state.conn.execute("SELECT COUNT(*) FROM pending_questions").fetchone()[0]
+
+  async def count(self) -> int:
+    return await self.state.run(self._count)
+
+  def _page(self, cursor: Optional[Cursor], limit: int, forward: bool) -> Tuple[List[PendingQuestion], bool, bool]:
+    if forward:
+      where, order = "(submitted_at, number) > (?, ?)", "ASC"
+    else:
+      where, order = "(submitted_at, number) < (?, ?)", "DESC"
+    if cursor is None:
+      cursor = (float("-inf"), 0) if forward else (float("inf"), 0)
+    rows = self.state.conn.execute(
+      f"SELECT {_COLUMNS} FROM pending_questions WHERE {where} ORDER BY submitted_at {order}, number {order} LIMIT ?",
+      (*cursor, limit + 1)
+    ).fetchall()
+    more = len(rows) > limit
+    questions = [PendingQuestion(*row) for row in rows[:limit]]
+    if not forward:
+      questions.reverse()
+    if not questions:
+      return questions, False, False
+    # whether there is anything before the first or after the last question of the page
+    if forward:
+      has_previous = cursor[0] != float("-inf") and self._exists("<", questions[0].cursor)
+      has_next = more
+    else:
+      has_previous = more
+      has_next = self._exists(">", questions[-1].cursor)
+    return questions, has_previous, has_next
+
+  def _exists(self, op: str, cursor: Cursor) -> bool:
+    return self.state.conn.execute(
+      f"SELECT EXISTS (SELECT 1 FROM pending_questions WHERE (submitted_at, number) {op} (?, ?))", cursor
+    ).fetchone()[0] == 1
+
+  async def page(
+    self, cursor: Optional[Cursor] = None, limit: int = 5, forward: bool = True
+  ) -> Tuple[List[PendingQuestion], bool, bool]:
+    """Up to ``limit`` open questions, oldest first, submitted after
+    ``cursor`` (or before it, with ``forward=False``).
+
+    Returns the questions and whether there are more before and after them.
+    """
+    return await self.state.run(self._page, cursor, limit, forward)
+
+  def _due_reminders(self, older_than: float, remind_every: float) -> List[PendingQuestion]:
+    now = time.time()
+    rows = self.state.conn.execute(
+      f"SELECT {_COLUMNS} FROM pending_questions WHERE submitted_at < ?"
+      " AND (reminded_at IS NULL OR reminded_at < ?) ORDER BY submitted_at, number",
+      (now - older_than, now - remind_every)
+    ).fetchall()
+    with self.state.transaction() as conn:
+      conn.executemany("UPDATE pending_questions SET reminded_at = ? WHERE number = ?", [(now, row[2]) for row in rows])
+    return [PendingQuestion(*row) for row in rows]
+
+  async def due_reminders(self, older_than: float, remind_every: float) -> List[PendingQuestion]:
+    """Questions open for over ``older_than`` seconds that have not been
+    reminded about in the last ``remind_every`` seconds, marked as reminded."""
+    return await self.state.run(self._due_reminders, older_than, remind_every)
+
+  async def set_available(self, chat_id: int, user_id: int, name: str, available: bool) -> None:
+    """Adds a committee member to the responders of a group, or marks them
+    as away. Questions assigned to someone going away are reassigned on the
+    next check."""
+    await self.state.run(self._set_available, chat_id, user_id, name, available)
+
+  def _set_available(self, chat_id: int, user_id: int, name: str, available: bool) -> None:
+    with self.state.transaction() as conn:
+      conn.execute(
+        "INSERT INTO responders (chat_id, user_id, name, available) VALUES (?, ?, ?, ?)"
+        " ON CONFLICT (chat_id, user_id) DO UPDATE SET name = excluded.name, available = excluded.available",
+        (chat_id, user_id, name, int(available))
+      )
+      if not available:
+        conn.execute(
+          "UPDATE pending_questions SET assigned_at = 0 WHERE chat_id = ? AND assigned_to = ? AND claimed_by IS NULL",
+          (chat_id, user_id)
+        )
+
+  def _least_loaded(self, chat_id: int, exclude: Optional[int]) -> Optional[Responder]:
+    row = self.state.conn.execute(
+      "SELECT user_id, name FROM responders WHERE chat_id = ? AND available AND user_id IS NOT ?"
+      " ORDER BY (SELECT COUNT(*) FROM pending_questions WHERE assigned_to = responders.user_id), last_assigned_at"
+      " LIMIT 1", (chat_id, exclude)
+    ).fetchone()
+    return None if row is None else Responder(*row)
+
+  def _assign_to(self, number: int, chat_id: int, responder: Responder, now: float) -> None:
+    self.state.conn.execute(
+      "UPDATE pending_questions SET assigned_to = ?, assigned_at = ? WHERE number = ?",
+      (responder.user_id, now, number)
+    )
+    self.state.conn.execute(
+      "UPDATE responders SET last_assigned_at = ? WHERE chat_id = ? AND user_id = ?", (now, chat_id, responder.user_id)
+    )
+
+  def _assign(self, number: int, chat_id: int) -> Optional[Responder]:
+    with self.state.transaction():
+      responder = self._least_loaded(chat_id, None)
+      if responder is not None:
+        self._assign_to(number, chat_id, responder, time.time())
+    return responder
+
+  async def assign(self, number: int, chat_id: int) -> Optional[Responder]:
+    """Assigns a question to the available responder of its group with the
+    fewest open assignments. None if the group has no one available."""
+    return await self.state.run(self._assign, number, chat_id)
+
+  async def assignee(self, number: int) -> Optional[int]:
+    row = await self.state.run(
+      lambda: self.state.conn.execute(
+        "SELECT assigned_to FROM pending_questions WHERE number = ?", (number,)
+      ).fetchone()
+    )
+    return None if row is None else row[0]
+
+  def _reassign(self, timeout: float) -> List[Tuple[PendingQuestion, Responder]]:
+    now = time.time()
+    with self.state.transaction() as conn:
+      rows = conn.execute(
+        f"SELECT {_COLUMNS} FROM pending_questions WHERE assigned_to IS NOT NULL AND claimed_by IS NULL"
+        " AND assigned_at < ? ORDER BY submitted_at, number", (now - timeout,)
+      ).fetchall()
+      reassigned = []
+      for row in rows:
+        question = PendingQuestion(*row)
+        responder = self._least_loaded(question.chat_id, question.assigned_to)
+        if responder is None:
+          # nobody else to give it to, the current assignee keeps it for another round
+          conn.execute("UPDATE pending_questions SET assigned_at = ? WHERE number = ?", (now, question.number))
+          continue
+        self._assign_to(question.number, question.chat_id, responder, now)
+        reassigned.append((question, responder))
+    return reassigned
+
+  async def reassign(self, timeout: float) -> List[Tuple[PendingQuestion, Responder]]:
+    """Moves the questions that were assigned over ``timeout`` seconds ago
+    and that nobody has started replying to to another responder. Returns
+    each moved question with its new assignee."""
+    return await self.state.run(self._reassign, timeout)
@@ -0,0 +1,360 @@
+"""Replays conversations against the bot from main.py and reports latencies.
+
+The bot talks to a stand-in Bot API served on localhost, so nothing reaches
+Telegram. Each simulated user asks a question (/ask_question, text,
+confirm) and a committee member then answers it in the research group
+(reply, text, confirm). Updates recorded from a real webhook can be
+replayed as well with ``--updates``, one Update JSON per line.
+
+    python benchmark.py --users 2000 --output results.json
+
+Results are printed as JSON: latency percentiles per handler, updates/sec,
+Bot API calls per update by method and the cost of persistence flushes.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import re
+import socket
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter, defaultdict
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import parse_qsl
+
+import numpy as np
+import uvicorn
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+
+BENCHMARK_TOKEN = "123456:benchmark"
+BOT_USER = {"id": 123456, "is_bot": True, "first_name": "Benchmark Bot", "username": "benchmark_bot"}
+# ids of simulated askers and committee members
+ASKER_IDS = 1_000_000
+MEMBER_IDS = 2_000_000
+
+
+class FakeBotAPI:
+  """Answers Bot API methods with plausible results and counts the calls.
+
+  Sent and edited messages are kept so the replay can press the buttons on
+  them, like a user would. Runs on another thread than the bot, which is
+  fine for the plain dict updates done here.
+  """
+
+  def __init__(self, latency: float = 0):
+    self.latency = latency
+    self.calls: Counter = Counter()
+    self.messages: Dict[Tuple[int, int], Dict[str, Any]] = {}
+    self.last_sent: Dict[int, Dict[str, Any]] = {}
+    self.replies_to: Dict[Tuple[int, int], Dict[str, Any]] = {}
+    self.reply_targets: Dict[int, Dict[str, Any]] = {}
+    self._message_ids = itertools.count(1)
+    self.app = Starlette(routes=[Route("/bot{token}/{method}", self.handle, methods=["POST"])])
+
+  def _chat(self, chat_id: int) -> Dict[str, Any]:
+    if chat_id < 0:
+      return {"id": chat_id, "type": "supergroup", "title": "Research group"}
+    return {"id": chat_id, "type": "private", "first_name": "User"}
+
+  def _store(self, message: Dict[str, Any]) -> Dict[str, Any]:
+    chat_id = message["chat"]["id"]
+    self.messages[(chat_id, message["message_id"])] = message
+    # the Reply button only carries the question number, the asker is named in the text
+    asker = re.search(r"^Question by .*, @user(\d+):$", message.get("text", ""), re.MULTILINE)
+    if asker and _button(message, "reply"):
+      self.reply_targets[int(asker.group(1))] = message
+    return message
+
+  def send_message(self, params: Dict[str, Any]) -> Dict[str, Any]:
+    chat_id = int(params["chat_id"])
+    message = {
+      "message_id": next(self._message_ids),
+      "date": int(time.time()),
+      "chat": self._chat(chat_id),
+      "from": BOT_USER,
+      "text": params.get("text", ""),
+    }
+    if "reply_markup" in params:
+      message["reply_markup"] = params["reply_markup"]
+    self.last_sent[chat_id] = message
+    if "reply_to_message_id" in params:
+      self.replies_to[(chat_id, int(params["reply_to_message_id"]))] = message
+    return self._store(message)
+
+  def edit_message(self, params: Dict[str, Any]) -> Dict[str, Any]:
+    chat_id, message_id = int(params["chat_id"]), int(params["message_id"])
+    message = dict(self.messages.get((chat_id, message_id)) or {
+      "message_id": message_id, "date": int(time.time()), "chat": self._chat(chat_id), "from": BOT_USER
+    })
+    if "text" in params:
+      message["text"] = params["text"]
+    message.pop("reply_markup", None)
+    if "reply_markup" in params:
+      message["reply_markup"] = params["reply_markup"]
+    return self._store(message)
+
+  async def handle(self, request: Request) -> JSONResponse:
+    method = request.path_params["method"]
+    self.calls[method] += 1
+    params = {}
+    for key, value in parse_qsl((await request.body()).decode()):
+      try:
+        params[key] = json.loads(value)
+      except ValueError:
+        params[key] = value
+    if self.latency:
+      await asyncio.sleep(self.latency)
+
+    if method == "getMe":
+      result: Any = BOT_USER
+    elif method == "sendMessage":
+      result = self.send_message(params)
+    elif method in ("editMessageText", "editMessageReplyMarkup"):
+      result = self.edit_message(params)
+    elif method == "copyMessage":
+      result = {"message_id": self.send_message(params)["message_id"]}
+    else:
+      result = True
+    return JSONResponse({"ok": True, "result": result})
+
+
+def _button(message: Dict[str, Any], action: str) -> Optional[str]:
+  """The callback data of the message's first button for this action."""
+  for row in message.get("reply_markup", {}).get("inline_keyboard", []):
+    for button in row:
+      data = button.get("callback_data", "")
+      if data.split()[:1] == [action]:
+        return data
+  return None
+
+
+def _user(user_id: int) -> Dict[str, Any]:
+  return {"id": user_id, "is_bot": False, "first_name": "User", "last_name": str(user_id), "username": f"user{user_id}"}
+
+
+class Replay:
+  """Feeds updates to the application and times each one."""
+
+  def __init__(self, application, api: FakeBotAPI):
+    self.application = application
+    self.api = api
+    self.latencies: Dict[str, List[float]] = defaultdict(list)
+    self.updates = 0
+    self.errors: Counter = Counter()
+    self._update_ids = itertools.count(1)
+    self._message_ids = itertools.count(1_000_000_000)
+
+  async def process(self, label: str, data: Dict[str, Any]) -> None:
+    from telegram import Update
+
+    data["update_id"] = next(self._update_ids)
+    update = Update.de_json(data, self.application.bot)
+    started = time.perf_counter()
+    await self.application.process_update(update)
+    self.latencies[label].append(time.perf_counter() - started)
+    self.updates += 1
+
+  async def message(self, label: str, chat_id: int, user_id: int, text: str) -> None:
+    message = {
+      "message_id": next(self._message_ids),
+      "date": int(time.time()),
+      "chat": self.api._chat(chat_id),
+      "from": _user(user_id),
+      "text": text,
+    }
+    if text.startswith("/"):
+      message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    await self.process(label, {"message": message})
+
+  async def press(self, label: str, user_id: int, message: Optional[Dict[str, Any]], data: str) -> None:
+    if message is None:
+      self.errors[f"{label}: no message to press"] += 1
+      return
+    callback_query = {
+      "id": str(next(self._message_ids)),
+      "from": _user(user_id),
+      "chat_instance": "benchmark",
+      "data": data,
+      "message": message,
+    }
+    await self.process(label, {"callback_query": callback_query})
+
+  async def ask_and_answer(self, index: int, research_chat_id: int) -> None:
+    asker = ASKER_IDS + index
+    member = MEMBER_IDS + index
+    await self.message("ask_question", asker, asker, "/ask_question")
+    prompt = self.api.last_sent.get(asker)
+    await self.message(
+      "confirm_question", asker, asker, f"Question {index}: how do I apply for research funding for project {index}?"
+    )
+    await self.press("confirmed_question", asker, prompt and self.api.messages[(asker, prompt["message_id"])], "confirm")
+
+    question = self.api.reply_targets.get(asker)
+    await self.press("reply_question", member, question, question and _button(question, "reply") or "")
+    if question is None:
+      return
+    prompt = self.api.replies_to.get((research_chat_id, question["message_id"]))
+    await self.message("confirm_reply", research_chat_id, member, f"Reply {index}: ask the grants office.")
+    await self.press(
+      "confirmed_reply", member, prompt and self.api.messages[(research_chat_id, prompt["message_id"])], "confirm"
+    )
+
+  async def recorded(self, updates: List[Dict[str, Any]]) -> None:
+    for data in updates:
+      data.pop("update_id", None)
+      await self.process("recorded", data)
+
+
+def _recorded_by_user(path: str) -> List[List[Dict[str, Any]]]:
+  """Recorded updates grouped by user, each user's in their original order."""
+  by_user: Dict[Any, List[Dict[str, Any]]] = defaultdict(list)
+  with open(path) as file:
+    for line in file:
+      if line.strip():
+        data = json.loads(line)
+        sender = next((value.get("from", {}).get("id") for value in data.values() if isinstance(value, dict)), None)
+        by_user[sender].append(data)
+  return list(by_user.values())
+
+
+def _percentiles(seconds: List[float]) -> Dict[str, float]:
+  if not seconds:
+    return {"count": 0}
+  ms = np.array(seconds) * 1000
+  p50, p95, p99 = np.percentile(ms, [50, 95, 99])
+  return {
+    "count": len(ms),
+    "p50_ms": round(float(p50), 3),
+    "p95_ms": round(float(p95), 3),
+    "p99_ms": round(float(p99), 3),
+    "max_ms": round(float(ms.max()), 3),
+  }
+
+
+def _free_port() -> int:
+  with socket.socket() as sock:
+    sock.bind(("127.0.0.1", 0))
+    return sock.getsockname()[1]
+
+
+async def run(args: argparse.Namespace) -> Dict[str, Any]:
+  import main
+
+  api = FakeBotAPI(latency=args.api_latency / 1000)
+  port = _free_port()
+  server = uvicorn.Server(uvicorn.Config(api.app, host="127.0.0.1", port=port, log_level="warning", lifespan="off"))
+  # on its own thread and event loop, so the fake API does not eat into the bot's time
+  server_thread = threading.Thread(target=server.run, daemon=True)
+  server_thread.start()
+  while not server.started:
+    await asyncio.sleep(0.01)
+
+  application = main.build_application(base_url=f"http://127.0.0.1:{port}/bot", rate_limit=args.rate_limit)
+  replay = Replay(application, api)
+
+  async def count_error(update: object, context) -> None:
+    replay.errors[type(context.error).__name__] += 1
+
+  application.add_error_handler(count_error)
+  await application.initialize()
+  if application.post_init:
+    await application.post_init(application)
+  await application.start()
+
+  flushes: List[float] = []
+  done = asyncio.Event()
+
+  async def flush_periodically() -> None:
+    while not done.is_set():
+      try:
+        await asyncio.wait_for(done.wait(), args.flush_interval)
+      except asyncio.TimeoutError:
+        pass
+      started = time.perf_counter()
+      await application.update_persistence()
+      flushes.append(time.perf_counter() - started)
+
+  flusher = asyncio.create_task(flush_periodically())
+  semaphore = asyncio.Semaphore(args.concurrency)
+
+  async def limited(flow) -> None:
+    async with semaphore:
+      await flow
+
+  started = time.perf_counter()
+  if args.updates:
+    flows = [replay.recorded(updates) for updates in _recorded_by_user(args.updates)]
+  else:
+    flows = [replay.ask_and_answer(index, main.research_chat_id) for index in range(args.users)]
+  await asyncio.gather(*(limited(flow) for flow in flows))
+  duration = time.perf_counter() - started
+
+  done.set()
+  await flusher
+  await application.stop()
+  if application.post_shutdown:
+    await application.post_shutdown(application)
+  await application.shutdown()
+  server.should_exit = True
+  server_thread.join()
+
+  api_calls = sum(api.calls.values())
+  return {
+    "users": 0 if args.updates else args.users,
+    "concurrency": args.concurrency,
+    "rate_limit": args.rate_limit,
+    "api_latency_ms": args.api_latency,
+    "updates": replay.updates,
+    "duration_s": round(duration, 3),
+    "updates_per_second": round(replay.updates / duration, 1) if duration else None,
+    "errors": dict(replay.errors),
+    "handlers": {label: _percentiles(seconds) for label, seconds in replay.latencies.items()},
+    "bot_api": {
+      "calls": api_calls,
+      "calls_per_update": round(api_calls / replay.updates, 3) if replay.updates else None,
+      "by_method": dict(api.calls),
+    },
+    "persistence_flush": dict(_percentiles(flushes), state_file_bytes=os.path.getsize(main.STATE_FILE)),
+  }
+
+
+def main() -> None:
+  parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+  parser.add_argument("--users", type=int, default=500, help="simulated askers, each answered by a committee member")
+  parser.add_argument("--concurrency", type=int, default=200, help="conversations running at the same time")
+  parser.add_argument("--updates", help="replay recorded updates from this JSON lines file instead")
+  parser.add_argument("--api-latency", type=float, default=0, help="milliseconds the fake Bot API waits per call")
+  parser.add_argument("--flush-interval", type=float, default=1, help="seconds between timed persistence flushes")
+  parser.add_argument("--rate-limit", action="store_true", help="keep the Telegram rate limiter on")
+  parser.add_argument("--output", help="also write the results to this file")
+  args = parser.parse_args()
+
+  os.environ["telegram_API_key"] = BENCHMARK_TOKEN
+  if args.updates:
+    args.updates = os.path.abspath(args.updates)
+  if args.output:
+    args.output = os.path.abspath(args.output)
+  sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+  with tempfile.TemporaryDirectory() as state_dir:
+    # main.py keeps its state files in the working directory
+    os.chdir(state_dir)
+    logging.disable(logging.WARNING)
+    results = asyncio.run(run(args))
+
+  report = json.dumps(results, indent=2)
+  print(report)
+  if args.output:
+    with open(args.output, "w") as file:
+      file.write(report + "\n")
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,296 @@
+import asyncio
+import logging
+import sqlite3
+import time
+import uuid
+from typing import Dict, Iterable, List, NamedTuple, Optional, Set, Tuple
+
+from telegram.error import BadRequest, Forbidden, RetryAfter, TelegramError
+from telegram.ext import Application
+
+from persistence import StateFile
+from ratelimiter import PRIORITY_BROADCAST
+
+logger = logging.getLogger(__name__)
+
+# a broadcast whose sender has not checked in for this long is taken over
+STALE_AFTER = 120
+# how often the sender checks in, whether or not its messages are getting out
+HEARTBEAT_INTERVAL = 20
+BATCH_SIZE = 200
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS known_users (user_id INTEGER PRIMARY KEY, first_seen REAL NOT NULL, blocked_at REAL);
+CREATE TABLE IF NOT EXISTS broadcasts (
+  id INTEGER PRIMARY KEY,
+  text TEXT NOT NULL,
+  chat_id INTEGER NOT NULL,
+  created_by INTEGER NOT NULL,
+  created_at REAL NOT NULL,
+  state TEXT NOT NULL DEFAULT 'draft',
+  owner TEXT,
+  heartbeat REAL,
+  started_at REAL,
+  finished_at REAL
+);
+CREATE TABLE IF NOT EXISTS broadcast_deliveries (
+  broadcast_id INTEGER NOT NULL,
+  user_id INTEGER NOT NULL,
+  status TEXT,
+  not_before REAL,
+  PRIMARY KEY (broadcast_id, user_id)
+);
+CREATE INDEX IF NOT EXISTS broadcast_deliveries_pending ON broadcast_deliveries (broadcast_id, user_id) WHERE status IS NULL;
+"""
+
+# (table, column, declaration) added after the table was first released
+_ADDED_COLUMNS = [
+  ("broadcast_deliveries", "not_before", "REAL"),
+]
+
+
+def _create_tables(conn: sqlite3.Connection) -> None:
+  conn.executescript(_SCHEMA)
+  for table, column, declaration in _ADDED_COLUMNS:
+    columns = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+    if column not in columns:
+      conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {declaration}")
+
+
+class BroadcastReport(NamedTuple):
+  broadcast_id: int
+  chat_id: int
+  sent: int
+  blocked: int
+  failed: int
+  seconds: float
+
+
+class Broadcaster:
+  """Sends an announcement to every user who has talked to the bot.
+
+  Users are recorded in ``known_users`` the first time each process sees
+  them. Starting a broadcast snapshots the recipients into
+  ``broadcast_deliveries`` and every delivery is marked off as soon as it
+  completes, so a broadcast interrupted by a restart resumes with the users
+  it has not reached yet. The sender checks in every ``HEARTBEAT_INTERVAL``
+  seconds from its own task, so a broadcast waiting on the rate limiter is
+  not mistaken for an abandoned one, and stops if another worker took
+  over. Up to ``concurrency`` messages are in flight at once and the bot's
+  rate limiter keeps them under Telegram's global limit, behind any replies
+  to users. Users who blocked the bot are left out of later broadcasts. A
+  delivery Telegram still throttles after the rate limiter's retries stays
+  pending, with the time it may be tried again in ``not_before``.
+  """
+
+  def __init__(self, filepath: str, concurrency: int = 30):
+    self.state = StateFile.open(filepath)
+    self.concurrency = concurrency
+    self.owner = uuid.uuid4().hex
+    self._seen: Set[int] = set()
+    self._tasks: Dict[int, asyncio.Task] = {}
+    self.state.register(_create_tables)
+
+  def _remember(self, user_ids: List[int]) -> None:
+    now = time.time()
+    with self.state.transaction() as conn:
+      conn.executemany(
+        "INSERT OR IGNORE INTO known_users (user_id, first_seen) VALUES (?, ?)", [(user_id, now) for user_id in user_ids]
+      )
+
+  async def remember(self, user_ids: Iterable[int]) -> None:
+    new = [user_id for user_id in user_ids if user_id not in self._seen]
+    if new:
+      self._seen.update(new)
+      await self.state.run(self._remember, new)
+
+  def _create(self, text: str, chat_id: int, created_by: int) -> int:
+    return self.state.conn.execute(
+      "INSERT INTO broadcasts (text, chat_id, created_by, created_at) VALUES (?, ?, ?, ?)",
+      (text, chat_id, created_by, time.time())
+    ).lastrowid
+
+  async def create(self, text: str, chat_id: int, created_by: int) -> int:
+    """Saves a draft to be confirmed with ``start()``."""
+    return await self.state.run(self._create, text, chat_id, created_by)
+
+  def _recipient_count(self) -> int:
+    return self.state.conn.execute("SELECT COUNT(*) FROM known_users WHERE blocked_at IS NULL").fetchone()[0]
+
+  async def recipient_count(self) -> int:
+    return await self.state.run(self._recipient_count)
+
+  def _discard(self, broadcast_id: int) -> bool:
+    return self.state.conn.execute(
+      "DELETE FROM broadcasts WHERE id = ? AND state = 'draft'", (broadcast_id,)
+    ).rowcount == 1
+
+  async def discard(self, broadcast_id: int) -> bool:
+    return await self.state.run(self._discard, broadcast_id)
+
+  def _claim(self, broadcast_id: int) -> Optional[str]:
+    """Takes over a draft or a stale broadcast, snapshotting the recipients
+    the first time. Returns its text, None if it is not ours to send."""
+    now = time.time()
+    with self.state.transaction() as conn:
+      row = conn.execute(
+        "SELECT text, state FROM broadcasts WHERE id = ?"
+        " AND (state = 'draft' OR (state = 'sending' AND (owner = ? OR heartbeat < ?)))",
+        (broadcast_id, self.owner, now - STALE_AFTER)
+      ).fetchone()
+      if row is None:
+        return None
+      text, state = row
+      if state == "draft":
+        conn.execute(
+          "INSERT OR IGNORE INTO broadcast_deliveries (broadcast_id, user_id)"
+          " SELECT ?, user_id FROM known_users WHERE blocked_at IS NULL", (broadcast_id,)
+        )
+      conn.execute(
+        "UPDATE broadcasts SET state = 'sending', owner = ?, heartbeat = ?, started_at = COALESCE(started_at, ?)"
+        " WHERE id = ?", (self.owner, now, now, broadcast_id)
+      )
+    return text
+
+  def _pending(self, broadcast_id: int) -> Tuple[List[int], Optional[float]]:
+    """Up to ``BATCH_SIZE`` recipients due now, and when the next one held
+    back by Telegram is due, None if there is none."""
+    now = time.time()
+    user_ids = [row[0] for row in self.state.conn.execute(
+      "SELECT user_id FROM broadcast_deliveries WHERE broadcast_id = ? AND status IS NULL"
+      " AND (not_before IS NULL OR not_before <= ?) LIMIT ?",
+      (broadcast_id, now, BATCH_SIZE)
+    )]
+    next_due = self.state.conn.execute(
+      "SELECT MIN(not_before) FROM broadcast_deliveries WHERE broadcast_id = ? AND status IS NULL AND not_before > ?",
+      (broadcast_id, now)
+    ).fetchone()[0]
+    return user_ids, next_due
+
+  def _record(self, broadcast_id: int, user_id: int, status: Optional[str], not_before: Optional[float]) -> None:
+    with self.state.transaction() as conn:
+      conn.execute(
+        "UPDATE broadcast_deliveries SET status = ?, not_before = ? WHERE broadcast_id = ? AND user_id = ?",
+        (status, not_before, broadcast_id, user_id)
+      )
+      if status == "blocked":
+        conn.execute("UPDATE known_users SET blocked_at = ? WHERE user_id = ?", (time.time(), user_id))
+
+  def _beat(self, broadcast_id: int) -> bool:
+    """Refreshes the heartbeat, returns False if another worker took over."""
+    return self.state.conn.execute(
+      "UPDATE broadcasts SET heartbeat = ? WHERE id = ? AND owner = ?", (time.time(), broadcast_id, self.owner)
+    ).rowcount == 1
+
+  def _finish(self, broadcast_id: int) -> BroadcastReport:
+    now = time.time()
+    self.state.conn.execute("UPDATE broadcasts SET state = 'done', finished_at = ? WHERE id = ?", (now, broadcast_id))
+    chat_id, started_at = self.state.conn.execute(
+      "SELECT chat_id, started_at FROM broadcasts WHERE id = ?", (broadcast_id,)
+    ).fetchone()
+    counts = dict(self.state.conn.execute(
+      "SELECT status, COUNT(*) FROM broadcast_deliveries WHERE broadcast_id = ? GROUP BY status", (broadcast_id,)
+    ).fetchall())
+    return BroadcastReport(
+      broadcast_id, chat_id, counts.get("sent", 0), counts.get("blocked", 0), counts.get("failed", 0), now - started_at
+    )
+
+  async def _send_one(self, application: Application, user_id: int, text: str) -> Tuple[Optional[str], Optional[float]]:
+    """The status to record and, for a delivery left pending, when to try
+    it again."""
+    bot = application.bot
+    kwargs = {"rate_limit_args": PRIORITY_BROADCAST} if bot.rate_limiter else {}
+    try:
+      await bot.send_message(user_id, text, **kwargs)
+      return "sent", None
+    except Forbidden as exc:
+      # blocked the bot or deleted their account
+      logger.debug("Dropping %s from broadcasts: %s", user_id, exc)
+      return "blocked", None
+    except BadRequest as exc:
+      if "chat not found" in exc.message.lower():
+        logger.debug("Dropping %s from broadcasts: %s", user_id, exc)
+        return "blocked", None
+      logger.info("Broadcast to %s failed: %s", user_id, exc)
+      return "failed", None
+    except RetryAfter as exc:
+      # throttled even after the rate limiter's retries, not the recipient's fault
+      logger.info("Broadcast to %s held back for %ss", user_id, exc.retry_after)
+      return None, time.time() + exc.retry_after
+    except TelegramError as exc:
+      logger.info("Broadcast to %s failed: %s", user_id, exc)
+      return "failed", None
+
+  async def _deliver(
+    self, application: Application, semaphore: asyncio.Semaphore, lost: asyncio.Event, broadcast_id: int, user_id: int, text: str
+  ) -> None:
+    async with semaphore:
+      if lost.is_set():
+        return
+      status, not_before = await self._send_one(application, user_id, text)
+    await self.state.run(self._record, broadcast_id, user_id, status, not_before)
+
+  async def _heartbeat(self, broadcast_id: int, lost: asyncio.Event) -> None:
+    while await self.state.run(self._beat, broadcast_id):
+      await asyncio.sleep(HEARTBEAT_INTERVAL)
+    lost.set()
+
+  async def _send(self, application: Application, broadcast_id: int, text: str) -> Optional[BroadcastReport]:
+    semaphore = asyncio.Semaphore(self.concurrency)
+    lost = asyncio.Event()
+    heartbeat = asyncio.create_task(self._heartbeat(broadcast_id, lost))
+    try:
+      while not lost.is_set():
+        user_ids, next_due = await self.state.run(self._pending, broadcast_id)
+        if not user_ids:
+          if next_due is None:
+            return await self.state.run(self._finish, broadcast_id)
+          await asyncio.sleep(min(max(next_due - time.time(), 0), HEARTBEAT_INTERVAL))
+          continue
+        await asyncio.gather(*(
+          self._deliver(application, semaphore, lost, broadcast_id, user_id, text) for user_id in user_ids
+        ))
+    finally:
+      heartbeat.cancel()
+    logger.warning("Broadcast %s was taken over by another worker.", broadcast_id)
+    return None
+
+  async def start(self, application: Application, broadcast_id: int, on_done=None) -> bool:
+    """Starts sending a broadcast in the background unless another worker
+    is already on it. ``on_done`` is awaited with the ``BroadcastReport``."""
+    if broadcast_id in self._tasks:
+      return False
+    text = await self.state.run(self._claim, broadcast_id)
+    if text is None:
+      return False
+
+    async def send() -> None:
+      try:
+        report = await self._send(application, broadcast_id, text)
+        if report is not None and on_done is not None:
+          await on_done(report)
+      except Exception:
+        logger.exception("Broadcast %s stopped, it will be resumed later", broadcast_id)
+      finally:
+        del self._tasks[broadcast_id]
+
+    self._tasks[broadcast_id] = asyncio.create_task(send())
+    return True
+
+  def _stale(self) -> List[int]:
+    return [row[0] for row in self.state.conn.execute(
+      "SELECT id FROM broadcasts WHERE state = 'sending' AND heartbeat < ?", (time.time() - STALE_AFTER,)
+    )]
+
+  async def resume(self, application: Application, on_done=None) -> int:
+    """Picks up broadcasts left unfinished by a stopped worker."""
+    resumed = 0
+    for broadcast_id in await self.state.run(self._stale):
+      if await self.start(application, broadcast_id, on_done):
+        resumed += 1
+    return resumed
+
+  async def stop(self) -> None:
+    for task in list(self._tasks.values()):
+      task.cancel()
+    await asyncio.gather(*self._tasks.values(), return_exceptions=True)
@@ -0,0 +1,150 @@
+import asyncio
+import logging
+import time
+from collections import defaultdict
+from typing import Dict, List, Optional, Set, Tuple
+
+from telegram.error import BadRequest, Forbidden, RetryAfter, TelegramError
+from telegram.ext import Application
+
+logger = logging.getLogger(__name__)
+
+MessageRef = Tuple[int, int]
+
+# Bot API limit for a single deleteMessages call
+BULK_DELETE_LIMIT = 100
+RETRY_DELAY = 30
+# deletions scheduled by another worker (or a previous run) are picked up
+# once they are this many seconds overdue
+ORPHAN_GRACE = 60
+
+
+class MessageCleaner:
+  """Deletes messages in the background so handlers never wait on it.
+
+  Pending deletions live in ``bot_data["pending_deletions"]`` as
+  ``{(chat_id, message_id): due_timestamp}``, so anything still queued or
+  failed with a transient error is retried after a restart. Due messages are
+  grouped per chat and removed with one ``deleteMessages`` call per chat when
+  the installed PTB supports it, otherwise one call per message, with at most
+  ``max_in_flight`` requests running at once. When several workers share
+  ``bot_data``, each one only deletes what it scheduled itself until a
+  deletion is ``ORPHAN_GRACE`` seconds overdue.
+  """
+
+  def __init__(self, max_in_flight: int = 8):
+    self.max_in_flight = max_in_flight
+    self.pending: Dict[MessageRef, float] = {}
+    self._owned: Set[MessageRef] = set()
+    self._in_flight: Set[MessageRef] = set()
+    self._tasks: Set[asyncio.Task] = set()
+    self._semaphore: Optional[asyncio.Semaphore] = None
+    self._wake: Optional[asyncio.Event] = None
+    self._worker: Optional[asyncio.Task] = None
+    self.application: Optional[Application] = None
+
+  def schedule(self, chat_id: int, message_id: int, delay: float = 0) -> None:
+    self.pending[(chat_id, message_id)] = time.time() + delay
+    self._owned.add((chat_id, message_id))
+    if self._wake is not None:
+      self._wake.set()
+
+  def schedule_many(self, to_delete: Dict[int, int], delay: float = 0) -> None:
+    """Takes the ``{message_id: chat_id}`` dicts kept in ``user_data``."""
+    for message_id, chat_id in to_delete.items():
+      self.schedule(chat_id, message_id, delay)
+
+  async def start(self, application: Application) -> None:
+    self.application = application
+    # carry over anything scheduled before start() and anything left from the last run
+    persisted = application.bot_data.setdefault("pending_deletions", {})
+    persisted.update(self.pending)
+    self.pending = persisted
+    self._semaphore = asyncio.Semaphore(self.max_in_flight)
+    self._wake = asyncio.Event()
+    self._worker = asyncio.create_task(self._run())
+
+  async def stop(self) -> None:
+    if self._worker is not None:
+      self._worker.cancel()
+      try:
+        await self._worker
+      except asyncio.CancelledError:
+        pass
+      self._worker = None
+    if self._tasks:
+      await asyncio.gather(*self._tasks, return_exceptions=True)
+
+  async def _run(self) -> None:
+    while True:
+      now = time.time()
+      due: Dict[int, List[int]] = defaultdict(list)
+      next_due = None
+      for ref, due_at in self.pending.items():
+        if ref in self._in_flight:
+          continue
+        if ref not in self._owned:
+          due_at += ORPHAN_GRACE
+        if due_at <= now:
+          due[ref[0]].append(ref[1])
+        elif next_due is None or due_at < next_due:
+          next_due = due_at
+
+      for chat_id, message_ids in due.items():
+        for i in range(0, len(message_ids), BULK_DELETE_LIMIT):
+          batch = message_ids[i:i + BULK_DELETE_LIMIT]
+          self._in_flight.update((chat_id, message_id) for message_id in batch)
+          task = asyncio.create_task(self._delete(chat_id, batch))
+          self._tasks.add(task)
+          task.add_done_callback(self._tasks.discard)
+
+      self._wake.clear()
+      # other workers may add deletions to bot_data without waking us
+      timeout = ORPHAN_GRACE if next_due is None else min(max(next_due - time.time(), 0), ORPHAN_GRACE)
+      try:
+        await asyncio.wait_for(self._wake.wait(), timeout)
+      except asyncio.TimeoutError:
+        pass
+
+  async def _delete_one(self, chat_id: int, message_id: int) -> None:
+    async with self._semaphore:
+      await self.application.bot.delete_message(chat_id=chat_id, message_id=message_id)
+
+  async def _delete(self, chat_id: int, message_ids: List[int]) -> None:
+    bot = self.application.bot
+    try:
+      if len(message_ids) > 1 and hasattr(bot, "delete_messages"):
+        async with self._semaphore:
+          await bot.delete_messages(chat_id=chat_id, message_ids=message_ids)
+        failed = []
+      else:
+        # each call takes its own slot, so a batch never has more than max_in_flight requests out
+        results = await asyncio.gather(
+          *(self._delete_one(chat_id, message_id) for message_id in message_ids), return_exceptions=True
+        )
+        failed = [
+          (message_id, result) for message_id, result in zip(message_ids, results)
+          if isinstance(result, Exception)
+        ]
+    except Exception as exc:
+      failed = [(message_id, exc) for message_id in message_ids]
+
+    for message_id, exc in failed:
+      ref = (chat_id, message_id)
+      if isinstance(exc, (BadRequest, Forbidden)) or not isinstance(exc, TelegramError):
+        # already deleted, too old to delete or not ours to delete
+        logger.debug("Dropping deletion of %s: %s", ref, exc)
+        continue
+      delay = exc.retry_after if isinstance(exc, RetryAfter) else RETRY_DELAY
+      logger.info("Retrying deletion of %s in %ss: %s", ref, delay, exc)
+      self.pending[ref] = time.time() + delay
+      self._owned.add(ref)
+      self._in_flight.discard(ref)
+      message_ids.remove(message_id)
+
+    for message_id in message_ids:
+      ref = (chat_id, message_id)
+      self.pending.pop(ref, None)
+      self._owned.discard(ref)
+      self._in_flight.discard(ref)
+    self._wake.set()
@@ -0,0 +1,111 @@
+"""Moves the answered-questions ledger out of the bot's state file and
+reports how long loading the state takes, and how much memory it needs,
+before and after.
+
+    python compact.py --output compaction.json
+
+Run it with the bot stopped, from the directory it keeps its state in. If
+there is no SQLite state file yet, the old PicklePersistence file is
+imported first and the "before" figures are for loading the pickle. The bot
+does the same on startup when it finds the ledger still in the state file;
+this lets it be done, and measured, ahead of a deploy.
+
+Each load is measured in a fresh interpreter, so the resident size is that
+of the loaded state alone.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import resource
+import subprocess
+import sys
+import time
+from typing import Any, Dict
+
+from telegram.ext import PicklePersistence
+
+from ledger import LedgerArchive, compact_state
+from persistence import SQLitePersistence, migrate_pickle
+
+# the persistent ConversationHandlers in main.py
+CONVERSATIONS = ("new_question", "new_reply")
+
+
+async def _load(persistence) -> None:
+  # what Application.initialize loads
+  await persistence.get_user_data()
+  await persistence.get_chat_data()
+  await persistence.get_bot_data()
+  await persistence.get_callback_data()
+  for name in CONVERSATIONS:
+    await persistence.get_conversations(name)
+
+
+def measure_load(kind: str, filepath: str) -> Dict[str, Any]:
+  """Loads a state file the way the bot does on startup, in this process."""
+  if kind == "pickle":
+    persistence = PicklePersistence(filepath)
+  else:
+    persistence = SQLitePersistence(filepath)
+  # ru_maxrss is in KiB on Linux
+  rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  started = time.perf_counter()
+  asyncio.run(_load(persistence))
+  return {
+    "file": filepath,
+    "file_bytes": os.path.getsize(filepath),
+    "load_s": round(time.perf_counter() - started, 4),
+    "resident_mib": round((resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before) / 1024, 2),
+  }
+
+
+def _measure(kind: str, filepath: str) -> Dict[str, Any]:
+  result = subprocess.run(
+    [sys.executable, os.path.abspath(__file__), "--measure", kind, filepath],
+    check=True, stdout=subprocess.PIPE, universal_newlines=True
+  )
+  return json.loads(result.stdout)
+
+
+def main() -> None:
+  parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+  parser.add_argument("--state", default="conversationbot.sqlite3", help="SQLite state file of the bot")
+  parser.add_argument("--archive", default="conversationbot_archive.sqlite3", help="archive the ledger is moved to")
+  parser.add_argument("--pickle", default="conversationbot", help="PicklePersistence file to import if there is no state file")
+  parser.add_argument("--output", help="also write the report to this file")
+  parser.add_argument("--measure", nargs=2, metavar=("KIND", "FILE"), help=argparse.SUPPRESS)
+  args = parser.parse_args()
+
+  if args.measure:
+    print(json.dumps(measure_load(*args.measure)))
+    return
+
+  logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+  if os.path.exists(args.state):
+    before = _measure("sqlite", args.state)
+  elif os.path.exists(args.pickle):
+    before = _measure("pickle", args.pickle)
+    migrate_pickle(args.pickle, args.state)
+  else:
+    sys.exit(f"Neither {args.state} nor {args.pickle} exists.")
+
+  archive = LedgerArchive(args.archive)
+  moved = compact_state(args.state, archive)
+  archive.close()
+
+  report = json.dumps({
+    "moved_to_archive": moved,
+    "archive_bytes": os.path.getsize(args.archive) if os.path.exists(args.archive) else 0,
+    "before": before,
+    "after": _measure("sqlite", args.state),
+  }, indent=2)
+  print(report)
+  if args.output:
+    with open(args.output, "w") as file:
+      file.write(report + "\n")
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,271 @@
+import asyncio
+import fcntl
+import logging
+import sqlite3
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, Hashable, Optional
+
+from telegram import Update
+from telegram.ext import Application
+
+logger = logging.getLogger(__name__)
+
+
+class KeyedLocks:
+  """One ``asyncio.Lock`` per key, created on demand and dropped once no
+  coroutine holds or waits for it, so the dict never outgrows the number of
+  keys in use."""
+
+  def __init__(self):
+    self._locks: Dict[Hashable, asyncio.Lock] = {}
+    self._waiters: Dict[Hashable, int] = {}
+
+  @asynccontextmanager
+  async def __call__(self, key: Hashable) -> AsyncIterator[None]:
+    lock = self._locks.setdefault(key, asyncio.Lock())
+    self._waiters[key] = self._waiters.get(key, 0) + 1
+    try:
+      async with lock:
+        yield
+    finally:
+      self._waiters[key] -= 1
+      if not self._waiters[key]:
+        del self._waiters[key]
+        del self._locks[key]
+
+  def __len__(self) -> int:
+    return len(self._locks)
+
+
+class PerUserApplication(Application):
+  """Processes updates concurrently, except that updates from the same user
+  are processed one after another.
+
+  ``ConversationHandler`` relies on the updates of a conversation arriving
+  one by one. Both conversations of this bot are keyed on the user, so
+  serialising per user keeps them consistent while different users no
+  longer wait on each other.
+  """
+
+  def __init__(self, **kwargs):
+    super().__init__(**kwargs)
+    self.user_locks = KeyedLocks()
+    self._bot_data_locks = KeyedLocks()
+    # a metrics.Metrics to report persistence flushes to
+    self.metrics = None
+    # a spool.UpdateSpool to mark handled updates in
+    self.spool = None
+
+  @property
+  def is_primary(self) -> bool:
+    """Whether this process runs the periodic jobs."""
+    return True
+
+  def bot_data_lock(self, key: Hashable, subkey: Hashable = None):
+    """Guards a read-modify-write of ``bot_data[key]``, or with ``subkey``
+    only of ``bot_data[key][subkey]``, that spans an ``await`` or that other
+    handlers may do at the same time."""
+    return self._bot_data_locks((key, subkey))
+
+  @asynccontextmanager
+  async def user_state(self, user_id: int) -> AsyncIterator[None]:
+    """Holds back the updates of a user while a job changes their
+    ``user_data`` or conversations."""
+    async with self.user_locks(user_id):
+      yield
+      # pylint: disable=protected-access
+      self._user_ids_to_be_updated_in_persistence.add(user_id)
+
+  def end_conversations(self, name: str, user_id: int) -> int:
+    """Ends every conversation of ``user_id`` in the ``ConversationHandler``
+    called ``name``, as if it had returned ``END``."""
+    # pylint: disable=protected-access
+    conversations = self._conversation_handler_conversations.get(name, {})
+    keys = [key for key in conversations if key[-1] == user_id]
+    for key in keys:
+      del conversations[key]
+    return len(keys)
+
+  async def update_persistence(self) -> None:
+    if self.metrics is None or self.persistence is None:
+      await super().update_persistence()
+      return
+    written = getattr(self.persistence, "bytes_written", 0)
+    started = time.perf_counter()
+    await super().update_persistence()
+    self.metrics.observe_flush(time.perf_counter() - started, getattr(self.persistence, "bytes_written", 0) - written)
+
+  async def _processed(self, update: object) -> None:
+    if self.spool is not None and isinstance(update, Update):
+      await self.spool.done(update.update_id)
+
+  @asynccontextmanager
+  async def _user_turn(self, user_id: int) -> AsyncIterator[None]:
+    """Waits until no other update of the user is being handled."""
+    async with self.user_locks(user_id):
+      yield
+
+  @asynccontextmanager
+  async def _turn(self, update: object) -> AsyncIterator[None]:
+    if isinstance(update, Update) and update.effective_user is not None:
+      async with self._user_turn(update.effective_user.id):
+        yield
+    else:
+      yield
+
+  async def _handle(self, update: object) -> None:
+    """Handles an update during its user's turn."""
+    await Application.process_update(self, update)
+
+  async def process_update(self, update: object) -> None:
+    try:
+      async with self._turn(update):
+        await self._handle(update)
+    finally:
+      await self._processed(update)
+
+  async def _Application__process_update_wrapper(self, update: object) -> None:
+    # Replaces Application.__process_update_wrapper, which takes one of the
+    # concurrent_updates slots before calling process_update(). A user
+    # flooding the bot would fill every slot with updates waiting on their
+    # own lock, so the user's turn comes first and the slot second.
+    try:
+      async with self._turn(update):
+        async with self._concurrent_updates_sem:
+          await self._handle(update)
+    finally:
+      await self._processed(update)
+    self.update_queue.task_done()
+
+
+class LeaseLocks:
+  """Like ``KeyedLocks``, but also excludes other processes using the same
+  SQLite file.
+
+  A lease row expires after ``ttl`` seconds, so a worker that dies while
+  holding one does not block the key forever. While it is held, it is
+  renewed every third of ``ttl`` from a background task, so a handler
+  waiting on Telegram's rate limits does not lose it half way.
+  """
+
+  def __init__(self, filepath: str, ttl: float = 60, poll_interval: float = 0.02):
+    self.ttl = ttl
+    self.poll_interval = poll_interval
+    self._local = KeyedLocks()
+    self._conn = sqlite3.connect(filepath, isolation_level=None, check_same_thread=False)
+    self._conn.execute("PRAGMA journal_mode = WAL")
+    self._conn.execute("PRAGMA busy_timeout = 5000")
+    self._conn.execute("CREATE TABLE IF NOT EXISTS leases (key TEXT PRIMARY KEY, owner TEXT NOT NULL, expires REAL NOT NULL)")
+    self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="leases")
+
+  def _try_acquire(self, key: str, owner: str) -> bool:
+    now = time.time()
+    self._conn.execute("BEGIN IMMEDIATE")
+    try:
+      row = self._conn.execute("SELECT expires FROM leases WHERE key = ?", (key,)).fetchone()
+      if row is not None and row[0] > now:
+        return False
+      self._conn.execute("INSERT OR REPLACE INTO leases (key, owner, expires) VALUES (?, ?, ?)", (key, owner, now + self.ttl))
+      return True
+    finally:
+      self._conn.execute("COMMIT")
+
+  def _renew(self, key: str, owner: str) -> bool:
+    return self._conn.execute(
+      "UPDATE leases SET expires = ? WHERE key = ? AND owner = ?", (time.time() + self.ttl, key, owner)
+    ).rowcount == 1
+
+  async def _keep(self, key: str, owner: str) -> None:
+    loop = asyncio.get_running_loop()
+    while True:
+      await asyncio.sleep(self.ttl / 3)
+      if not await loop.run_in_executor(self._executor, self._renew, key, owner):
+        logger.warning("Lost the lease on %s, another worker may take it over", key)
+        return
+
+  def _release(self, key: str, owner: str) -> None:
+    self._conn.execute("DELETE FROM leases WHERE key = ? AND owner = ?", (key, owner))
+
+  @asynccontextmanager
+  async def __call__(self, key: Hashable) -> AsyncIterator[None]:
+    lease_key = repr(key)
+    owner = uuid.uuid4().hex
+    loop = asyncio.get_running_loop()
+    async with self._local(key):
+      while not await loop.run_in_executor(self._executor, self._try_acquire, lease_key, owner):
+        await asyncio.sleep(self.poll_interval)
+      renewal = asyncio.create_task(self._keep(lease_key, owner))
+      try:
+        yield
+      finally:
+        renewal.cancel()
+        await loop.run_in_executor(self._executor, self._release, lease_key, owner)
+
+
+class SharedStateApplication(PerUserApplication):
+  """``PerUserApplication`` for running several worker processes on one
+  ``SQLitePersistence(shared=True)`` file.
+
+  Each update is handled under a lease on its user, after pulling in the
+  conversation states other workers wrote for that user, and the persistence
+  is flushed straight after so the next worker sees the result. One worker
+  at a time holds the primary lock file and runs the periodic jobs.
+  """
+
+  def __init__(self, **kwargs):
+    super().__init__(**kwargs)
+    self.leases: Optional[LeaseLocks] = None
+    self._primary_lock_file = None
+
+  async def initialize(self) -> None:
+    await super().initialize()
+    self.leases = LeaseLocks(self.persistence.filepath)
+
+  @property
+  def is_primary(self) -> bool:
+    if self._primary_lock_file is None:
+      lock_file = open(self.persistence.filepath + ".primary", "a")
+      try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+      except OSError:
+        lock_file.close()
+        return False
+      # held until the process exits
+      self._primary_lock_file = lock_file
+    return True
+
+  @asynccontextmanager
+  async def bot_data_lock(self, key: Hashable, subkey: Hashable = None) -> AsyncIterator[None]:
+    # only the locked entry is read and written, the rest of bot_data is flushed as usual
+    entry = (key,) if subkey is None else (key, subkey)
+    async with self.leases(("bot_data", *entry)):
+      await self.persistence.refresh_bot_data(self.bot_data, *entry)
+      yield
+      await self.persistence.update_bot_data_entry(self.bot_data, *entry)
+
+  @asynccontextmanager
+  async def user_state(self, user_id: int) -> AsyncIterator[None]:
+    async with self.user_locks(user_id), self.leases(("user", user_id)):
+      # pylint: disable=protected-access
+      await self.persistence.refresh_user_data(user_id, self.user_data[user_id])
+      await self.persistence.refresh_conversations(self._conversation_handler_conversations, user_id)
+      yield
+      self._user_ids_to_be_updated_in_persistence.add(user_id)
+      await self.update_persistence()
+
+  @asynccontextmanager
+  async def _user_turn(self, user_id: int) -> AsyncIterator[None]:
+    async with self.user_locks(user_id), self.leases(("user", user_id)):
+      yield
+
+  async def _handle(self, update: object) -> None:
+    if not isinstance(update, Update) or update.effective_user is None:
+      await Application.process_update(self, update)
+      return
+    # pylint: disable=protected-access
+    await self.persistence.refresh_conversations(self._conversation_handler_conversations, update.effective_user.id)
+    await Application.process_update(self, update)
+    await self.update_persistence()
@@ -0,0 +1,140 @@
+import os
+import time
+from typing import List, NamedTuple, Optional, Tuple
+
+import numpy as np
+
+SUBMITTED = 1
+FOLLOW_UP = 2
+REPLIED = 3
+EDITED = 4
+QUESTION_CANCELLED = 5
+REPLY_CANCELLED = 6
+
+# One fixed-size record per event, so the file can be mapped as an array
+EVENT_DTYPE = np.dtype([
+  ("time", "<f8"),
+  ("kind", "u1"),
+  # the committee group the question was posted in and its message id
+  # there, both 0 if it was never sent
+  ("chat", "<i8"),
+  ("question", "<i8"),
+  # user who asked, replied or cancelled
+  ("actor", "<i8"),
+])
+
+# records from before questions were routed to several groups, without the chat
+LEGACY_EVENT_DTYPE = np.dtype([("time", "<f8"), ("kind", "u1"), ("question", "<i8"), ("actor", "<i8")])
+
+DAY = 24 * 60 * 60
+
+
+class Stats(NamedTuple):
+  questions: int
+  replied: int
+  # unanswered questions, whenever they were asked
+  backlog: int
+  # seconds from submission to first reply: p50, p90, p99; None without replies
+  reply_time: Optional[Tuple[float, float, float]]
+  # replies per responder over the window, most first
+  responders: List[Tuple[int, int]]
+  # questions submitted on each of the last days, oldest first
+  daily: List[int]
+
+
+class EventLog:
+  """Append-only log of what happens to questions, one ``EVENT_DTYPE``
+  record per event.
+
+  Records are appended with ``O_APPEND`` in a single write each, so several
+  workers can share the file, and read back by memory-mapping it, so
+  statistics are computed without copying the log into memory. The fields
+  of an event are stored together, so reading any one of them pages in
+  whole records.
+  """
+
+  def __init__(self, filepath: str):
+    self.filepath = filepath
+
+  def append(self, kind: int, chat: int, question: int, actor: int, at: Optional[float] = None) -> None:
+    record = np.array([(time.time() if at is None else at, kind, chat, question, actor)], dtype=EVENT_DTYPE)
+    fd = os.open(self.filepath, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+      os.write(fd, record.tobytes())
+    finally:
+      os.close(fd)
+
+  def import_legacy(self, filepath: str, chat: int) -> int:
+    """Appends the records of a log written before events had a chat, as
+    events in ``chat``, and renames that file out of the way."""
+    legacy = np.fromfile(filepath, dtype=LEGACY_EVENT_DTYPE, count=os.path.getsize(filepath) // LEGACY_EVENT_DTYPE.itemsize)
+    records = np.zeros(len(legacy), dtype=EVENT_DTYPE)
+    for field in LEGACY_EVENT_DTYPE.names:
+      records[field] = legacy[field]
+    records["chat"] = np.where(legacy["question"] != 0, chat, 0)
+    with open(self.filepath, "ab") as file:
+      file.write(records.tobytes())
+    os.replace(filepath, filepath + ".imported")
+    return len(records)
+
+  def read(self) -> np.ndarray:
+    try:
+      size = os.path.getsize(self.filepath)
+    except FileNotFoundError:
+      size = 0
+    # a crash mid-write can leave a partial record at the end
+    count = size // EVENT_DTYPE.itemsize
+    if not count:
+      return np.zeros(0, dtype=EVENT_DTYPE)
+    return np.memmap(self.filepath, dtype=EVENT_DTYPE, mode="r", shape=(count,))
+
+  def stats(self, now: Optional[float] = None, window: float = 30 * DAY, days: int = 7, utc_offset: float = 0) -> Stats:
+    """Statistics over the questions submitted in the last ``window``
+    seconds, with the daily volume of the last ``days`` days counted from
+    midnight at ``utc_offset``."""
+    now = time.time() if now is None else now
+    events = self.read()
+    times, kinds = events["time"], events["kind"]
+    # one id per question across groups: message ids are only unique within a chat
+    _, chat_index = np.unique(events["chat"], return_inverse=True)
+    questions = np.where(events["question"] != 0, (chat_index.astype(np.int64) << 32) | events["question"], 0)
+
+    submitted = np.isin(kinds, (SUBMITTED, FOLLOW_UP)) & (questions != 0)
+    recent = submitted & (times >= now - window)
+    asked_ids, asked_at = questions[recent], times[recent]
+
+    replies = kinds == REPLIED
+    reply_ids, reply_at = questions[replies], times[replies]
+    # first reply per question
+    order = np.lexsort((reply_at, reply_ids))
+    first_ids, first_index = np.unique(reply_ids[order], return_index=True)
+    first_at = reply_at[order][first_index]
+
+    if len(first_ids):
+      position = np.minimum(np.searchsorted(first_ids, asked_ids), len(first_ids) - 1)
+      answered = first_ids[position] == asked_ids
+      waits = first_at[position[answered]] - asked_at[answered]
+    else:
+      answered = np.zeros(len(asked_ids), dtype=bool)
+      waits = np.zeros(0)
+    reply_time = tuple(float(p) for p in np.percentile(waits, [50, 90, 99])) if len(waits) else None
+    backlog = int((~np.isin(questions[submitted], first_ids)).sum())
+
+    recent_replies = replies & (times >= now - window)
+    actors, counts = np.unique(events["actor"][recent_replies], return_counts=True)
+    top = np.argsort(-counts, kind="stable")
+    responders = [(int(actors[i]), int(counts[i])) for i in top]
+
+    today = np.floor((now + utc_offset) / DAY)
+    day = np.floor((times[submitted] + utc_offset) / DAY)
+    age = (today - day).astype(np.int64)
+    daily = np.bincount(age[(age >= 0) & (age < days)], minlength=days)[::-1]
+
+    return Stats(
+      questions=int(recent.sum()),
+      replied=int(answered.sum()),
+      backlog=backlog,
+      reply_time=reply_time,
+      responders=responders,
+      daily=[int(n) for n in daily],
+    )
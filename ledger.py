@@ -0,0 +1,187 @@
+import logging
+import re
+import sqlite3
+import time
+from typing import Any, Dict, NamedTuple, Optional, Tuple
+
+from persistence import rewrite_bot_data
+
+logger = logging.getLogger(__name__)
+
+
+class QuestionRecord(NamedTuple):
+  """A question in the research group that has been replied to."""
+  chat_id: int
+  message_id: int
+  template: str
+  answered_at: float
+
+
+class ReplyRecord(NamedTuple):
+  """A reply that was sent back to an asker."""
+  chat_id: int
+  message_id: int
+  header: str
+  template: str
+  replied_at: float
+
+
+ReplyKey = Tuple[int, int]
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS questions (message_id INTEGER PRIMARY KEY, chat_id INTEGER NOT NULL, template TEXT NOT NULL, answered_at REAL NOT NULL);
+CREATE TABLE IF NOT EXISTS replies (user_id INTEGER NOT NULL, message_id INTEGER NOT NULL, chat_id INTEGER NOT NULL, header TEXT NOT NULL, template TEXT NOT NULL, replied_at REAL NOT NULL, PRIMARY KEY (user_id, message_id));
+"""
+
+
+class LedgerArchive:
+  """Cold storage for ledger records that were evicted from ``bot_data``.
+
+  The file is only opened the first time an archived record is written or
+  looked up, so a bot that never touches old questions never pays for it.
+  """
+
+  def __init__(self, filepath: str):
+    self.filepath = filepath
+    self._conn: Optional[sqlite3.Connection] = None
+
+  @property
+  def conn(self) -> sqlite3.Connection:
+    if self._conn is None:
+      self._conn = sqlite3.connect(self.filepath)
+      self._conn.execute("PRAGMA journal_mode = WAL")
+      self._conn.executescript(_SCHEMA)
+    return self._conn
+
+  def add_questions(self, records: Dict[int, QuestionRecord]) -> None:
+    with self.conn:
+      self.conn.executemany(
+        "INSERT OR REPLACE INTO questions (message_id, chat_id, template, answered_at) VALUES (?, ?, ?, ?)",
+        [(r.message_id, r.chat_id, r.template, r.answered_at) for r in records.values()]
+      )
+
+  def add_replies(self, records: Dict[ReplyKey, ReplyRecord]) -> None:
+    with self.conn:
+      self.conn.executemany(
+        "INSERT OR REPLACE INTO replies (user_id, message_id, chat_id, header, template, replied_at) VALUES (?, ?, ?, ?, ?, ?)",
+        [(user_id, r.message_id, r.chat_id, r.header, r.template, r.replied_at) for (user_id, _), r in records.items()]
+      )
+
+  def get_question(self, message_id: int) -> Optional[QuestionRecord]:
+    row = self.conn.execute(
+      "SELECT chat_id, message_id, template, answered_at FROM questions WHERE message_id = ?", (message_id,)
+    ).fetchone()
+    return None if row is None else QuestionRecord(*row)
+
+  def get_reply(self, user_id: int, message_id: int) -> Optional[ReplyRecord]:
+    row = self.conn.execute(
+      "SELECT chat_id, message_id, header, template, replied_at FROM replies WHERE user_id = ? AND message_id = ?",
+      (user_id, message_id)
+    ).fetchone()
+    return None if row is None else ReplyRecord(*row)
+
+  def close(self) -> None:
+    if self._conn is not None:
+      self._conn.close()
+      self._conn = None
+
+
+def get_question(bot_data: Dict[str, Any], archive: LedgerArchive, message_id: int) -> Optional[QuestionRecord]:
+  record = bot_data.get("answered_questions", {}).get(message_id)
+  if record is None:
+    record = archive.get_question(message_id)
+  return record
+
+
+def get_reply(bot_data: Dict[str, Any], archive: LedgerArchive, user_id: int, message_id: int) -> Optional[ReplyRecord]:
+  record = bot_data.get("replies", {}).get((user_id, message_id))
+  if record is None:
+    record = archive.get_reply(user_id, message_id)
+  return record
+
+
+def _evict(records: Dict[Any, Any], max_entries: int, max_age: float) -> Dict[Any, Any]:
+  # both record types end with their timestamp
+  cutoff = time.time() - max_age
+  by_age = sorted(records.items(), key=lambda item: item[1][-1])
+  overflow = max(len(records) - max_entries, 0)
+  return {
+    key: record for i, (key, record) in enumerate(by_age)
+    if i < overflow or record[-1] < cutoff
+  }
+
+
+def archive_old_entries(bot_data: Dict[str, Any], archive: LedgerArchive, max_entries: int, max_age: float) -> int:
+  """Moves records older than ``max_age`` seconds, or beyond the newest
+  ``max_entries``, out of ``bot_data`` and into the archive."""
+  questions = bot_data.get("answered_questions", {})
+  replies = bot_data.get("replies", {})
+
+  old_questions = _evict(questions, max_entries, max_age)
+  old_replies = _evict(replies, max_entries, max_age)
+  if old_questions:
+    archive.add_questions(old_questions)
+    for key in old_questions:
+      del questions[key]
+  if old_replies:
+    archive.add_replies(old_replies)
+    for key in old_replies:
+      del replies[key]
+  return len(old_questions) + len(old_replies)
+
+
+def convert_legacy_entries(bot_data: Dict[str, Any]) -> int:
+  """Rewrites ledger entries that still hold whole ``telegram.Message`` objects
+  (as stored before the ledger existed) into slim records."""
+  converted = 0
+  questions = bot_data.get("answered_questions", {})
+  for message_id, entry in list(questions.items()):
+    if isinstance(entry, list):
+      message, template = entry
+      date = message.edit_date or message.date
+      questions[message_id] = QuestionRecord(message.chat_id, message.message_id, template, date.timestamp())
+      converted += 1
+
+  replies = bot_data.get("replies", {})
+  for user_id, entry in list(replies.items()):
+    if isinstance(entry, dict):
+      del replies[user_id]
+      for message_id, (message, header, template) in entry.items():
+        date = message.edit_date or message.date
+        replies[(user_id, message_id)] = ReplyRecord(message.chat_id, message.message_id, header, template, date.timestamp())
+        converted += 1
+  return converted
+
+
+# the bot_data keys of the ledger
+LEDGER_KEYS = frozenset({"answered_questions", "replies"})
+
+
+def move_to_archive(bot_data: Dict[str, Any], archive: LedgerArchive) -> int:
+  """Moves the whole ledger out of ``bot_data`` and into the archive, so
+  that loading ``bot_data`` no longer grows with the number of questions
+  answered. Returns the number of records moved."""
+  convert_legacy_entries(bot_data)
+  moved = archive_old_entries(bot_data, archive, 0, 0)
+  for key in LEDGER_KEYS:
+    bot_data.pop(key, None)
+  return moved
+
+
+def compact_state(state_path: str, archive: LedgerArchive) -> int:
+  """Moves the ledger out of a ``SQLitePersistence`` file that no bot is
+  running on, see ``move_to_archive``."""
+  return rewrite_bot_data(state_path, lambda bot_data: move_to_archive(bot_data, archive))
+
+
+_LEGACY_QUESTION = re.compile(r"^(?:\[\w+(?:-\w+)?\]\n)*#(\d+), [^\n]*\n\nQuestion by (.*?):\n\n(.*)$", re.DOTALL)
+
+
+def parse_legacy_question(text: str) -> Optional[Tuple[int, str, str]]:
+  """Number, asker and question of a group message posted before questions
+  were stored by number. The text of a replied question still ends with
+  the reply, see ``QuestionRecord.template`` for where it starts."""
+  match = _LEGACY_QUESTION.match(text)
+  if match is None:
+    return None
+  return int(match.group(1)), match.group(2), match.group(3).strip()
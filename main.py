@@ -1,15 +1,37 @@
 from datetime import datetime
 import pytz
 import asyncio
+import time
 
 import os
-from telegram.ext import (Application, CommandHandler, ExtBot, MessageHandler, filters, ConversationHandler, TypeHandler, CallbackQueryHandler, ContextTypes, CallbackContext, PicklePersistence)
+import sys
+from telegram.ext import (Application, CommandHandler, ExtBot, MessageHandler, filters, ConversationHandler, TypeHandler, CallbackQueryHandler, ContextTypes, CallbackContext)
 from telegram import (ReplyKeyboardMarkup, ReplyKeyboardRemove,InlineKeyboardButton, InlineKeyboardMarkup, Update)
 import logging
 from collections import defaultdict
-from typing import DefaultDict, Optional, Set
-from telegram.constants import ParseMode
+from typing import DefaultDict, List, Optional, Set
+from telegram.constants import ChatType, MessageLimit, ParseMode
+from telegram.error import TelegramError
 import random
+from textwrap import shorten
+from html import escape
+
+from persistence import SQLitePersistence, bot_data_keys, migrate_pickle
+from cleanup import MessageCleaner
+from ratelimiter import PriorityRateLimiter
+from concurrency import PerUserApplication, SharedStateApplication
+from search import QuestionIndex
+from wix import NumberedWixQuestion, WixInbox
+from metrics import InstrumentedRequest, Metrics
+from media import MEDIA, message_attachment, send_attachments
+import events
+from events import EventLog
+from backlog import PendingQuestions, Responder
+from routing import Router, load_routes
+from broadcast import Broadcaster, BroadcastReport
+from spool import SpoolQueue, UpdateSpool
+from ledger import (LEDGER_KEYS, LedgerArchive, compact_state, get_question, get_reply, parse_legacy_question)
+from questions import Question, QuestionStore, Reply
 
 
 logging.basicConfig(
@@ -21,20 +43,330 @@ logger = logging.getLogger(__name__)
 
 TOKEN = os.environ['telegram_API_key']
 PORT = int(os.environ.get('PORT', 8443))
+WEBHOOK_URL = f"https://lkcresearchtest2-matthiasliew.koyeb.app/{TOKEN}"
+
+PICKLE_FILE = "conversationbot"
+STATE_FILE = "conversationbot.sqlite3"
+ARCHIVE_FILE = "conversationbot_archive.sqlite3"
+EVENTS_FILE = "conversationbot_events.v2.bin"
+# events from before they recorded the chat of the question
+LEGACY_EVENTS_FILE = "conversationbot_events.bin"
+
+# replies from before questions were stored by number, opened on the first lookup
+ledger_archive = LedgerArchive(ARCHIVE_FILE)
+message_cleaner = MessageCleaner()
+event_log = EventLog(EVENTS_FILE)
+pending_questions = PendingQuestions(STATE_FILE)
+question_store = QuestionStore(STATE_FILE)
+broadcaster = Broadcaster(STATE_FILE, concurrency = 30)
+update_spool = UpdateSpool(STATE_FILE)
+
+# questions from the website form, posted to the group as digests
+WIX_API_KEY = os.environ.get('wix_API_key')
+WIX_DIGEST_INTERVAL = 15
+# stays under Telegram's 4096 character limit per message
+WIX_DIGEST_LENGTH = 4000
+
+wix_inbox = WixInbox(STATE_FILE)
+
+# answered questions like the one being asked, shown before it is confirmed
+SIMILAR_LOOKUP_TIMEOUT = 0.2
+SIMILAR_PREVIEW_LENGTH = 300
 
 research_chat_id = -1001856093938
 testing_group_id = -829275448
 
+# questions answered before routing were all in research_chat_id
+question_index = QuestionIndex(STATE_FILE, research_chat_id)
+
+# questions mentioning a committee group's keywords are posted there instead of research_chat_id
+ROUTING_FILE = os.environ.get('routing_rules_file', "routing.json")
+router = Router(load_routes(ROUTING_FILE), research_chat_id)
+COMMITTEE_CHATS = [*router.chat_ids, testing_group_id]
+
+# an assigned question nobody has started replying to moves to the next responder after this long
+ASSIGNMENT_TIMEOUT = 4 * 60 * 60
+ASSIGNMENT_CHECK_INTERVAL = 5 * 60
+
 sgTz = pytz.timezone("Asia/Singapore") 
 
 TYPING_REPLY, CONFIRM_MESSAGE,  = range(2)
 
+STATS_WINDOW_DAYS = 30
+STATS_DAILY_DAYS = 7
+STATS_TOP_RESPONDERS = 5
+
+PENDING_PAGE_SIZE = 5
+PENDING_PREVIEW_LENGTH = 200
+# committee is reminded of questions left unanswered this long, once per PENDING_REMIND_EVERY
+PENDING_REMIND_AFTER = 2 * 24 * 60 * 60
+PENDING_REMIND_EVERY = 24 * 60 * 60
+PENDING_REMIND_CHECK_INTERVAL = 60 * 60
+PENDING_REMIND_MAX_LISTED = 30
+
+# how often to look for broadcasts left unfinished by a restart
+BROADCAST_RESUME_INTERVAL = 60
+
+# handled updates are remembered as long as Telegram may deliver them again
+SPOOL_RETENTION = 24 * 60 * 60
+# with several workers, the updates of a worker that has not checked in for this long are replayed
+SPOOL_REPLAY_AFTER = 5 * 60
+SPOOL_CHECK_INTERVAL = 60
+
+# questions and replies left unfinished for this long are ended and their messages deleted
+QUESTION_IDLE_TIMEOUT = 60 * 60
+REPLY_IDLE_TIMEOUT = 6 * 60 * 60
+JANITOR_INTERVAL = 5 * 60
+JANITOR_MAX_USERS = 100
+
+# what the new_question and new_reply conversations keep in user_data
+QUESTION_STATE_KEYS = (
+  "question_info", "question_to_delete", "question", "question_media", "question_media_group",
+  "follow_up_to", "question_active_at",
+  # from before questions were stored by number
+  "follow_up_info", "last_replied_question",
+)
+REPLY_STATE_KEYS = (
+  "reply_to", "reply_msg", "reply_media", "reply_media_group", "curr_convo", "reply_to_delete",
+  "in_reply_conversation", "reply_active_at",
+  # from before questions were stored by number
+  "reply_info",
+)
+
+# stands in for the text of a question or reply sent as a photo or document without a caption
+NO_CAPTION = "(see attachment)"
+
+metrics = Metrics({TYPING_REPLY: "TYPING_REPLY", CONFIRM_MESSAGE: "CONFIRM_MESSAGE"})
+
+CONCURRENT_UPDATES = 64
+# PTB's default for the bot's own requests
+CONNECTION_POOL_SIZE = 256
+
+async def next_number(context: ContextTypes.DEFAULT_TYPE, key):
+  async with context.application.bot_data_lock(key):
+    context.bot_data[key] = context.bot_data.get(key, 0) + 1
+    return context.bot_data[key]
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
   await update.message.reply_text(
       "Hi! The LKC Medicine Research Bot is ready to serve!\n\n"
       "Send /help for more info on the available commands and resources."
   )
 
+async def search(update: Update, context: ContextTypes.DEFAULT_TYPE):
+  query = " ".join(context.args)
+  if not query:
+    await update.message.reply_text(
+      "Send /search followed by a few words from your question, e.g. /search research funding"
+    )
+    return
+
+  results = await question_index.search(query)
+  if not results:
+    await update.message.reply_text(
+      "No answered questions matched your search. Send /ask_question to ask the LKC Research Committee!"
+    )
+    return
+
+  answers = "\n\n".join(f"<b>Q:</b> {result.question}\n<b>A:</b> {result.reply}" for result in results)
+  await update.message.reply_text(
+    "Here is what the LKC Research Committee has answered before:\n\n" + answers, parse_mode=ParseMode.HTML
+  )
+
+def format_duration(seconds: float) -> str:
+  if seconds < 60 * 60:
+    return f"{seconds / 60:.0f} min"
+  if seconds < 24 * 60 * 60:
+    return f"{seconds / 3600:.1f} h"
+  return f"{seconds / 86400:.1f} days"
+
+async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+  utc_offset = datetime.now(sgTz).utcoffset().total_seconds()
+  result = await asyncio.get_running_loop().run_in_executor(
+    None, lambda: event_log.stats(window = STATS_WINDOW_DAYS * events.DAY, days = STATS_DAILY_DAYS, utc_offset = utc_offset)
+  )
+
+  if result.reply_time is None:
+    reply_time = "no replies yet"
+  else:
+    reply_time = " / ".join(format_duration(seconds) for seconds in result.reply_time)
+
+  responders = []
+  for user_id, count in result.responders[:STATS_TOP_RESPONDERS]:
+    try:
+      member = await context.bot.get_chat_member(update.effective_chat.id, user_id)
+      name = member.user.full_name
+    except TelegramError:
+      name = str(user_id)
+    responders.append(f"{name}: {count}")
+
+  await update.message.reply_text(
+    f"Last {STATS_WINDOW_DAYS} days: {result.questions} questions, {result.replied} replied\n"
+    f"Time to first reply (median / 90% / 99%): {reply_time}\n"
+    f"Unanswered questions: {result.backlog}\n\n"
+    "Replies by committee member:\n" + ("\n".join(responders) or "none") + "\n\n"
+    f"Questions per day, last {STATS_DAILY_DAYS} days: " + ", ".join(str(n) for n in result.daily)
+  )
+
+def message_link(chat_id: int, message_id: int) -> Optional[str]:
+  """Link to a message in a supergroup, None for other chats."""
+  chat = str(chat_id)
+  if not chat.startswith("-100"):
+    return None
+  return f"https://t.me/c/{chat[4:]}/{message_id}"
+
+async def pending_page(cursor = None, forward: bool = True):
+  count = await pending_questions.count()
+  questions, has_previous, has_next = await pending_questions.page(cursor, PENDING_PAGE_SIZE, forward)
+  if not questions:
+    return "No unanswered questions!", None
+
+  now = time.time()
+  entries = []
+  keyboard = []
+  for question in questions:
+    claimed = " · being answered" if question.claimed_by else ""
+    entries.append(f"#{question.number} · waiting {format_duration(now - question.submitted_at)}{claimed}\n{question.preview}")
+    link = message_link(question.chat_id, question.message_id)
+    if link is not None:
+      keyboard.append([InlineKeyboardButton(f"Reply to #{question.number}", url = link)])
+
+  navigation = []
+  if has_previous:
+    first = questions[0].cursor
+    navigation.append(InlineKeyboardButton("« Older", callback_data = f"pending prev {first[0]!r} {first[1]}"))
+  if has_next:
+    last = questions[-1].cursor
+    navigation.append(InlineKeyboardButton("Newer »", callback_data = f"pending next {last[0]!r} {last[1]}"))
+  if navigation:
+    keyboard.append(navigation)
+
+  text = f"{count} unanswered questions, oldest first:\n\n" + "\n\n".join(entries)
+  return text, InlineKeyboardMarkup(keyboard) if keyboard else None
+
+async def pending(update: Update, context: ContextTypes.DEFAULT_TYPE):
+  text, reply_markup = await pending_page()
+  await update.message.reply_text(text, reply_markup = reply_markup)
+
+async def pending_navigate(update: Update, context: ContextTypes.DEFAULT_TYPE):
+  await update.callback_query.answer()
+  _, direction, submitted_at, number = update.callback_query.data.split()
+  text, reply_markup = await pending_page((float(submitted_at), int(number)), forward = direction == "next")
+  await update.callback_query.edit_message_text(text, reply_markup = reply_markup)
+
+async def remind_pending(context: ContextTypes.DEFAULT_TYPE):
+  if not context.application.is_primary:
+    return
+  due = await pending_questions.due_reminders(PENDING_REMIND_AFTER, PENDING_REMIND_EVERY)
+  by_chat = defaultdict(list)
+  for question in due:
+    by_chat[question.chat_id].append(question)
+
+  now = time.time()
+  for chat_id, questions in by_chat.items():
+    entries = []
+    for question in questions[:PENDING_REMIND_MAX_LISTED]:
+      label = f"#{question.number}"
+      link = message_link(chat_id, question.message_id)
+      if link is not None:
+        label = f'<a href="{link}">{label}</a>'
+      entries.append(f"{label}, waiting {format_duration(now - question.submitted_at)}")
+    if len(questions) > PENDING_REMIND_MAX_LISTED:
+      entries.append(f"and {len(questions) - PENDING_REMIND_MAX_LISTED} more, see /pending")
+    try:
+      await context.bot.send_message(
+        chat_id, "Reminder! These questions are still waiting for a reply:\n\n" + "\n".join(entries),
+        parse_mode = ParseMode.HTML
+      )
+    except TelegramError as exc:
+      logger.warning("Could not send the pending questions reminder to %s: %s", chat_id, exc)
+
+async def track_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
+  if update.effective_user is not None and update.effective_chat is not None and update.effective_chat.type == ChatType.PRIVATE:
+    await broadcaster.remember([update.effective_user.id])
+
+async def broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
+  parts = update.message.text.split(None, 1)
+  if len(parts) < 2:
+    await update.message.reply_text("Send /broadcast followed by the announcement to send to every user of the bot.")
+    return
+  text = parts[1]
+  if len(text) > MessageLimit.TEXT_LENGTH:
+    await update.message.reply_text(f"The announcement is too long, Telegram allows up to {MessageLimit.TEXT_LENGTH} characters.")
+    return
+
+  broadcast_id = await broadcaster.create(text, update.effective_chat.id, update.effective_user.id)
+  recipients = await broadcaster.recipient_count()
+  keyboard = [[
+    InlineKeyboardButton("Send", callback_data = f"broadcast send {broadcast_id}"),
+    InlineKeyboardButton("Cancel", callback_data = f"broadcast cancel {broadcast_id}"),
+  ]]
+  await update.message.reply_text(
+    f"Send this announcement to {recipients} users?\n\n{text}", reply_markup = InlineKeyboardMarkup(keyboard)
+  )
+
+async def report_broadcast(bot: ExtBot, report: BroadcastReport):
+  try:
+    await bot.send_message(
+      report.chat_id,
+      f"Announcement sent in {format_duration(report.seconds)}: {report.sent} delivered, "
+      f"{report.blocked} users have blocked the bot and were removed, {report.failed} failed."
+    )
+  except TelegramError as exc:
+    logger.warning("Could not report broadcast %s: %s", report.broadcast_id, exc)
+
+async def broadcast_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE):
+  query = update.callback_query
+  await query.answer()
+  if update.effective_chat.id not in COMMITTEE_CHATS:
+    return
+  _, action, broadcast_id = query.data.split()
+  if action == "cancel":
+    if await broadcaster.discard(int(broadcast_id)):
+      await query.edit_message_text("Announcement cancelled.")
+    return
+  if await broadcaster.start(context.application, int(broadcast_id), lambda report: report_broadcast(context.bot, report)):
+    await query.edit_message_text("Sending the announcement. I will report here when it is done.")
+
+async def resume_broadcasts(context: ContextTypes.DEFAULT_TYPE):
+  if not context.application.is_primary:
+    return
+  resumed = await broadcaster.resume(context.application, lambda report: report_broadcast(context.bot, report))
+  if resumed:
+    logger.info("Resumed %s unfinished broadcasts.", resumed)
+
+async def available(update: Update, context: ContextTypes.DEFAULT_TYPE):
+  user = update.effective_user
+  await pending_questions.set_available(update.effective_chat.id, user.id, user.full_name, True)
+  await update.message.reply_text(
+    f"Thanks {user.first_name}! New questions in this group will be assigned to you. Send /away to stop."
+  )
+
+async def away(update: Update, context: ContextTypes.DEFAULT_TYPE):
+  user = update.effective_user
+  await pending_questions.set_available(update.effective_chat.id, user.id, user.full_name, False)
+  await update.message.reply_text(
+    "Ok! No more questions will be assigned to you here, and the ones you have not started on will go to someone else. "
+    "Send /available when you are back."
+  )
+
+async def announce_assignment(bot: ExtBot, chat_id: int, message_id: int, responder: Responder):
+  try:
+    await bot.send_message(
+      chat_id,
+      f'Assigned to <a href="tg://user?id={responder.user_id}">{escape(responder.name)}</a>. '
+      f"It goes to the next available member if nobody has started on it within {format_duration(ASSIGNMENT_TIMEOUT)}.",
+      parse_mode = ParseMode.HTML, reply_to_message_id = message_id
+    )
+  except TelegramError as exc:
+    logger.warning("Could not announce the assignment of %s: %s", message_id, exc)
+
+async def reassign_questions(context: ContextTypes.DEFAULT_TYPE):
+  if not context.application.is_primary:
+    return
+  for question, responder in await pending_questions.reassign(ASSIGNMENT_TIMEOUT):
+    await announce_assignment(context.bot, question.chat_id, question.message_id, responder)
+
 async def ask_question(update, context: ContextTypes.DEFAULT_TYPE):
   reply = await update.message.reply_text(
       "Ok! Fire away! Questions will be sent to the LKC Research Committee and they will get back to you shortly\n\n"
@@ -42,6 +374,7 @@ async def ask_question(update, context: ContextTypes.DEFAULT_TYPE):
   )
   
   context.user_data["question_info"] = [reply.id, reply.chat.id]
+  context.user_data["question_active_at"] = time.time()
   context.user_data["question_to_delete"] = {reply.id: reply.chat.id}
 
   return TYPING_REPLY
@@ -52,17 +385,35 @@ async def confirm_question(update: Update, context: ContextTypes.DEFAULT_TYPE):
      InlineKeyboardButton("Edit", callback_data="edit")]
   ]
 
-  msg = update.message.text
+  msg = update.message.text or update.message.caption or NO_CAPTION
   context.user_data["question"] = msg
   context.user_data["question_to_delete"][update.message.id] = update.message.chat.id
+  attachment = message_attachment(update.message)
+  if attachment is not None:
+    # replaces what was attached before an edit, a retyped text keeps it;
+    # its caption is the question itself
+    context.user_data["question_media"] = [attachment[:2] + (None,)]
+    context.user_data["question_media_group"] = update.message.media_group_id
+  attached = "\n\n(with attachments)" if context.user_data.get("question_media") else ""
 
   question_info = context.user_data["question_info"]
   question_message_id = question_info[0]
   question_chat_id = question_info[1]
+
+  try:
+    similar = await asyncio.wait_for(question_index.similar(msg), SIMILAR_LOOKUP_TIMEOUT)
+  except asyncio.TimeoutError:
+    similar = []
+  answered_before = "".join(
+    f"\n\nQ: {shorten(result.question, SIMILAR_PREVIEW_LENGTH)}\nA: {shorten(result.reply, SIMILAR_PREVIEW_LENGTH)}"
+    for result in similar
+  )
+  if answered_before:
+    answered_before = "\n\nSimilar questions that have been answered before:" + answered_before
   
   await context.bot.edit_message_text(
       "Got it! Just to confirm, is this the question that you want to ask?\n\n"
-      f"{msg}", message_id = question_message_id, chat_id = question_chat_id,
+      f"{msg}{attached}{answered_before}", message_id = question_message_id, chat_id = question_chat_id,
       reply_markup=InlineKeyboardMarkup(
           reply_keyboard, one_time_keyboard=True
       )
@@ -70,16 +421,21 @@ async def confirm_question(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
   return CONFIRM_MESSAGE
 
+async def add_question_media(update: Update, context: ContextTypes.DEFAULT_TYPE):
+  """Collects the rest of an album, which arrives as one message per file."""
+  media_group_id = update.message.media_group_id
+  if media_group_id is None or media_group_id != context.user_data.get("question_media_group"):
+    return None
+  context.user_data["question_media"].append(message_attachment(update.message))
+  context.user_data["question_to_delete"][update.message.id] = update.message.chat.id
+  return None
+
 async def confirmed_question(update: Update, context: ContextTypes.DEFAULT_TYPE):
   await update.callback_query.answer()
   
   await update.callback_query.edit_message_text("Ok! Submitting question to the LKC Research Committee...")
 
-  if not "no_of_questions" in context.bot_data:
-      context.bot_data["no_of_questions"] = 0
-  
-  context.bot_data["no_of_questions"] += 1
-  no_of_questions = context.bot_data["no_of_questions"]
+  no_of_questions = await next_number(context, "no_of_questions")
   
   msg = context.user_data["question"]
   del context.user_data["question"]
@@ -100,31 +456,52 @@ Question by {first_name} {last_name}, @{username}:
 {msg}
   """
   reply_keyboard = [
-    [InlineKeyboardButton("Reply", callback_data=f"reply {user_id}")]
+    [InlineKeyboardButton("Reply", callback_data=f"reply #{no_of_questions}")]
   ]
 
-  if "follow_up_info" in context.user_data:
+  media = context.user_data.pop("question_media", [])
+  context.user_data.pop("question_media_group", None)
+  # a follow-up brings along the files of the question it follows up on
+  attached_before = ()
+  follow_up_of = None
+  if "follow_up_to" in context.user_data:
     to_send = "[FOLLOW-UP]\n" + to_send
-    last_message = context.user_data["last_replied_question"]
-    await last_message.reply_text(to_send, reply_markup=InlineKeyboardMarkup(
+    last_chat_id, last_message_id, follow_up_of = context.user_data.pop("follow_up_to")[:3]
+    earlier = None if follow_up_of is None else await question_store.get(follow_up_of)
+    if earlier is not None:
+      attached_before = earlier.attachments
+    sent = await context.bot.send_message(last_chat_id, to_send, reply_to_message_id=last_message_id, reply_markup=InlineKeyboardMarkup(
           reply_keyboard, one_time_keyboard=True
     ))
-    del context.user_data["last_replied_question"]
-    del context.user_data["follow_up_info"]
+    event_log.append(events.FOLLOW_UP, sent.chat_id, sent.message_id, user_id)
+    await pending_questions.add(sent.message_id, sent.chat_id, no_of_questions, user_id, shorten(msg, PENDING_PREVIEW_LENGTH))
   else:
-    await context.bot.send_message(research_chat_id, to_send, reply_markup=InlineKeyboardMarkup(
+    sent = await context.bot.send_message(router.chat_for(msg), to_send, reply_markup=InlineKeyboardMarkup(
           reply_keyboard, one_time_keyboard=True
       )
     )
+    event_log.append(events.SUBMITTED, sent.chat_id, sent.message_id, user_id)
+    await pending_questions.add(sent.message_id, sent.chat_id, no_of_questions, user_id, shorten(msg, PENDING_PREVIEW_LENGTH))
+  await question_store.add(Question(
+    no_of_questions, user_id, f"{first_name} {last_name}, @{username}", msg, date.timestamp(),
+    sent.chat_id, sent.message_id, sent.text, follow_up_of, attachments = tuple(media)
+  ))
+
+  if attached_before or media:
+    await send_attachments(context.bot, sent.chat_id, [*attached_before, *media], reply_to_message_id = sent.message_id)
+
+  responder = await pending_questions.assign(no_of_questions, sent.chat_id)
+  if responder is not None:
+    await announce_assignment(context.bot, sent.chat_id, sent.message_id, responder)
 
   await update.callback_query.message.reply_text(
       "Question successfully submitted!"
   )
   
-  for key, val in context.user_data["question_to_delete"].items():
-    await delete_message(chat_id = val, message_id = key, time = 0, context = context)
+  message_cleaner.schedule_many(context.user_data["question_to_delete"])
   del context.user_data["question_to_delete"]
   del context.user_data["question_info"]
+  context.user_data.pop("question_active_at", None)
 
   return ConversationHandler.END
 
@@ -143,9 +520,10 @@ async def cancel_question(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
   user = update.message.from_user
   try:
     context.user_data["question_to_delete"][update.message.id] = update.message.chat.id
-  except:
-    pass
+  except Exception:
+    metrics.suppressed("cancel_question")
   logger.info("User %s canceled the conversation.", user.first_name)
+  event_log.append(events.QUESTION_CANCELLED, 0, 0, user.id)
   cancel_message = await update.message.reply_text(
       "Cancelled. Feel free to continue browsing!")
 
@@ -154,47 +532,95 @@ async def cancel_question(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
   question_chat_id = question_info[1]
    
   try:
-    if "follow_up_info" in context.user_data:
-      follow_up_info = context.user_data["follow_up_info"]
-      reply_keyboard = reply_keyboard = [
-        [InlineKeyboardButton("Ask Follow-Up Question", callback_data=f"follow_up {follow_up_info[2]}")]
-      ]
-      await context.bot.edit_message_text(
-        follow_up_info[3], message_id = follow_up_info[0], chat_id = follow_up_info[1],
-        reply_markup=InlineKeyboardMarkup(
-            reply_keyboard, one_time_keyboard=True
-        )
-      )
+    if "follow_up_to" in context.user_data:
+      await restore_follow_up_button(context.bot, context.user_data["follow_up_to"])
     else:
       await context.bot.edit_message_text(
         "Cancelled.", message_id = question_message_id, chat_id = question_chat_id
       )
       
-    for key, val in context.user_data["question_to_delete"].items():
-      await delete_message(chat_id = val, message_id = key, time = 0, context = context)
+    message_cleaner.schedule_many(context.user_data["question_to_delete"])
     del context.user_data["question_to_delete"]
     del context.user_data["question_info"]
-    del context.user_data["follow_up_info"]
-  except:
-    pass
+    context.user_data.pop("question_active_at", None)
+    context.user_data.pop("question_media", None)
+    context.user_data.pop("question_media_group", None)
+    context.user_data.pop("follow_up_to", None)
+  except Exception:
+    metrics.suppressed("cancel_question")
 
-  await delete_message(cancel_message.chat.id, cancel_message.id, 1.5, context)
+  message_cleaner.schedule(cancel_message.chat.id, cancel_message.id, delay = 1.5)
 
   return ConversationHandler.END
 
+async def restore_follow_up_button(bot: ExtBot, follow_up_to) -> None:
+  button_chat_id, button_message_id, callback_data = follow_up_to[3:]
+  reply_keyboard = [
+    [InlineKeyboardButton("Ask Follow-Up Question", callback_data=callback_data)]
+  ]
+  await bot.edit_message_reply_markup(
+    chat_id = button_chat_id, message_id = button_message_id, reply_markup=InlineKeyboardMarkup(reply_keyboard)
+  )
+
 async def follow_up_question(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
   await update.callback_query.answer()
-  replied_question_id = int(update.callback_query.data.split()[1])
-  context.user_data["last_replied_question"] = context.bot_data["answered_questions"][replied_question_id][0]
+  replied_question_id = update.callback_query.data.split()[1]
+  if replied_question_id.startswith("#"):
+    replied_question = await question_store.get(int(replied_question_id[1:]))
+    if replied_question is None:
+      await update.callback_query.message.reply_text("This question could not be found.")
+      return ConversationHandler.END
+    question_ref = [replied_question.chat_id, replied_question.message_id, replied_question.number]
+  else:
+    # a button from before questions were stored by number, it names the group message
+    replied_question = get_question(context.bot_data, ledger_archive, int(replied_question_id))
+    if replied_question is None:
+      await update.callback_query.message.reply_text("This question could not be found.")
+      return ConversationHandler.END
+    known = await question_store.by_message(replied_question.chat_id, replied_question.message_id)
+    question_ref = [replied_question.chat_id, replied_question.message_id, None if known is None else known.number]
 
-  previous_msg_text = update.callback_query.message.text
-  previous_msg_id = update.callback_query.message.message_id
-  previous_msg_chat_id = update.callback_query.message.chat.id
-  
-  context.user_data["follow_up_info"] = [previous_msg_id, previous_msg_chat_id, replied_question_id, previous_msg_text]
+  previous_message = update.callback_query.message
+  context.user_data["follow_up_to"] = question_ref + [previous_message.chat.id, previous_message.message_id, update.callback_query.data]
 
   return await ask_question(update.callback_query, context)
 
+async def import_legacy_question(context: ContextTypes.DEFAULT_TYPE, query) -> Optional[Question]:
+  """Stores a question whose Reply or Edit Response button was made before
+  questions were stored by number. Those buttons carry the asker and the
+  reply message, the rest is read from the message once."""
+  message = query.message
+  data = query.data.split()
+  parsed = parse_legacy_question(message.text or "")
+  if parsed is None:
+    return None
+  number, asker_name, text = parsed
+  question = Question(
+    number, int(data[1]), asker_name, text, message.date.timestamp(), message.chat.id, message.message_id, message.text
+  )
+  if data[0] == "edit_response":
+    record = get_question(context.bot_data, ledger_archive, message.message_id)
+    reply = get_reply(context.bot_data, ledger_archive, int(data[1]), int(data[2]))
+    if record is None or reply is None:
+      return None
+    question = question._replace(
+      text = reply.template.split("\nQuestion:\n", 1)[-1].rsplit("\n\nReply:", 1)[0],
+      replied_header = record.template, reply_chat_id = reply.chat_id, reply_message_id = reply.message_id,
+      reply_header = reply.header, reply_template = reply.template
+    )
+  await question_store.add(question)
+  return await question_store.by_message(message.chat.id, message.message_id)
+
+async def resolve_question(context: ContextTypes.DEFAULT_TYPE, query) -> Optional[Question]:
+  """The question a Reply or Edit Response button is on."""
+  data = query.data.split()
+  if data[1].startswith("#"):
+    return await question_store.get(int(data[1][1:]))
+  question = await question_store.by_message(query.message.chat.id, query.message.message_id)
+  if question is None:
+    question = await import_legacy_question(context, query)
+  return question
+
 async def reply_question(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
   await update.callback_query.answer()
 
@@ -204,15 +630,40 @@ async def reply_question(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
       await chat.send_message("You cannot reply to this message until you have replied to the message that you previously wished to reply to. Otherwise send /cancel to cancel the reply to the previous asker and then press the reply button on this message again.")
       return ConversationHandler.END
 
+  question = await resolve_question(context, update.callback_query)
+  if question is None:
+    await update.callback_query.message.chat.send_message("This question could not be found.")
+    return ConversationHandler.END
+
+  replier_id = update.callback_query.from_user.id
+  assignee = await pending_questions.assignee(question.number)
+  if assignee is not None and assignee != replier_id:
+    await update.callback_query.message.chat.send_message(
+      "This question is assigned to someone else. It will go to the next available member "
+      f"if they have not started on it within {format_duration(ASSIGNMENT_TIMEOUT)}."
+    )
+    return ConversationHandler.END
+  # serialises committee members pressing "Reply" on the same question
+  async with context.application.bot_data_lock("question_claims", question.number):
+    question_claims = context.bot_data.setdefault("question_claims", {})
+    if question_claims.get(question.number, replier_id) != replier_id:
+      await update.callback_query.message.chat.send_message("Someone else is already replying to this question.")
+      return ConversationHandler.END
+    question_claims[question.number] = replier_id
+    await update.callback_query.message.edit_reply_markup()
+  await pending_questions.claim(question.number, replier_id)
+
   context.user_data['in_reply_conversation'] = True
   
-  user_to_reply = int(update.callback_query.data.split()[1])
-  previous_msg_text = update.callback_query.message.text
-  previous_msg_id = update.callback_query.message.id
-  previous_msg_chat_id = update.callback_query.message.chat.id
-
-  context.user_data["reply_info"] = [user_to_reply, previous_msg_text, previous_msg_id, previous_msg_chat_id]
+  editing = update.callback_query.data.split()[0] == "edit_response"
+  context.user_data["reply_to"] = [question.number, question.chat_id, question.message_id, editing]
+  context.user_data["reply_active_at"] = time.time()
   context.user_data["reply_to_delete"] = {}
+  if editing:
+    # an edit keeps the files of the reply it replaces unless new ones are sent
+    previous = await question_store.latest_reply(question.number)
+    if previous is not None and previous.attachments:
+      context.user_data["reply_media"] = list(previous.attachments)
   
   new_reply = await update.callback_query.message.reply_text(
       "Alright! Just type down your response and send it!"
@@ -221,11 +672,6 @@ async def reply_question(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
   context.user_data["reply_to_delete"][new_reply.message_id] = new_reply.chat.id
   context.user_data["curr_convo"] = [new_reply.message_id, new_reply.chat.id]
 
-  if update.callback_query.data.split()[0] == "edit_response":
-    context.user_data["reply_info"].append(int(update.callback_query.data.split()[2]))
-
-  await update.callback_query.message.edit_reply_markup()
-  
   return TYPING_REPLY
 
 async def confirm_reply(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -234,9 +680,14 @@ async def confirm_reply(update: Update, context: ContextTypes.DEFAULT_TYPE):
      InlineKeyboardButton("Edit", callback_data="edit")]
   ]
 
-  msg = update.message.text
+  msg = update.message.text or update.message.caption or NO_CAPTION
   context.user_data["reply_msg"] = msg
   context.user_data["reply_to_delete"][update.message.id] = update.message.chat.id
+  attachment = message_attachment(update.message)
+  if attachment is not None:
+    context.user_data["reply_media"] = [attachment[:2] + (None,)]
+    context.user_data["reply_media_group"] = update.message.media_group_id
+  attached = "\n\n(with attachments)" if context.user_data.get("reply_media") else ""
   
   question_info = context.user_data["curr_convo"]
   question_message_id = question_info[0]
@@ -244,7 +695,7 @@ async def confirm_reply(update: Update, context: ContextTypes.DEFAULT_TYPE):
   
   await context.bot.edit_message_text(
       "Got it! Just to confirm, is this the reply that you want to send?\n\n"
-      f"{msg}", message_id = question_message_id, chat_id = question_chat_id,
+      f"{msg}{attached}", message_id = question_message_id, chat_id = question_chat_id,
       reply_markup=InlineKeyboardMarkup(
           reply_keyboard, one_time_keyboard=True
       )
@@ -252,12 +703,22 @@ async def confirm_reply(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
   return CONFIRM_MESSAGE
 
+async def add_reply_media(update: Update, context: ContextTypes.DEFAULT_TYPE):
+  media_group_id = update.message.media_group_id
+  if media_group_id is None or media_group_id != context.user_data.get("reply_media_group"):
+    return None
+  context.user_data["reply_media"].append(message_attachment(update.message))
+  context.user_data["reply_to_delete"][update.message.id] = update.message.chat.id
+  return None
+
 async def confirmed_reply(update: Update, context: ContextTypes.DEFAULT_TYPE):
   await update.callback_query.answer()
   
   await update.callback_query.edit_message_text("Ok! Sending reply back to user...")
 
   msg = context.user_data["reply_msg"]
+  media = context.user_data.pop("reply_media", [])
+  context.user_data.pop("reply_media_group", None)
 
   sender = update.callback_query.from_user
 
@@ -265,86 +726,69 @@ async def confirmed_reply(update: Update, context: ContextTypes.DEFAULT_TYPE):
   last_name = sender.last_name
   username = sender.username
 
-  question_info = context.user_data["reply_info"]
-
-  question_user_id = question_info[0]
-  complete_question_text = question_info[1]
-  question_text = complete_question_text.split("\n\n")[2]
-  question_message_id = question_info[2]
-  question_chat_id = question_info[3]
-
-  to_send_header = f"""
-Reply by {first_name} {last_name}, @{username}:
-"""
-  to_send_template = f"""
-Question:
-{question_text}
-
-Reply:"""
-
-  to_send = to_send_header + to_send_template + f"\n{msg}"
+  number, question_chat_id, question_message_id, editing = context.user_data["reply_to"]
+  question = await question_store.get(number)
+  responder = f"{first_name} {last_name}, @{username}"
 
   reply_keyboard = [
-    [InlineKeyboardButton("Ask Follow-Up Question", callback_data=f"follow_up {question_message_id}")]
+    [InlineKeyboardButton("Ask Follow-Up Question", callback_data=f"follow_up #{number}")]
   ]
-  if len(context.user_data["reply_info"]) > 4:
-    question_user_reply_id = question_info[4]
-    previous_reply = context.bot_data["replies"][question_user_id][question_user_reply_id] 
-    replied = previous_reply[0]
-    to_send_header = previous_reply[1]
-    to_send_template = previous_reply[2]
-    to_send = to_send_header + f"Last Edit by {first_name} {last_name}, @{username}:\n" + to_send_template + f"\n{msg}"
-    replied = await replied.edit_text(to_send, reply_markup=InlineKeyboardMarkup(
+  if editing:
+    to_send = question.reply_header + f"Last Edit by {responder}:\n" + question.reply_template + f"\n{msg}"
+    replied = await context.bot.edit_message_text(to_send, chat_id = question.reply_chat_id, message_id = question.reply_message_id, reply_markup=InlineKeyboardMarkup(
           reply_keyboard, one_time_keyboard=True
       ))
-    await replied.reply_text("This reponse was edited!", quote = True)
+    await context.bot.send_message(replied.chat_id, "This reponse was edited!", reply_to_message_id = replied.message_id)
   else:
-    replied = await context.bot.send_message(question_user_id, to_send, reply_markup=InlineKeyboardMarkup(
+    question = question._replace(
+      reply_header = f"\nReply by {responder}:\n",
+      reply_template = f"\nQuestion:\n{question.text}\n\nReply:"
+    )
+    to_send = question.reply_header + question.reply_template + f"\n{msg}"
+    replied = await context.bot.send_message(question.asker_id, to_send, reply_markup=InlineKeyboardMarkup(
           reply_keyboard, one_time_keyboard=True
       ))
+    question = question._replace(reply_chat_id = replied.chat_id, reply_message_id = replied.message_id)
+
+  if media:
+    await send_attachments(context.bot, replied.chat_id, media, reply_to_message_id = replied.message_id)
 
   await update.callback_query.edit_message_text(
       "Reply successfully submitted!"
   )
 
   date = datetime.now(sgTz)
-  replied_template = f"""[REPLIED]
-{complete_question_text}
-
-Reply by {first_name} {last_name}, @{username} on {date}:
-"""
-  replied_message = replied_template + f"\n{msg}"
-
   edit_keyboard = [
-    [InlineKeyboardButton("Edit Response", callback_data=f"edit_response {question_user_id} {replied.message_id}")]
+    [InlineKeyboardButton("Edit Response", callback_data=f"edit_response #{number}")]
   ]
-  if len(context.user_data["reply_info"]) > 4:
-    replied_template = context.bot_data["answered_questions"][question_message_id][1]
-    replied_message = replied_template + f"Last Edit by {first_name} {last_name}, @{username} on {date}:\n" + f"\n{msg}"
-    
-  message_to_save = await context.bot.edit_message_text(replied_message, message_id = question_message_id, chat_id = question_chat_id, reply_markup=InlineKeyboardMarkup(
+  if editing:
+    replied_message = question.replied_header + f"Last Edit by {responder} on {date}:\n" + f"\n{msg}"
+  else:
+    question = question._replace(replied_header = f"[REPLIED]\n{question.posted_text}\n\nReply by {responder} on {date}:\n")
+    replied_message = question.replied_header + f"\n{msg}"
+
+  await context.bot.edit_message_text(replied_message, message_id = question_message_id, chat_id = question_chat_id, reply_markup=InlineKeyboardMarkup(
           edit_keyboard, one_time_keyboard=True
       ))
-
-  if "answered_questions" not in context.bot_data:
-    context.bot_data["answered_questions"] = {}
-  if "replies" not in context.bot_data:
-    context.bot_data["replies"] = {}
-  if question_user_id not in context.bot_data["replies"]:
-    context.bot_data["replies"][question_user_id] = {}
-  
-  context.bot_data["answered_questions"][question_message_id] = [message_to_save, replied_template]
-  context.bot_data["replies"][question_user_id][replied.message_id] = [replied, to_send_header, to_send_template]
+  if media:
+    # the committee member's own messages are deleted, the group keeps the files this way
+    await send_attachments(context.bot, question_chat_id, media, reply_to_message_id = question_message_id)
+
+  await question_store.add_reply(Reply(number, 0, sender.id, responder, msg, time.time(), tuple(media)), question)
+  await question_index.add(question_chat_id, question_message_id, question.text, msg)
+  event_log.append(events.EDITED if editing else events.REPLIED, question_chat_id, question_message_id, sender.id)
+  await pending_questions.remove(number)
   
   del context.user_data["reply_msg"]
-  del context.user_data["reply_info"]
+  del context.user_data["reply_to"]
   del context.user_data["curr_convo"]
 
-  context.user_data['in_reply_conversation'] = False
+  context.user_data.pop('in_reply_conversation', None)
+  context.bot_data.get("question_claims", {}).pop(number, None)
 
-  for key, val in context.user_data["reply_to_delete"].items():
-    await delete_message(chat_id = val, message_id = key, time = 0, context = context)
+  message_cleaner.schedule_many(context.user_data["reply_to_delete"])
   del context.user_data["reply_to_delete"]
+  context.user_data.pop("reply_active_at", None)
 
   return ConversationHandler.END
 
@@ -358,101 +802,254 @@ async def edit_reply(update: Update, context: ContextTypes.DEFAULT_TYPE):
   return TYPING_REPLY
   
   
+async def restore_reply_button(bot: ExtBot, reply_to) -> None:
+  """Puts back the button that was taken off the question when the reply started."""
+  number, chat_id, message_id, editing = reply_to
+  if editing:
+    reply_keyboard = [
+      [InlineKeyboardButton("Edit Response", callback_data=f"edit_response #{number}")]
+    ]
+  else:
+    reply_keyboard = [
+      [InlineKeyboardButton("Reply", callback_data=f"reply #{number}")]
+    ]
+  await bot.edit_message_reply_markup(chat_id = chat_id, message_id = message_id, reply_markup=InlineKeyboardMarkup(reply_keyboard))
+
 async def cancel_reply(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
   """Cancels and ends the conversation."""
 
   user = update.message.from_user
   context.user_data["reply_to_delete"][update.message.id] = update.message.chat.id
   logger.info("User %s canceled the reply.", user.first_name)
+  event_log.append(events.REPLY_CANCELLED, *context.user_data.get("reply_to", [0, 0, 0])[1:3], user.id)
 
   try:
-    reset_message_info = context.user_data["reply_info"]
-  
-    reset_message_user_id = reset_message_info[0]
-    reset_message_text = reset_message_info[1]
-    reset_message_id = reset_message_info[2]
-    reset_message_chat_id = reset_message_info[3]
-    if len(context.user_data["reply_info"]) > 4:
-      
-      reply_keyboard = [
-        [InlineKeyboardButton("Edit Response", callback_data=f"edit_response {reset_message_user_id} {reset_message_info[4]}")]
-      ]
-    else:
-      reply_keyboard = [
-        [InlineKeyboardButton("Reply", callback_data=f"reply {reset_message_user_id}")]
-      ]
-    
-    await context.bot.edit_message_text(reset_message_text, message_id = reset_message_id, chat_id = reset_message_chat_id, reply_markup=InlineKeyboardMarkup(
-          reply_keyboard, one_time_keyboard=True
-      )
-    )
-  except:
-    pass
+    await restore_reply_button(context.bot, context.user_data["reply_to"])
+  except Exception:
+    metrics.suppressed("cancel_reply")
   
   cancel_message = await update.message.reply_text(
       "Cancelled reply!")
 
+  if "reply_to" in context.user_data:
+    context.bot_data.get("question_claims", {}).pop(context.user_data["reply_to"][0], None)
+    await pending_questions.claim(context.user_data["reply_to"][0], None)
+
   if "reply_msg" in context.user_data:
     del context.user_data["reply_msg"]
-  if "reply_info" in context.user_data:
-    del context.user_data["reply_info"]
+  context.user_data.pop("reply_media", None)
+  context.user_data.pop("reply_media_group", None)
+  if "reply_to" in context.user_data:
+    del context.user_data["reply_to"]
   if "curr_convo" in context.user_data:
     del context.user_data["curr_convo"]
-  context.user_data['in_reply_conversation'] = False
+  context.user_data.pop('in_reply_conversation', None)
 
-  for key, val in context.user_data["reply_to_delete"].items():
-    await delete_message(chat_id = val, message_id = key, time = 0, context = context)
+  message_cleaner.schedule_many(context.user_data["reply_to_delete"])
   
-  await delete_message(cancel_message.chat.id, cancel_message.id, 1.5, context)
+  message_cleaner.schedule(cancel_message.chat.id, cancel_message.id, delay = 1.5)
 
   del context.user_data["reply_to_delete"]
+  context.user_data.pop("reply_active_at", None)
 
   return ConversationHandler.END
 
-async def delete_message(chat_id, message_id, time, context):
-  if time > 0:
-    await asyncio.sleep(time)
-  try:
-    await context.bot.delete_message(chat_id = chat_id, message_id = message_id)
-  except:
-    pass
-
-
-async def handle_wix_requests(update: Update, context: ContextTypes.DEFAULT_TYPE):
-  if not "no_of_wix_questions" in context.bot_data:
-      context.bot_data["no_of_wix_questions"] = 0
-  
-  context.bot_data["no_of_wix_questions"] += 1
-  no_of_questions = context.bot_data["no_of_wix_questions"]
-
-  sender = update.message.from_user
-
-  full_name = sender.first_name
-  email = sender.last_name
-
-  msg = update.message.text
-
-  date = datetime.now(sgTz)
-  
-  question = f"""
-  [WIX] #{no_of_questions}, {date}
-
-Question by {full_name}, {email}:
-
-{msg}
-  """
-  reply_keyboard = [
-    [InlineKeyboardButton("Reply", callback_data=f"replyemail {email}")]
-  ]  
-  await context.bot.send_message(testing_group_id, question, reply_markup=InlineKeyboardMarkup(
-          reply_keyboard, one_time_keyboard=True
+async def touch_conversations(update: Update, context: ContextTypes.DEFAULT_TYPE):
+  if update.effective_user is None:
+    return
+  now = time.time()
+  if "question_info" in context.user_data:
+    context.user_data["question_active_at"] = now
+  if "reply_to" in context.user_data:
+    context.user_data["reply_active_at"] = now
+
+def abandoned(user_data, active_key: str, state_keys, timeout: float, now: float) -> bool:
+  """Whether a conversation left state in ``user_data`` and has been idle
+  for ``timeout`` seconds. State from before activity was recorded counts as
+  idle."""
+  return any(key in user_data for key in state_keys) and user_data.get(active_key, 0) < now - timeout
+
+async def expire_question(application: Application, user_id: int, user_data):
+  if "follow_up_to" in user_data:
+    try:
+      await restore_follow_up_button(application.bot, user_data["follow_up_to"])
+    except TelegramError:
+      metrics.suppressed("expire_question")
+  message_cleaner.schedule_many(user_data.get("question_to_delete", {}))
+  for key in QUESTION_STATE_KEYS:
+    user_data.pop(key, None)
+  application.end_conversations("new_question", user_id)
+
+async def expire_reply(application: Application, user_id: int, user_data):
+  if "reply_to" in user_data:
+    reply_to = user_data["reply_to"]
+    try:
+      await restore_reply_button(application.bot, reply_to)
+    except TelegramError:
+      metrics.suppressed("expire_reply")
+    application.bot_data.get("question_claims", {}).pop(reply_to[0], None)
+    await pending_questions.claim(reply_to[0], None)
+  message_cleaner.schedule_many(user_data.get("reply_to_delete", {}))
+  for key in REPLY_STATE_KEYS:
+    user_data.pop(key, None)
+  application.end_conversations("new_reply", user_id)
+
+async def sweep_conversations(context: ContextTypes.DEFAULT_TYPE):
+  """Ends the questions and replies users walked away from, so their
+  prompts are deleted, the question can be replied to by someone else and
+  user_data does not keep growing."""
+  if not context.application.is_primary:
+    return
+  application = context.application
+  now = time.time()
+  idle = [
+    user_id for user_id, user_data in list(application.user_data.items())
+    if abandoned(user_data, "question_active_at", QUESTION_STATE_KEYS, QUESTION_IDLE_TIMEOUT, now)
+    or abandoned(user_data, "reply_active_at", REPLY_STATE_KEYS, REPLY_IDLE_TIMEOUT, now)
+  ]
+  expired = 0
+  for user_id in idle[:JANITOR_MAX_USERS]:
+    async with application.user_state(user_id):
+      # checked again, the user may have carried on in the meantime
+      user_data = application.user_data[user_id]
+      if abandoned(user_data, "question_active_at", QUESTION_STATE_KEYS, QUESTION_IDLE_TIMEOUT, now):
+        await expire_question(application, user_id, user_data)
+        expired += 1
+      if abandoned(user_data, "reply_active_at", REPLY_STATE_KEYS, REPLY_IDLE_TIMEOUT, now):
+        await expire_reply(application, user_id, user_data)
+        expired += 1
+  if expired:
+    logger.info("Ended %s abandoned conversations.", expired)
+
+def format_wix_question(question: NumberedWixQuestion) -> str:
+  date = datetime.fromtimestamp(question.received_at, sgTz)
+  return f"""[WIX] #{question.number}, {date}
+
+Question by {question.name}, {question.email}:
+
+{question.question}"""
+
+def split_text(text: str, limit: int) -> List[str]:
+  """Splits text into parts of at most limit characters, at a line break
+  where there is one, else at a space."""
+  parts = []
+  while len(text) > limit:
+    cut = text.rfind("\n", 0, limit + 1)
+    if cut <= 0:
+      cut = text.rfind(" ", 0, limit + 1)
+    if cut <= 0:
+      cut = limit
+    parts.append(text[:cut])
+    text = text[cut:].lstrip("\n ")
+  parts.append(text)
+  return parts
+
+async def post_wix_digest(context: ContextTypes.DEFAULT_TYPE):
+  """Posts the questions received from the website since the last run,
+  packed into as few messages as fit. A question too long for one message
+  is sent over several, and counts as posted once its last part is sent."""
+  if not context.application.is_primary:
+    return
+  questions = await wix_inbox.unposted()
+  digests = []
+  for question in questions:
+    text = format_wix_question(question)
+    if digests and len(digests[-1][1]) + len(text) + 2 <= WIX_DIGEST_LENGTH:
+      digests[-1][0].append(question.number)
+      digests[-1][1] += "\n\n" + text
+      continue
+    parts = split_text(text, WIX_DIGEST_LENGTH)
+    digests.extend([[question.number], part, False] for part in parts[:-1])
+    digests.append([[question.number], parts[-1], True])
+
+  for numbers, text, complete in digests:
+    try:
+      await context.bot.send_message(testing_group_id, text)
+    except TelegramError as exc:
+      # left unposted for the next run
+      logger.warning("Could not post website questions %s: %s", numbers, exc)
+      return
+    if complete:
+      await wix_inbox.mark_posted(numbers)
+
+async def maintain_spool(context: ContextTypes.DEFAULT_TYPE):
+  await update_spool.beat()
+  if not context.application.is_primary:
+    return
+  if isinstance(context.application, SharedStateApplication):
+    now = time.time()
+    replayed = await context.application.update_queue.replay(context.bot, now, now - SPOOL_REPLAY_AFTER)
+    if replayed:
+      logger.info("Replayed %s updates left by a stopped worker.", replayed)
+  await update_spool.prune(SPOOL_RETENTION)
+
+async def post_init(application: Application):
+  # keyed on message ids, replaced by question_claims
+  application.bot_data.pop("claimed_questions", None)
+  await message_cleaner.start(application)
+  # updates received before the last shutdown or crash but never handled,
+  # with several workers only those of workers that stopped
+  await update_spool.beat()
+  now = time.time()
+  stale_before = now - SPOOL_REPLAY_AFTER if isinstance(application, SharedStateApplication) else None
+  replayed = await application.update_queue.replay(application.bot, now, stale_before)
+  if replayed:
+    logger.info("Replaying %s updates that were not handled before the restart.", replayed)
+  await question_index.load()
+  # users from before the user index existed
+  await broadcaster.remember(list(application.user_data))
+
+async def post_shutdown(application: Application):
+  await message_cleaner.stop()
+  await broadcaster.stop()
+
+def prepare_state() -> None:
+    """One-shot imports of the state saved by the old PicklePersistence, of
+    the ledger once kept in bot_data, which moves to the archive so that
+    startup only loads live conversations and counters (see compact.py to do
+    this ahead of a deploy), and of the events logged without their chat."""
+    if not os.path.exists(STATE_FILE) and os.path.exists(PICKLE_FILE):
+      migrate_pickle(PICKLE_FILE, STATE_FILE)
+    if os.path.exists(STATE_FILE) and LEDGER_KEYS & bot_data_keys(STATE_FILE):
+      moved = compact_state(STATE_FILE, ledger_archive)
+      ledger_archive.close()
+      logger.info("Moved %s ledger entries to %s.", moved, ARCHIVE_FILE)
+    if os.path.exists(LEGACY_EVENTS_FILE):
+      imported = event_log.import_legacy(LEGACY_EVENTS_FILE, research_chat_id)
+      logger.info("Imported %s events from %s.", imported, LEGACY_EVENTS_FILE)
+
+def build_application(workers: int = 1, base_url: Optional[str] = None, rate_limit: bool = True) -> Application:
+    """Build the bot. With several workers, each one builds its own
+    application on the shared state file and the Telegram limits are split
+    between them. ``base_url`` and ``rate_limit`` are for pointing the bot
+    at a stand-in Bot API, as benchmark.py does."""
+    shared = workers > 1
+    persistence = SQLitePersistence(filepath=STATE_FILE, shared=shared)
+    builder = (
+      Application.builder()
+      .application_class(SharedStateApplication if shared else PerUserApplication)
+      .token(TOKEN)
+      .concurrent_updates(CONCURRENT_UPDATES)
+      .persistence(persistence)
+      .update_queue(SpoolQueue(update_spool))
+      .request(InstrumentedRequest(metrics, connection_pool_size = CONNECTION_POOL_SIZE))
+      .post_init(post_init)
+      .post_shutdown(post_shutdown)
+    )
+    if rate_limit:
+      builder = builder.rate_limiter(PriorityRateLimiter(
+        overall_rate = 30 / workers,
+        private_chat_rate = 1 / workers,
+        private_chat_burst = max(3 // workers, 1),
+        group_rate = 20 / 60 / workers,
+        group_burst = max(20 // workers, 1),
       ))
-
-def main() -> None:
-    """Run the bot."""
-
-    persistence = PicklePersistence(filepath="conversationbot")
-    application = Application.builder().token(TOKEN).persistence(persistence).build()
+    if base_url is not None:
+      builder = builder.base_url(base_url)
+    if shared:
+      # updates come in through server.py
+      builder = builder.updater(None)
+    application = builder.build()
   
     tele_question = ConversationHandler(
         entry_points=[
@@ -462,12 +1059,13 @@ def main() -> None:
         states={
             TYPING_REPLY: [
                 MessageHandler(
-                    filters.TEXT & ~(filters.COMMAND), confirm_question
+                    (filters.TEXT & ~(filters.COMMAND)) | MEDIA, confirm_question
                 )
             ],
             CONFIRM_MESSAGE: [
                 CallbackQueryHandler(confirmed_question, pattern="^(confirm)$"),
-                CallbackQueryHandler(edit_question, pattern="^(edit)$")
+                CallbackQueryHandler(edit_question, pattern="^(edit)$"),
+                MessageHandler(MEDIA, add_question_media)
             ],
         },
         fallbacks=[CommandHandler("cancel", cancel_question)],
@@ -483,13 +1081,14 @@ def main() -> None:
         states={
             TYPING_REPLY: [
                 MessageHandler(
-                    filters.TEXT & ~(filters.COMMAND), confirm_reply
+                    (filters.TEXT & ~(filters.COMMAND)) | MEDIA, confirm_reply
                 ),
                 CallbackQueryHandler(reply_question, pattern="^(reply)")
             ],
             CONFIRM_MESSAGE: [
                 CallbackQueryHandler(confirmed_reply, pattern="^(confirm)$"),
-                CallbackQueryHandler(edit_reply, pattern="^(edit)$")
+                CallbackQueryHandler(edit_reply, pattern="^(edit)$"),
+                MessageHandler(MEDIA, add_reply_media)
             ],
         },
         fallbacks=[CommandHandler("cancel", cancel_reply)],
@@ -498,19 +1097,40 @@ def main() -> None:
     )
     
     # run track_users in its own group to not interfere with the user handlers
+    application.add_handler(TypeHandler(Update, track_users), group = -1)
+    application.add_handler(TypeHandler(Update, touch_conversations), group = -2)
     application.add_handler(CommandHandler("start", start))
-    application.add_handler(MessageHandler(
-      filters.TEXT & filters.User(username="testemail@e.ntu.edu.sg") & ~(filters.COMMAND), handle_wix_requests
-    ))
+    application.add_handler(CommandHandler("search", search))
+    application.add_handler(CommandHandler("stats", stats, filters = filters.Chat(COMMITTEE_CHATS)))
+    application.add_handler(CommandHandler("pending", pending, filters = filters.Chat(COMMITTEE_CHATS)))
+    application.add_handler(CommandHandler("available", available, filters = filters.Chat(COMMITTEE_CHATS)))
+    application.add_handler(CommandHandler("away", away, filters = filters.Chat(COMMITTEE_CHATS)))
+    application.add_handler(CallbackQueryHandler(pending_navigate, pattern = "^pending (prev|next) "))
+    application.add_handler(CommandHandler("broadcast", broadcast, filters = filters.Chat(COMMITTEE_CHATS)))
+    application.add_handler(CallbackQueryHandler(broadcast_confirm, pattern = "^broadcast (send|cancel) "))
     application.add_handler(tele_question)
     application.add_handler(tele_reply)
-    application.run_webhook(
-      listen = "0.0.0.0",
-      port = PORT,
-      url_path = TOKEN,
-      webhook_url = f"https://lkcresearchtest2-matthiasliew.koyeb.app/{TOKEN}"
-    )
-    #application.run_polling()
+    application.job_queue.run_repeating(post_wix_digest, interval = WIX_DIGEST_INTERVAL)
+    application.job_queue.run_repeating(remind_pending, interval = PENDING_REMIND_CHECK_INTERVAL)
+    application.job_queue.run_repeating(resume_broadcasts, interval = BROADCAST_RESUME_INTERVAL)
+    application.job_queue.run_repeating(maintain_spool, interval = SPOOL_CHECK_INTERVAL)
+    application.job_queue.run_repeating(sweep_conversations, interval = JANITOR_INTERVAL)
+    application.job_queue.run_repeating(reassign_questions, interval = ASSIGNMENT_CHECK_INTERVAL)
+    metrics.instrument_handlers(application)
+    application.metrics = metrics
+    application.spool = update_spool
+    return application
+
+def main() -> None:
+    """Run the bot in one process. The webhook, the website questions and
+    /metrics are all served by server.py, which is also what the Procfile
+    runs."""
+    os.environ.setdefault("WEB_CONCURRENCY", "1")
+    # run as a script this module is __main__; server.py imports it as main,
+    # which would load a second copy with its own stores
+    sys.modules.setdefault("main", sys.modules[__name__])
+    import server
+    server.run()
     
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,55 @@
+from typing import List, Optional, Sequence, Tuple
+
+from telegram import InputMediaDocument, InputMediaPhoto, Message
+from telegram.ext import ExtBot, filters
+
+# photos and documents attached to questions and replies
+MEDIA = filters.PHOTO | filters.Document.ALL
+
+# Bot API limit for a single sendMediaGroup call
+MEDIA_GROUP_LIMIT = 10
+
+# ("photo" | "document", file_id, caption)
+Attachment = Tuple[str, str, Optional[str]]
+
+
+def message_attachment(message: Message) -> Optional[Attachment]:
+  if message.photo:
+    # the largest size, Telegram keeps the others as thumbnails
+    return ("photo", message.photo[-1].file_id, message.caption)
+  if message.document:
+    return ("document", message.document.file_id, message.caption)
+  return None
+
+
+async def send_attachments(
+  bot: ExtBot, chat_id: int, attachments: Sequence[Attachment], reply_to_message_id: Optional[int] = None
+) -> List[Message]:
+  """Sends attachments by ``file_id``, so Telegram serves the files it
+  already has and nothing passes through the bot.
+
+  Photos and documents are sent as albums, one per kind since Telegram does
+  not mix them, of up to ``MEDIA_GROUP_LIMIT`` files each, every file with
+  its own caption.
+  """
+  sent = []
+  for kind, input_media, send_one in (
+    ("photo", InputMediaPhoto, bot.send_photo),
+    ("document", InputMediaDocument, bot.send_document),
+  ):
+    files = []
+    for attachment_kind, file_id, *caption in attachments:
+      if attachment_kind == kind:
+        # attachments kept before captions were have none
+        files.append((file_id, caption[0] if caption else None))
+    for i in range(0, len(files), MEDIA_GROUP_LIMIT):
+      batch = files[i:i + MEDIA_GROUP_LIMIT]
+      if len(batch) == 1:
+        file_id, caption = batch[0]
+        sent.append(await send_one(chat_id, file_id, caption=caption, reply_to_message_id=reply_to_message_id))
+      else:
+        sent.extend(await bot.send_media_group(
+          chat_id, [input_media(file_id, caption=caption) for file_id, caption in batch],
+          reply_to_message_id=reply_to_message_id
+        ))
+  return sent
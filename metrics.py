@@ -0,0 +1,185 @@
+import bisect
+import functools
+import logging
+import os
+import time
+from collections import Counter
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from telegram.ext import Application, ConversationHandler
+from telegram.request import HTTPXRequest
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (1e3, 1e4, 1e5, 1e6, 1e7)
+
+_PREFIX = "lkcbot"
+
+
+class Histogram:
+  __slots__ = ("buckets", "counts", "sum", "count")
+
+  def __init__(self, buckets: Sequence[float] = LATENCY_BUCKETS):
+    self.buckets = buckets
+    self.counts = [0] * (len(buckets) + 1)
+    self.sum = 0.0
+    self.count = 0
+
+  def observe(self, value: float) -> None:
+    self.counts[bisect.bisect_left(self.buckets, value)] += 1
+    self.sum += value
+    self.count += 1
+
+  def lines(self, name: str, labels: str = "") -> Iterable[str]:
+    cumulative = 0
+    for bound, count in zip([*self.buckets, "+Inf"], self.counts):
+      cumulative += count
+      yield f'{name}_bucket{{{labels}{"," if labels else ""}le="{bound}"}} {cumulative}'
+    suffix = f"{{{labels}}}" if labels else ""
+    yield f"{name}_sum{suffix} {self.sum}"
+    yield f"{name}_count{suffix} {self.count}"
+
+
+def _label(value: Any) -> str:
+  return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Metrics:
+  """In-process counters for the bot, rendered in the Prometheus text format.
+
+  Each worker process keeps its own, so with several workers a scrape shows
+  the worker that answered it (see the ``pid`` label).
+  """
+
+  def __init__(self, state_names: Optional[Dict[object, str]] = None):
+    self.state_names = state_names or {}
+    self.handler_latency: Dict[str, Histogram] = {}
+    self.handler_errors: Counter = Counter()
+    self.suppressed_errors: Counter = Counter()
+    self.api_latency: Dict[str, Histogram] = {}
+    self.api_errors: Counter = Counter()
+    self.flush_latency = Histogram()
+    self.flush_bytes = Histogram(SIZE_BUCKETS)
+
+  def _histogram(self, histograms: Dict[str, Histogram], key: str) -> Histogram:
+    histogram = histograms.get(key)
+    if histogram is None:
+      histogram = histograms[key] = Histogram()
+    return histogram
+
+  def observe_handler(self, name: str, seconds: float) -> None:
+    self._histogram(self.handler_latency, name).observe(seconds)
+
+  def observe_api_call(self, method: str, seconds: float, failed: bool = False) -> None:
+    self._histogram(self.api_latency, method).observe(seconds)
+    if failed:
+      self.api_errors[method] += 1
+
+  def observe_flush(self, seconds: float, written: int) -> None:
+    self.flush_latency.observe(seconds)
+    self.flush_bytes.observe(written)
+
+  def suppressed(self, where: str) -> None:
+    """Counts an exception a handler catches and carries on from. Call it
+    from the ``except`` block."""
+    self.suppressed_errors[where] += 1
+    logger.debug("Suppressed error in %s", where, exc_info=True)
+
+  def _wrap(self, callback):
+    name = callback.__name__
+
+    @functools.wraps(callback)
+    async def timed(update, context):
+      started = time.perf_counter()
+      try:
+        return await callback(update, context)
+      except Exception:
+        self.handler_errors[name] += 1
+        raise
+      finally:
+        self.observe_handler(name, time.perf_counter() - started)
+
+    return timed
+
+  def _handlers(self, handlers: Iterable[Any]) -> Iterable[Any]:
+    for handler in handlers:
+      if isinstance(handler, ConversationHandler):
+        yield from self._handlers(handler.entry_points)
+        for state_handlers in handler.states.values():
+          yield from self._handlers(state_handlers)
+        yield from self._handlers(handler.fallbacks)
+      else:
+        yield handler
+
+  def instrument_handlers(self, application: Application) -> None:
+    """Times every handler callback registered so far, including the ones
+    inside conversations. Call it once, after adding the handlers."""
+    for group in application.handlers.values():
+      for handler in self._handlers(group):
+        handler.callback = self._wrap(handler.callback)
+
+  def _conversation_states(self, application: Application) -> List[Tuple[str, str, int]]:
+    # pylint: disable=protected-access
+    counts: Counter = Counter()
+    for name, conversations in application._conversation_handler_conversations.items():
+      for state in conversations.values():
+        counts[(name, self.state_names.get(state, str(state)))] += 1
+    return [(name, state, count) for (name, state), count in sorted(counts.items())]
+
+  def render(self, application: Application) -> str:
+    pid = os.getpid()
+    lines = [f"# TYPE {_PREFIX}_handler_seconds histogram"]
+    for name, histogram in sorted(self.handler_latency.items()):
+      lines.extend(histogram.lines(f"{_PREFIX}_handler_seconds", f'handler="{name}",pid="{pid}"'))
+
+    lines.append(f"# TYPE {_PREFIX}_handler_errors_total counter")
+    for name, count in sorted(self.handler_errors.items()):
+      lines.append(f'{_PREFIX}_handler_errors_total{{handler="{name}",pid="{pid}"}} {count}')
+    lines.append(f"# TYPE {_PREFIX}_suppressed_errors_total counter")
+    for where, count in sorted(self.suppressed_errors.items()):
+      lines.append(f'{_PREFIX}_suppressed_errors_total{{where="{_label(where)}",pid="{pid}"}} {count}')
+
+    lines.append(f"# TYPE {_PREFIX}_bot_api_seconds histogram")
+    for method, histogram in sorted(self.api_latency.items()):
+      lines.extend(histogram.lines(f"{_PREFIX}_bot_api_seconds", f'method="{_label(method)}",pid="{pid}"'))
+    lines.append(f"# TYPE {_PREFIX}_bot_api_errors_total counter")
+    for method, count in sorted(self.api_errors.items()):
+      lines.append(f'{_PREFIX}_bot_api_errors_total{{method="{_label(method)}",pid="{pid}"}} {count}')
+
+    lines.append(f"# TYPE {_PREFIX}_persistence_flush_seconds histogram")
+    lines.extend(self.flush_latency.lines(f"{_PREFIX}_persistence_flush_seconds", f'pid="{pid}"'))
+    lines.append(f"# TYPE {_PREFIX}_persistence_flush_bytes histogram")
+    lines.extend(self.flush_bytes.lines(f"{_PREFIX}_persistence_flush_bytes", f'pid="{pid}"'))
+
+    lines.append(f"# TYPE {_PREFIX}_conversations gauge")
+    for name, state, count in self._conversation_states(application):
+      lines.append(f'{_PREFIX}_conversations{{conversation="{_label(name)}",state="{_label(state)}",pid="{pid}"}} {count}')
+
+    rate_limiter = application.bot.rate_limiter
+    if hasattr(rate_limiter, "queue_depth"):
+      lines.append(f"# TYPE {_PREFIX}_rate_limiter_queue_depth gauge")
+      lines.append(f'{_PREFIX}_rate_limiter_queue_depth{{pid="{pid}"}} {rate_limiter.queue_depth}')
+      lines.append(f"# TYPE {_PREFIX}_rate_limiter_in_flight gauge")
+      lines.append(f'{_PREFIX}_rate_limiter_in_flight{{pid="{pid}"}} {rate_limiter.in_flight}')
+    return "\n".join(lines) + "\n"
+
+
+class InstrumentedRequest(HTTPXRequest):
+  """``HTTPXRequest`` that times every Bot API call by method, without the
+  time spent waiting in the rate limiter."""
+
+  def __init__(self, metrics: Metrics, **kwargs):
+    super().__init__(**kwargs)
+    self.metrics = metrics
+
+  async def do_request(self, url: str, method: str, *args, **kwargs) -> Tuple[int, bytes]:
+    api_method = url.rsplit("/", 1)[-1]
+    started = time.perf_counter()
+    failed = True
+    try:
+      code, payload = await super().do_request(url, method, *args, **kwargs)
+      failed = code >= 400
+      return code, payload
+    finally:
+      self.metrics.observe_api_call(api_method, time.perf_counter() - started, failed)
@@ -0,0 +1,680 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import pickle
+import sqlite3
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from copy import deepcopy
+from io import BytesIO
+from typing import Any, Callable, Dict, Iterator, List, Optional, Set, Tuple, Union
+
+from telegram.ext import BasePersistence, PersistenceInput
+from telegram.ext._picklepersistence import _BotPickler, _BotUnpickler
+
+logger = logging.getLogger(__name__)
+
+# Marker stored in the subkey column of a bot_data row that holds a whole value.
+# Dict values are split into one row per entry, plus a marker row with NULL data.
+_WHOLE = b""
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL);
+INSERT OR IGNORE INTO meta (key, value) VALUES ('version', 0);
+CREATE TABLE IF NOT EXISTS user_data (user_id INTEGER PRIMARY KEY, data BLOB NOT NULL, version INTEGER NOT NULL DEFAULT 0);
+CREATE TABLE IF NOT EXISTS chat_data (chat_id INTEGER PRIMARY KEY, data BLOB NOT NULL, version INTEGER NOT NULL DEFAULT 0);
+CREATE TABLE IF NOT EXISTS bot_data (key BLOB NOT NULL, subkey BLOB NOT NULL, data BLOB, version INTEGER NOT NULL DEFAULT 0, deleted_at REAL, PRIMARY KEY (key, subkey));
+CREATE TABLE IF NOT EXISTS callback_data (id INTEGER PRIMARY KEY CHECK (id = 0), data BLOB NOT NULL);
+CREATE TABLE IF NOT EXISTS conversations (name TEXT NOT NULL, key TEXT NOT NULL, state BLOB NOT NULL, user_id INTEGER, PRIMARY KEY (name, key));
+"""
+
+_INDEXES = """
+CREATE INDEX IF NOT EXISTS bot_data_version ON bot_data (version);
+CREATE INDEX IF NOT EXISTS conversations_user_id ON conversations (user_id);
+"""
+
+# Columns added after the first release of this file, for databases created before them.
+_ADDED_COLUMNS = [
+  ("user_data", "version", "INTEGER NOT NULL DEFAULT 0"),
+  ("chat_data", "version", "INTEGER NOT NULL DEFAULT 0"),
+  ("bot_data", "version", "INTEGER NOT NULL DEFAULT 0"),
+  ("bot_data", "deleted_at", "REAL"),
+  ("conversations", "user_id", "INTEGER"),
+]
+
+# How long deleted bot_data rows are kept around so other workers see the deletion.
+TOMBSTONE_TTL = 24 * 60 * 60
+
+
+def _digest(data: Optional[bytes]) -> bytes:
+  if data is None:
+    return b"split"
+  return hashlib.blake2b(data, digest_size=16).digest()
+
+
+class StateFile:
+  """One connection to the bot's state file, shared by the stores that keep
+  their tables in it.
+
+  sqlite3 connections are not thread safe, so the stores run their queries
+  through ``run()``, on a single worker thread, one call at a time. Lookups
+  that must not wait behind writes use ``reader`` through ``read()``
+  instead, a second, read-only connection on a thread of its own, which WAL
+  lets read while the other writes. Each store registers the script or
+  function that creates its tables; they run when the file is first used.
+  Get the instance for a file with ``open()``.
+  """
+
+  _instances: Dict[str, "StateFile"] = {}
+
+  @classmethod
+  def open(cls, filepath: str) -> "StateFile":
+    key = os.path.abspath(filepath)
+    if key not in cls._instances:
+      cls._instances[key] = cls(filepath)
+    return cls._instances[key]
+
+  def __init__(self, filepath: str):
+    self.filepath = filepath
+    self._conn: Optional[sqlite3.Connection] = None
+    self._reader: Optional[sqlite3.Connection] = None
+    self._lock = threading.RLock()
+    self._schemas: List[Union[str, Callable[[sqlite3.Connection], None]]] = []
+    self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="state")
+    self._read_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="state-read")
+
+  def register(self, schema: Union[str, Callable[[sqlite3.Connection], None]]) -> None:
+    """Adds a store's tables: an SQL script, or a function that is given the
+    connection, for migrations. Runs right away if the file is open already."""
+    with self._lock:
+      self._schemas.append(schema)
+      opened = self._conn is not None
+    if opened:
+      self._executor.submit(self._create, schema).result()
+
+  def _create(self, schema: Union[str, Callable[[sqlite3.Connection], None]]) -> None:
+    if callable(schema):
+      schema(self._conn)
+    else:
+      self._conn.executescript(schema)
+
+  @property
+  def conn(self) -> sqlite3.Connection:
+    with self._lock:
+      if self._conn is None:
+        conn = sqlite3.connect(self.filepath, isolation_level=None, check_same_thread=False)
+        # only takes effect before the first table is created, see _Store
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        conn.execute("PRAGMA journal_mode = WAL")
+        # the update spool answers Telegram only once an update is on disk
+        conn.execute("PRAGMA synchronous = FULL")
+        conn.execute("PRAGMA busy_timeout = 5000")
+        self._conn = conn
+        for schema in self._schemas:
+          self._create(schema)
+      return self._conn
+
+  @property
+  def reader(self) -> sqlite3.Connection:
+    with self._lock:
+      if self._reader is None:
+        # creates the tables first
+        self.conn
+        reader = sqlite3.connect(self.filepath, isolation_level=None, check_same_thread=False)
+        reader.execute("PRAGMA query_only = ON")
+        reader.execute("PRAGMA busy_timeout = 5000")
+        self._reader = reader
+      return self._reader
+
+  async def run(self, func, *args):
+    return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+  async def read(self, func, *args):
+    """Like ``run()``, for functions that only query ``reader``."""
+    return await asyncio.get_running_loop().run_in_executor(self._read_executor, func, *args)
+
+  @contextmanager
+  def transaction(self) -> Iterator[sqlite3.Connection]:
+    """``BEGIN IMMEDIATE`` ... ``COMMIT``, rolled back on errors. Inside
+    another transaction, it just becomes part of it."""
+    conn = self.conn
+    if conn.in_transaction:
+      yield conn
+      return
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+      yield conn
+    except BaseException:
+      conn.execute("ROLLBACK")
+      raise
+    conn.execute("COMMIT")
+
+
+class _Store:
+  """Synchronous SQLite access shared by the persistence and the migrator.
+
+  Values are pickled with PTB's bot-aware pickler so that ``Message`` objects
+  and the like round-trip exactly as they do with ``PicklePersistence``.
+  Every write stamps its rows with a new value of a global version counter,
+  which lets other processes sharing the file pick up only what changed.
+  """
+
+  def __init__(self, filepath: str, bot: object):
+    self.filepath = filepath
+    self.bot = bot
+    self.conn = sqlite3.connect(filepath, isolation_level=None, check_same_thread=False)
+    self.conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    self.conn.execute("PRAGMA journal_mode = WAL")
+    self.conn.execute("PRAGMA synchronous = NORMAL")
+    self.conn.execute("PRAGMA busy_timeout = 5000")
+    self._enable_auto_vacuum()
+    self.conn.executescript(_SCHEMA)
+    self._add_missing_columns()
+    self.conn.executescript(_INDEXES)
+    self._transaction_depth = 0
+    # digests of the rows as last written, so only changed rows hit the disk
+    self.bot_data_digests: Dict[Tuple[bytes, bytes], bytes] = {}
+    self.user_data_digests: Dict[int, bytes] = {}
+    self.chat_data_digests: Dict[int, bytes] = {}
+    # versions of the rows as last seen by this process
+    self.user_data_versions: Dict[int, int] = {}
+    self.bot_data_version = self.current_version()
+    # pickled bytes written since the store was opened
+    self.bytes_written = 0
+
+  def _enable_auto_vacuum(self) -> None:
+    """SQLite ignores ``auto_vacuum`` on a file that already has tables until
+    it is rebuilt, and ``incremental_vacuum`` does nothing before that."""
+    if self.conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 0:
+      return
+    try:
+      self.conn.execute("VACUUM")
+    except sqlite3.OperationalError as exc:
+      # e.g. another worker is using the file, tried again on the next start
+      logger.warning("Could not rebuild %s for incremental vacuuming: %s", self.filepath, exc)
+      return
+    logger.info("Rebuilt %s for incremental vacuuming.", self.filepath)
+
+  def _add_missing_columns(self) -> None:
+    for table, column, declaration in _ADDED_COLUMNS:
+      columns = {row[1] for row in self.conn.execute(f"PRAGMA table_info({table})")}
+      if column not in columns:
+        self.conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {declaration}")
+        if column == "user_id":
+          for key, in self.conn.execute("SELECT key FROM conversations").fetchall():
+            self.conn.execute("UPDATE conversations SET user_id = ? WHERE key = ?", (json.loads(key)[-1], key))
+
+  def dumps(self, obj: Any) -> bytes:
+    buffer = BytesIO()
+    _BotPickler(self.bot, buffer, protocol=pickle.HIGHEST_PROTOCOL).dump(obj)
+    return buffer.getvalue()
+
+  def loads(self, data: bytes) -> Any:
+    return _BotUnpickler(self.bot, BytesIO(data)).load()
+
+  def close(self) -> None:
+    self.conn.close()
+
+  def current_version(self) -> int:
+    return self.conn.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()[0]
+
+  def _next_version(self) -> int:
+    """Must be called inside a transaction."""
+    self.conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'version'")
+    return self.current_version()
+
+  def load_id_table(self, table: str, column: str, digests: Dict[int, bytes]) -> Dict[int, Any]:
+    result = {}
+    for row_id, data, version in self.conn.execute(f"SELECT {column}, data, version FROM {table}"):
+      result[row_id] = self.loads(data)
+      digests[row_id] = _digest(data)
+      if table == "user_data":
+        self.user_data_versions[row_id] = version
+    return result
+
+  def write_id_row(self, table: str, column: str, digests: Dict[int, bytes], row_id: int, value: Any) -> None:
+    data = self.dumps(value)
+    digest = _digest(data)
+    if digests.get(row_id) == digest:
+      return
+    with self.transaction():
+      version = self._next_version()
+      self.conn.execute(
+        f"INSERT OR REPLACE INTO {table} ({column}, data, version) VALUES (?, ?, ?)", (row_id, data, version)
+      )
+    digests[row_id] = digest
+    self.bytes_written += len(data)
+    if table == "user_data":
+      self.user_data_versions[row_id] = version
+
+  def drop_id_row(self, table: str, column: str, digests: Dict[int, bytes], row_id: int) -> None:
+    self.conn.execute(f"DELETE FROM {table} WHERE {column} = ?", (row_id,))
+    digests.pop(row_id, None)
+
+  def load_user_data_if_changed(self, user_id: int) -> Tuple[bool, Any]:
+    """Returns ``(True, data)`` if another process changed the user's row
+    since this process last read or wrote it, ``data`` being ``None`` if the
+    row is gone."""
+    row = self.conn.execute("SELECT data, version FROM user_data WHERE user_id = ?", (user_id,)).fetchone()
+    if row is None:
+      if self.user_data_versions.pop(user_id, None) is None:
+        return False, None
+      self.user_data_digests.pop(user_id, None)
+      return True, None
+    data, version = row
+    if self.user_data_versions.get(user_id) == version:
+      return False, None
+    self.user_data_versions[user_id] = version
+    self.user_data_digests[user_id] = _digest(data)
+    return True, self.loads(data)
+
+  def load_bot_data(self) -> Dict[Any, Any]:
+    result: Dict[Any, Any] = {}
+    for key, subkey, data in self.conn.execute(
+      "SELECT key, subkey, data FROM bot_data WHERE deleted_at IS NULL ORDER BY key, subkey"
+    ):
+      self.bot_data_digests[(key, subkey)] = _digest(data)
+      if subkey == _WHOLE:
+        result[self.loads(key)] = {} if data is None else self.loads(data)
+      else:
+        result[self.loads(key)][self.loads(subkey)] = self.loads(data)
+    return result
+
+  def load_bot_data_changes(self, entry: Optional[Tuple[Any, Any]] = None) -> List[Tuple[Any, Any, bool, Any]]:
+    """Returns the ``bot_data`` rows written by other processes since the last
+    call as ``(key, subkey, deleted, value)``, ``subkey`` being ``_WHOLE`` for
+    top-level values and ``value`` being ``None`` for split dicts.
+
+    With ``entry``, only the rows of that ``(key, subkey)`` (or of the whole
+    key, for ``_WHOLE``) that differ from what this process last saw."""
+    changes = []
+    if entry is None:
+      rows = self.conn.execute(
+        "SELECT key, subkey, data, deleted_at, version FROM bot_data WHERE version > ? ORDER BY key, subkey",
+        (self.bot_data_version,)
+      ).fetchall()
+    else:
+      key, subkey = entry
+      where, args = "key = ?", (self.dumps(key),)
+      if subkey != _WHOLE:
+        where, args = "key = ? AND subkey IN (?, ?)", (*args, _WHOLE, self.dumps(subkey))
+      rows = self.conn.execute(
+        f"SELECT key, subkey, data, deleted_at, version FROM bot_data WHERE {where} ORDER BY key, subkey", args
+      ).fetchall()
+    for key, subkey, data, deleted_at, version in rows:
+      if entry is None:
+        self.bot_data_version = max(self.bot_data_version, version)
+      row_key = (key, subkey)
+      deleted = deleted_at is not None
+      digest = None if deleted else _digest(data)
+      if self.bot_data_digests.get(row_key) == digest:
+        # our own write
+        continue
+      if deleted:
+        self.bot_data_digests.pop(row_key, None)
+      else:
+        self.bot_data_digests[row_key] = digest
+      changes.append((
+        self.loads(key),
+        _WHOLE if subkey == _WHOLE else self.loads(subkey),
+        deleted,
+        None if deleted or data is None else self.loads(data),
+      ))
+    return changes
+
+  def _bot_data_rows(self, data: Dict[Any, Any]) -> Dict[Tuple[bytes, bytes], Optional[bytes]]:
+    rows = {}
+    for key, value in data.items():
+      pickled_key = self.dumps(key)
+      if type(value) is dict:
+        rows[(pickled_key, _WHOLE)] = None
+        for subkey, subvalue in value.items():
+          rows[(pickled_key, self.dumps(subkey))] = self.dumps(subvalue)
+      else:
+        rows[(pickled_key, _WHOLE)] = self.dumps(value)
+    return rows
+
+  def write_bot_data(self, data: Dict[Any, Any], entry: Optional[Tuple[Any, Any]] = None) -> int:
+    """Writes the rows of ``data`` that changed. With ``entry``, ``data``
+    only holds that ``(key, subkey)`` and the rows of other entries are left
+    alone."""
+    rows = self._bot_data_rows(data)
+    if entry is None:
+      written = set(self.bot_data_digests)
+    else:
+      key, subkey = entry
+      pickled_key = self.dumps(key)
+      if subkey == _WHOLE:
+        written = {row_key for row_key in self.bot_data_digests if row_key[0] == pickled_key}
+      else:
+        written = {(pickled_key, self.dumps(subkey))}
+        rows = {row_key: row_data for row_key, row_data in rows.items() if row_key[1] == _WHOLE or row_key in written}
+    changed = []
+    for row_key, row_data in rows.items():
+      digest = _digest(row_data)
+      if self.bot_data_digests.get(row_key) != digest:
+        changed.append((row_key, row_data, digest))
+    removed = [row_key for row_key in written if row_key in self.bot_data_digests and row_key not in rows]
+    if not changed and not removed:
+      return 0
+
+    with self.transaction():
+      version = self._next_version()
+      # deletions are kept as tombstones for a while so other processes notice them
+      self.conn.executemany(
+        "UPDATE bot_data SET data = NULL, version = ?, deleted_at = ? WHERE key = ? AND subkey = ?",
+        [(version, time.time(), key, subkey) for key, subkey in removed]
+      )
+      self.conn.executemany(
+        "INSERT OR REPLACE INTO bot_data (key, subkey, data, version, deleted_at) VALUES (?, ?, ?, ?, NULL)",
+        [(key, subkey, row_data, version) for (key, subkey), row_data, _ in changed]
+      )
+    if version == self.bot_data_version + 1:
+      # nobody else wrote in between, so there is nothing to catch up on
+      self.bot_data_version = version
+    for row_key in removed:
+      del self.bot_data_digests[row_key]
+    for row_key, row_data, digest in changed:
+      self.bot_data_digests[row_key] = digest
+      self.bytes_written += len(row_data or b"")
+    return len(changed) + len(removed)
+
+  def load_callback_data(self) -> Optional[Any]:
+    row = self.conn.execute("SELECT data FROM callback_data WHERE id = 0").fetchone()
+    return None if row is None else self.loads(row[0])
+
+  def write_callback_data(self, data: Any) -> None:
+    pickled = self.dumps(data)
+    self.conn.execute("INSERT OR REPLACE INTO callback_data (id, data) VALUES (0, ?)", (pickled,))
+    self.bytes_written += len(pickled)
+
+  def load_conversations(self, name: str) -> Dict[Tuple[int, ...], object]:
+    return {
+      tuple(json.loads(key)): self.loads(state)
+      for key, state in self.conn.execute("SELECT key, state FROM conversations WHERE name = ?", (name,))
+    }
+
+  def load_user_conversations(self, user_id: int) -> Dict[str, Dict[Tuple[int, ...], object]]:
+    result: Dict[str, Dict[Tuple[int, ...], object]] = {}
+    for name, key, state in self.conn.execute(
+      "SELECT name, key, state FROM conversations WHERE user_id = ?", (user_id,)
+    ):
+      result.setdefault(name, {})[tuple(json.loads(key))] = self.loads(state)
+    return result
+
+  def write_conversation(self, name: str, key: Tuple[int, ...], state: Optional[object]) -> None:
+    encoded_key = json.dumps(list(key))
+    if state is None:
+      self.conn.execute("DELETE FROM conversations WHERE name = ? AND key = ?", (name, encoded_key))
+    else:
+      pickled = self.dumps(state)
+      self.conn.execute(
+        "INSERT OR REPLACE INTO conversations (name, key, state, user_id) VALUES (?, ?, ?, ?)",
+        (name, encoded_key, pickled, key[-1])
+      )
+      self.bytes_written += len(pickled)
+
+  @contextmanager
+  def transaction(self) -> Iterator[None]:
+    if self._transaction_depth:
+      # already inside one, it commits or rolls back as a whole
+      self._transaction_depth += 1
+      try:
+        yield
+      finally:
+        self._transaction_depth -= 1
+      return
+
+    self.conn.execute("BEGIN IMMEDIATE")
+    self._transaction_depth = 1
+    try:
+      yield
+    except BaseException:
+      self.conn.execute("ROLLBACK")
+      raise
+    finally:
+      self._transaction_depth = 0
+    self.conn.execute("COMMIT")
+
+  def compact(self) -> None:
+    self.conn.execute("DELETE FROM bot_data WHERE deleted_at < ?", (time.time() - TOMBSTONE_TTL,))
+    self.conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    self.conn.execute("PRAGMA incremental_vacuum")
+
+
+class SQLitePersistence(BasePersistence):
+  """Drop-in replacement for ``PicklePersistence`` backed by a SQLite file.
+
+  Every user, chat, conversation and top-level ``bot_data`` entry lives in its
+  own row, and dict values in ``bot_data`` are split one row per entry. A flush
+  only writes the rows whose pickled form changed, inside a single
+  transaction, so a crash mid-write leaves the previous state intact. The WAL
+  is checkpointed and free pages reclaimed in the background every
+  ``compact_interval`` seconds.
+
+  With ``shared=True`` several processes can use the same file: before an
+  update is handled, ``refresh_*`` pulls in the rows other processes wrote
+  since this one last looked, so the caller only has to make sure that
+  updates of the same user are not handled by two processes at once.
+  """
+
+  def __init__(
+    self,
+    filepath: str,
+    store_data: PersistenceInput = None,
+    update_interval: float = 60,
+    compact_interval: float = 3600,
+    shared: bool = False,
+  ):
+    super().__init__(store_data=store_data, update_interval=update_interval)
+    self.filepath = filepath
+    self.shared = shared
+    self.compact_interval = compact_interval
+    self._store: Optional[_Store] = None
+    # sqlite3 connections are not thread safe, so all access goes through one worker
+    self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="persistence")
+    self._last_compaction = time.monotonic()
+
+  @property
+  def bytes_written(self) -> int:
+    """Pickled bytes written to the file by this process so far."""
+    return 0 if self._store is None else self._store.bytes_written
+
+  async def _run(self, func) -> Any:
+    if self._store is None:
+      self._store = _Store(self.filepath, self.bot)
+    return await asyncio.get_running_loop().run_in_executor(self._executor, func)
+
+  async def get_user_data(self) -> Dict[int, Any]:
+    return await self._run(lambda: self._store.load_id_table("user_data", "user_id", self._store.user_data_digests))
+
+  async def get_chat_data(self) -> Dict[int, Any]:
+    return await self._run(lambda: self._store.load_id_table("chat_data", "chat_id", self._store.chat_data_digests))
+
+  async def get_bot_data(self) -> Dict[Any, Any]:
+    return await self._run(lambda: self._store.load_bot_data())
+
+  async def get_callback_data(self) -> Optional[Any]:
+    return await self._run(lambda: self._store.load_callback_data())
+
+  async def get_conversations(self, name: str) -> Dict[Tuple[int, ...], object]:
+    return await self._run(lambda: self._store.load_conversations(name))
+
+  async def update_conversation(self, name: str, key: Tuple[int, ...], new_state: Optional[object]) -> None:
+    await self._run(lambda: self._store.write_conversation(name, key, new_state))
+
+  async def update_user_data(self, user_id: int, data: Any) -> None:
+    await self._run(lambda: self._store.write_id_row("user_data", "user_id", self._store.user_data_digests, user_id, data))
+
+  async def update_chat_data(self, chat_id: int, data: Any) -> None:
+    await self._run(lambda: self._store.write_id_row("chat_data", "chat_id", self._store.chat_data_digests, chat_id, data))
+
+  async def update_bot_data(self, data: Dict[Any, Any]) -> None:
+    written = await self._run(lambda: self._store.write_bot_data(data))
+    if written:
+      logger.debug("Wrote %s changed bot_data rows.", written)
+    self._maybe_compact()
+
+  async def update_callback_data(self, data: Any) -> None:
+    await self._run(lambda: self._store.write_callback_data(data))
+
+  async def drop_chat_data(self, chat_id: int) -> None:
+    await self._run(lambda: self._store.drop_id_row("chat_data", "chat_id", self._store.chat_data_digests, chat_id))
+
+  async def drop_user_data(self, user_id: int) -> None:
+    await self._run(lambda: self._store.drop_id_row("user_data", "user_id", self._store.user_data_digests, user_id))
+
+  async def refresh_user_data(self, user_id: int, user_data: Any) -> None:
+    if not self.shared:
+      return
+    changed, data = await self._run(lambda: self._store.load_user_data_if_changed(user_id))
+    if changed:
+      user_data.clear()
+      user_data.update(data or {})
+
+  async def refresh_chat_data(self, chat_id: int, chat_data: Any) -> None:
+    pass
+
+  async def update_bot_data_entry(self, bot_data: Dict[Any, Any], key: Any, subkey: Any = _WHOLE) -> None:
+    """Writes ``bot_data[key]``, or only ``bot_data[key][subkey]``, if it changed."""
+    if key not in bot_data:
+      data = {}
+    elif subkey == _WHOLE or type(bot_data[key]) is not dict:
+      data = {key: deepcopy(bot_data[key])}
+    elif subkey in bot_data[key]:
+      data = {key: {subkey: deepcopy(bot_data[key][subkey])}}
+    else:
+      data = {key: {}}
+    await self._run(lambda: self._store.write_bot_data(data, (key, subkey)))
+
+  async def refresh_bot_data(self, bot_data: Any, key: Any = None, subkey: Any = _WHOLE) -> None:
+    """Pulls in what other processes wrote to ``bot_data``, or with ``key``
+    only to ``bot_data[key]`` or ``bot_data[key][subkey]``."""
+    if not self.shared:
+      return
+    entry = None if key is None else (key, subkey)
+    changes = await self._run(lambda: self._store.load_bot_data_changes(entry))
+    # applied in place on the event loop, handlers hold references to the nested dicts
+    for key, subkey, deleted, value in changes:
+      if subkey == _WHOLE:
+        if deleted:
+          bot_data.pop(key, None)
+        elif value is not None:
+          bot_data[key] = value
+        elif type(bot_data.get(key)) is not dict:
+          bot_data[key] = {}
+      elif deleted:
+        bot_data.get(key, {}).pop(subkey, None)
+      else:
+        bot_data.setdefault(key, {})[subkey] = value
+
+  async def refresh_conversations(self, conversations: Dict[str, Any], user_id: int) -> None:
+    """Brings the conversation states of ``user_id`` in line with the file.
+
+    ``conversations`` maps handler names to the conversation dicts of the
+    application; they are updated without marking the keys as written.
+    """
+    if not self.shared:
+      return
+    stored = await self._run(lambda: self._store.load_user_conversations(user_id))
+    for name, states in conversations.items():
+      stored_states = stored.get(name, {})
+      for key in [key for key in states if key[-1] == user_id and key not in stored_states]:
+        states.data.pop(key)
+      states.update_no_track(stored_states)
+
+  def _maybe_compact(self) -> None:
+    if time.monotonic() - self._last_compaction < self.compact_interval:
+      return
+    self._last_compaction = time.monotonic()
+    # queued behind any pending writes on the worker, never blocks the event loop
+    self._executor.submit(self._store.compact)
+
+  async def flush(self) -> None:
+    if self._store is None:
+      return
+    await self._run(lambda: self._store.compact())
+    await self._run(lambda: self._store.close())
+    self._store = None
+
+
+# Stands in for the bot while migrating, so bot references survive the round trip.
+_MIGRATION_BOT = object()
+
+
+def migrate_pickle(pickle_path: str, db_path: str) -> None:
+  """Import a ``PicklePersistence`` file into a fresh SQLite persistence file."""
+  if os.path.exists(db_path):
+    raise FileExistsError(f"{db_path} already exists, refusing to overwrite it.")
+
+  with open(pickle_path, "rb") as file:
+    data = _BotUnpickler(_MIGRATION_BOT, file).load()
+
+  # write to a temporary file first so an interrupted migration leaves nothing behind
+  tmp_path = db_path + ".migrating"
+  if os.path.exists(tmp_path):
+    os.remove(tmp_path)
+  store = _Store(tmp_path, _MIGRATION_BOT)
+  try:
+    with store.transaction():
+      for user_id, user_data in data.get("user_data", {}).items():
+        store.write_id_row("user_data", "user_id", store.user_data_digests, user_id, user_data)
+      for chat_id, chat_data in data.get("chat_data", {}).items():
+        store.write_id_row("chat_data", "chat_id", store.chat_data_digests, chat_id, chat_data)
+      for name, conversations in data.get("conversations", {}).items():
+        for key, state in conversations.items():
+          store.write_conversation(name, key, state)
+      if data.get("callback_data") is not None:
+        store.write_callback_data(data["callback_data"])
+    store.write_bot_data(data.get("bot_data", {}))
+    store.conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+  finally:
+    store.close()
+  os.replace(tmp_path, db_path)
+  logger.info("Migrated %s into %s.", pickle_path, db_path)
+
+
+def bot_data_keys(db_path: str) -> Set[Any]:
+  """The top-level ``bot_data`` keys stored in a file, without loading their values."""
+  store = _Store(db_path, _MIGRATION_BOT)
+  try:
+    return {
+      store.loads(key)
+      for key, in store.conn.execute("SELECT key FROM bot_data WHERE subkey = ? AND deleted_at IS NULL", (_WHOLE,))
+    }
+  finally:
+    store.close()
+
+
+def rewrite_bot_data(db_path: str, rewrite: Callable[[Dict[Any, Any]], Any]) -> Any:
+  """Lets ``rewrite`` change the ``bot_data`` stored in a file in place and
+  writes back the rows that changed, then drops every tombstone and vacuums
+  the file down to what is left. Returns what ``rewrite`` returned.
+
+  Only for when no bot is using the file, since running workers would miss
+  the deletions.
+  """
+  store = _Store(db_path, _MIGRATION_BOT)
+  try:
+    bot_data = store.load_bot_data()
+    result = rewrite(bot_data)
+    store.write_bot_data(bot_data)
+    store.conn.execute("DELETE FROM bot_data WHERE deleted_at IS NOT NULL")
+    store.conn.execute("VACUUM")
+    store.conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+  finally:
+    store.close()
+  logger.info("Rewrote the bot_data of %s.", db_path)
+  return result
+
+
+if __name__ == "__main__":
+  logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+  if len(sys.argv) != 4 or sys.argv[1] != "migrate":
+    sys.exit(f"usage: {sys.argv[0]} migrate <pickle file> <sqlite file>")
+  migrate_pickle(sys.argv[2], sys.argv[3])
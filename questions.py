@@ -0,0 +1,174 @@
+import json
+import sqlite3
+from typing import NamedTuple, Optional, Sequence
+
+from media import Attachment
+from persistence import StateFile
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS questions (
+  number INTEGER PRIMARY KEY,
+  asker_id INTEGER NOT NULL,
+  asker_name TEXT NOT NULL,
+  text TEXT NOT NULL,
+  submitted_at REAL NOT NULL,
+  chat_id INTEGER NOT NULL,
+  message_id INTEGER NOT NULL,
+  posted_text TEXT NOT NULL,
+  follow_up_of INTEGER,
+  replied_header TEXT,
+  reply_chat_id INTEGER,
+  reply_message_id INTEGER,
+  reply_header TEXT,
+  reply_template TEXT
+);
+CREATE UNIQUE INDEX IF NOT EXISTS questions_message ON questions (chat_id, message_id);
+CREATE TABLE IF NOT EXISTS question_replies (
+  number INTEGER NOT NULL,
+  version INTEGER NOT NULL,
+  responder_id INTEGER NOT NULL,
+  responder_name TEXT NOT NULL,
+  text TEXT NOT NULL,
+  replied_at REAL NOT NULL,
+  PRIMARY KEY (number, version)
+);
+"""
+
+# (table, column, declaration) added after the table was first released
+_ADDED_COLUMNS = [
+  # JSON list of [kind, file_id, caption]
+  ("questions", "attachments", "TEXT"),
+  ("question_replies", "attachments", "TEXT"),
+]
+
+_COLUMNS = (
+  "number, asker_id, asker_name, text, submitted_at, chat_id, message_id, posted_text, follow_up_of,"
+  " replied_header, reply_chat_id, reply_message_id, reply_header, reply_template, attachments"
+)
+_REPLY_COLUMNS = "number, version, responder_id, responder_name, text, replied_at, attachments"
+
+
+def _create_tables(conn: sqlite3.Connection) -> None:
+  conn.executescript(_SCHEMA)
+  for table, column, declaration in _ADDED_COLUMNS:
+    columns = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+    if column not in columns:
+      conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {declaration}")
+
+
+def _dump_attachments(attachments: Sequence[Attachment]) -> Optional[str]:
+  return json.dumps(attachments) if attachments else None
+
+
+def _load_attachments(stored: Optional[str]) -> Sequence[Attachment]:
+  return tuple(tuple(attachment) for attachment in json.loads(stored)) if stored else ()
+
+
+class Question(NamedTuple):
+  number: int
+  asker_id: int
+  asker_name: str
+  text: str
+  submitted_at: float
+  # the question as posted in the committee group
+  chat_id: int
+  message_id: int
+  posted_text: str
+  # number of the question this one follows up on
+  follow_up_of: Optional[int] = None
+  # Rendered once, when the question is first replied to: the start of the
+  # group message after the reply, the reply the asker got and the header
+  # and template of its text, which edits keep.
+  replied_header: Optional[str] = None
+  reply_chat_id: Optional[int] = None
+  reply_message_id: Optional[int] = None
+  reply_header: Optional[str] = None
+  reply_template: Optional[str] = None
+  # photos and documents sent with the question, as Telegram file ids
+  attachments: Sequence[Attachment] = ()
+
+
+class Reply(NamedTuple):
+  number: int
+  # 1 for the first reply, then one more per edit
+  version: int
+  responder_id: int
+  responder_name: str
+  text: str
+  replied_at: float
+  attachments: Sequence[Attachment] = ()
+
+
+class QuestionStore:
+  """Every question submitted to the committee, keyed by its number, with
+  the replies and edits it got.
+
+  Buttons carry the question number, so resolving one is a primary key
+  lookup, and the texts that are shown again on edits are rendered once
+  and kept here instead of being rebuilt from the message text.
+  """
+
+  def __init__(self, filepath: str):
+    self.state = StateFile.open(filepath)
+    self.state.register(_create_tables)
+
+  async def add(self, question: Question) -> None:
+    await self.state.run(
+      self.state.conn.execute,
+      f"INSERT OR IGNORE INTO questions ({_COLUMNS}) VALUES ({', '.join('?' * len(question))})",
+      question._replace(attachments=_dump_attachments(question.attachments))
+    )
+
+  def _get(self, where: str, args) -> Optional[Question]:
+    row = self.state.conn.execute(f"SELECT {_COLUMNS} FROM questions WHERE {where}", args).fetchone()
+    if row is None:
+      return None
+    question = Question(*row)
+    return question._replace(attachments=_load_attachments(question.attachments))
+
+  async def get(self, number: int) -> Optional[Question]:
+    return await self.state.run(self._get, "number = ?", (number,))
+
+  async def by_message(self, chat_id: int, message_id: int) -> Optional[Question]:
+    """The question posted as ``message_id`` in the group ``chat_id``."""
+    return await self.state.run(self._get, "chat_id = ? AND message_id = ?", (chat_id, message_id))
+
+  def _add_reply(self, reply: Reply, replied: Question) -> int:
+    with self.state.transaction() as conn:
+      version = conn.execute(
+        "SELECT COALESCE(MAX(version), 0) + 1 FROM question_replies WHERE number = ?", (reply.number,)
+      ).fetchone()[0]
+      conn.execute(
+        f"INSERT INTO question_replies ({_REPLY_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?)",
+        reply._replace(version=version, attachments=_dump_attachments(reply.attachments))
+      )
+      # the first reply's texts are the ones edits build on
+      conn.execute(
+        "UPDATE questions SET replied_header = COALESCE(replied_header, ?), reply_chat_id = COALESCE(reply_chat_id, ?),"
+        " reply_message_id = COALESCE(reply_message_id, ?), reply_header = COALESCE(reply_header, ?),"
+        " reply_template = COALESCE(reply_template, ?) WHERE number = ?",
+        (
+          replied.replied_header, replied.reply_chat_id, replied.reply_message_id, replied.reply_header,
+          replied.reply_template, reply.number
+        )
+      )
+    return version
+
+  async def add_reply(self, reply: Reply, replied: Question) -> int:
+    """Records a reply or an edit of it, whatever its ``version``, and
+    returns the version it got. ``replied`` is the question with the texts
+    rendered for the reply, kept only if it is the first one."""
+    return await self.state.run(self._add_reply, reply, replied)
+
+  def _latest_reply(self, number: int) -> Optional[Reply]:
+    row = self.state.conn.execute(
+      f"SELECT {_REPLY_COLUMNS} FROM question_replies WHERE number = ? ORDER BY version DESC LIMIT 1", (number,)
+    ).fetchone()
+    if row is None:
+      return None
+    reply = Reply(*row)
+    return reply._replace(attachments=_load_attachments(reply.attachments))
+
+  async def latest_reply(self, number: int) -> Optional[Reply]:
+    """The reply as last edited, if the question has one."""
+    return await self.state.run(self._latest_reply, number)
@@ -0,0 +1,218 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from typing import Any, Callable, Coroutine, Dict, List, Optional, Tuple, Union
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+logger = logging.getLogger(__name__)
+
+# Lower numbers are sent first.
+PRIORITY_REPLY = 0
+PRIORITY_DEFAULT = 1
+PRIORITY_CLEANUP = 2
+# announcements fill whatever the rest of the bot leaves of the global limit
+PRIORITY_BROADCAST = 3
+
+_CLEANUP_ENDPOINTS = {"deleteMessage", "deleteMessages"}
+# Telegram's per-chat limits are on new messages; edits and deletions only
+# count against the global limit
+_SEND_ENDPOINTS = {
+  "sendMessage", "sendPhoto", "sendDocument", "sendMediaGroup", "copyMessage", "forwardMessage",
+  "sendAnimation", "sendAudio", "sendVideo", "sendVoice", "sendSticker",
+}
+_MAX_IDLE_BUCKETS = 1000
+
+
+class TokenBucket:
+  __slots__ = ("rate", "capacity", "tokens", "updated")
+
+  def __init__(self, rate: float, capacity: float):
+    self.rate = rate
+    self.capacity = capacity
+    self.tokens = capacity
+    self.updated = time.monotonic()
+
+  def _refill(self, now: float) -> None:
+    self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+    self.updated = now
+
+  def delay(self, now: float) -> float:
+    """Seconds until a token is available, 0 if one is available now."""
+    self._refill(now)
+    if self.tokens >= 1:
+      return 0
+    return (1 - self.tokens) / self.rate
+
+  def take(self, now: float) -> None:
+    self._refill(now)
+    self.tokens -= 1
+
+  def is_full(self, now: float) -> bool:
+    self._refill(now)
+    return self.tokens >= self.capacity
+
+
+class PriorityRateLimiter(BaseRateLimiter[int]):
+  """Throttles outgoing requests to stay under Telegram's flood limits.
+
+  Every request with a ``chat_id`` needs a token from the global bucket
+  (30/s), and every message sent also one from the bucket of its chat (1/s
+  with bursts of 3 for private chats, 20/min for groups). Waiting requests are served in priority order: replies to
+  private chats first, deletions and broadcasts last. Pass ``rate_limit_args=<priority>`` to
+  a bot method to override the guess. A ``RetryAfter`` from Telegram pauses
+  all requests for the given time and the request is queued again, up to
+  ``max_retries`` times.
+  """
+
+  def __init__(
+    self,
+    overall_rate: float = 30,
+    private_chat_rate: float = 1,
+    private_chat_burst: float = 3,
+    group_rate: float = 20 / 60,
+    group_burst: float = 20,
+    max_retries: int = 3,
+  ):
+    self.overall = TokenBucket(overall_rate, overall_rate)
+    self.private_chat_rate = private_chat_rate
+    self.private_chat_burst = private_chat_burst
+    self.group_rate = group_rate
+    self.group_burst = group_burst
+    self.max_retries = max_retries
+    self._chat_buckets: Dict[int, TokenBucket] = {}
+    # (priority, arrival, chat_id or None for the global bucket only, future)
+    self._queue: List[Tuple[int, int, Optional[int], asyncio.Future]] = []
+    self._counter = itertools.count()
+    self._paused_until = 0.0
+    self._wake: Optional[asyncio.Event] = None
+    self._dispatcher: Optional[asyncio.Task] = None
+    self.in_flight = 0
+
+  @property
+  def queue_depth(self) -> int:
+    """Number of requests waiting for a token."""
+    return len(self._queue)
+
+  async def initialize(self) -> None:
+    # the bot is initialised by both the application and its updater
+    if self._dispatcher is not None:
+      return
+    self._wake = asyncio.Event()
+    self._dispatcher = asyncio.create_task(self._dispatch())
+
+  async def shutdown(self) -> None:
+    if self._dispatcher is not None:
+      self._dispatcher.cancel()
+      try:
+        await self._dispatcher
+      except asyncio.CancelledError:
+        pass
+      self._dispatcher = None
+    for _, _, _, future in self._queue:
+      future.cancel()
+    self._queue.clear()
+
+  def _bucket(self, chat_id: int) -> TokenBucket:
+    bucket = self._chat_buckets.get(chat_id)
+    if bucket is None:
+      if chat_id < 0:
+        bucket = TokenBucket(self.group_rate, self.group_burst)
+      else:
+        bucket = TokenBucket(self.private_chat_rate, self.private_chat_burst)
+      self._chat_buckets[chat_id] = bucket
+    return bucket
+
+  async def _acquire(self, priority: int, chat_id: Optional[int]) -> None:
+    future = asyncio.get_running_loop().create_future()
+    heapq.heappush(self._queue, (priority, next(self._counter), chat_id, future))
+    self._wake.set()
+    await future
+
+  async def _dispatch(self) -> None:
+    while True:
+      now = time.monotonic()
+      wait = None
+      if now < self._paused_until:
+        wait = self._paused_until - now
+      else:
+        waiting = []
+        while self._queue:
+          entry = heapq.heappop(self._queue)
+          priority, _, chat_id, future = entry
+          if future.done():
+            continue
+          overall_delay = self.overall.delay(now)
+          if overall_delay:
+            # nothing else can be sent until the global bucket refills
+            waiting.append(entry)
+            wait = overall_delay
+            break
+          chat_delay = 0 if chat_id is None else self._bucket(chat_id).delay(now)
+          if chat_delay:
+            waiting.append(entry)
+            wait = chat_delay if wait is None else min(wait, chat_delay)
+            continue
+          self.overall.take(now)
+          if chat_id is not None:
+            self._bucket(chat_id).take(now)
+          future.set_result(None)
+        for entry in waiting:
+          heapq.heappush(self._queue, entry)
+
+        if len(self._chat_buckets) > _MAX_IDLE_BUCKETS:
+          for chat_id in [c for c, b in self._chat_buckets.items() if b.is_full(now)]:
+            del self._chat_buckets[chat_id]
+
+      self._wake.clear()
+      try:
+        await asyncio.wait_for(self._wake.wait(), wait)
+      except asyncio.TimeoutError:
+        pass
+
+  def _priority(self, endpoint: str, chat_id: Optional[int], rate_limit_args: Optional[int]) -> int:
+    if rate_limit_args is not None:
+      return rate_limit_args
+    if endpoint in _CLEANUP_ENDPOINTS:
+      return PRIORITY_CLEANUP
+    if chat_id is not None and chat_id > 0:
+      return PRIORITY_REPLY
+    return PRIORITY_DEFAULT
+
+  async def process_request(
+    self,
+    callback: Callable[..., Coroutine[Any, Any, Union[bool, Dict[str, Any], None]]],
+    args: Any,
+    kwargs: Dict[str, Any],
+    endpoint: str,
+    data: Dict[str, Any],
+    rate_limit_args: Optional[int],
+  ) -> Union[bool, Dict[str, Any], None]:
+    chat_id = data.get("chat_id")
+    try:
+      chat_id = int(chat_id)
+    except (TypeError, ValueError):
+      # usernames of channels and supergroups
+      chat_id = None if chat_id is None else -1
+    priority = self._priority(endpoint, chat_id, rate_limit_args)
+    bucket_chat_id = chat_id if endpoint in _SEND_ENDPOINTS else None
+
+    for attempt in range(self.max_retries + 1):
+      if chat_id is not None:
+        await self._acquire(priority, bucket_chat_id)
+      elif time.monotonic() < self._paused_until:
+        await asyncio.sleep(self._paused_until - time.monotonic())
+      self.in_flight += 1
+      try:
+        return await callback(*args, **kwargs)
+      except RetryAfter as exc:
+        if attempt == self.max_retries:
+          raise
+        logger.info("Rate limit hit on %s, pausing for %ss.", endpoint, exc.retry_after)
+        self._paused_until = max(self._paused_until, time.monotonic() + exc.retry_after + 0.1)
+        self._wake.set()
+      finally:
+        self.in_flight -= 1
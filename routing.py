@@ -0,0 +1,60 @@
+import json
+import os
+import re
+from typing import FrozenSet, List, NamedTuple, Sequence
+
+_WORD = re.compile(r"\w+")
+
+
+class Route(NamedTuple):
+  chat_id: int
+  # lowercase words and phrases
+  keywords: FrozenSet[str]
+
+
+def load_routes(filepath: str) -> List[Route]:
+  """Reads routing rules from a JSON file like
+  ``[{"chat_id": -100123, "keywords": ["ethics", "irb approval"]}]``.
+
+  A missing file means no rules. Raises ValueError if the file is malformed.
+  """
+  if not os.path.exists(filepath):
+    return []
+  with open(filepath, encoding="utf-8") as file:
+    rules = json.load(file)
+  if not isinstance(rules, list):
+    raise ValueError(f"{filepath} must hold a list of routing rules.")
+  routes = []
+  for rule in rules:
+    if not isinstance(rule, dict) or not isinstance(rule.get("chat_id"), int) or not isinstance(rule.get("keywords"), list):
+      raise ValueError(f"Routing rule {rule!r} needs an integer chat_id and a list of keywords.")
+    routes.append(Route(rule["chat_id"], frozenset(" ".join(_WORD.findall(str(k).lower())) for k in rule["keywords"])))
+  return routes
+
+
+class Router:
+  """Picks the committee group a question is posted to.
+
+  The question goes to the group whose keywords it mentions most, the first
+  such rule on a tie, and to ``default_chat_id`` if it mentions none.
+  Keywords match whole words, phrases match consecutive words.
+  """
+
+  def __init__(self, routes: Sequence[Route], default_chat_id: int):
+    self.routes = list(routes)
+    self.default_chat_id = default_chat_id
+
+  @property
+  def chat_ids(self) -> List[int]:
+    return list(dict.fromkeys([self.default_chat_id, *(route.chat_id for route in self.routes)]))
+
+  def chat_for(self, text: str) -> int:
+    words = _WORD.findall(text.lower())
+    # padded so that phrases only match on word boundaries
+    joined = f" {' '.join(words)} "
+    best_chat_id, best_hits = self.default_chat_id, 0
+    for route in self.routes:
+      hits = sum(1 for keyword in route.keywords if keyword and f" {keyword} " in joined)
+      if hits > best_hits:
+        best_chat_id, best_hits = route.chat_id, hits
+    return best_chat_id
@@ -0,0 +1,149 @@
+import html
+import logging
+import re
+import sqlite3
+from typing import List, NamedTuple
+
+from persistence import StateFile
+from similarity import VectorIndex
+
+logger = logging.getLogger(__name__)
+
+# Stand-ins for the highlight tags, swapped for <b></b> once the text is escaped.
+_MARK_START = "\x02"
+_MARK_END = "\x03"
+
+_TOKEN = re.compile(r"\w+", re.UNICODE)
+
+
+class SearchResult(NamedTuple):
+  chat_id: int
+  message_id: int
+  question: str
+  reply: str
+
+
+class QuestionIndex:
+  """Full-text index over answered questions and their replies.
+
+  Backed by an SQLite FTS5 table (an inverted index kept up to date on every
+  insert) in the bot's state file. Each question is identified by its chat
+  and message id in its committee group, since every group numbers its
+  messages separately. Rows indexed before questions were routed to several
+  groups are taken to be in ``legacy_chat_id``. Queries are ranked with BM25
+  and come back as HTML snippets with the matching terms in bold.
+
+  The questions are also kept in a ``VectorIndex`` for ``similar()``, loaded
+  on first use and topped up with the rows added since, by any worker.
+  Lookups and the vectors stay on the state file's read thread, so they
+  never wait behind the writes of the other stores.
+  """
+
+  def __init__(self, filepath: str, legacy_chat_id: int):
+    self.state = StateFile.open(filepath)
+    self.legacy_chat_id = legacy_chat_id
+    self._vectors = VectorIndex()
+    # the last sequence number loaded into the vectors
+    self._synced_seq = 0
+    self.state.register(self._create_tables)
+
+  def _create_tables(self, conn: sqlite3.Connection) -> None:
+    conn.execute(
+      "CREATE VIRTUAL TABLE IF NOT EXISTS answered_questions_fts USING fts5(question, reply, tokenize = 'porter unicode61')"
+    )
+    # The rowid of the FTS table is the id given to each question here.
+    # Questions are answered out of order, so other workers catch up on
+    # seq, the order of indexing.
+    conn.execute(
+      "CREATE TABLE IF NOT EXISTS answered_questions (id INTEGER PRIMARY KEY AUTOINCREMENT,"
+      " chat_id INTEGER NOT NULL, message_id INTEGER NOT NULL, seq INTEGER NOT NULL, UNIQUE (chat_id, message_id))"
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS answered_questions_by_seq ON answered_questions (seq)")
+    with self.state.transaction():
+      # the sequence table answered_questions replaced
+      conn.execute("DROP TABLE IF EXISTS answered_questions_seq")
+      # rows indexed by message id alone, before the table existed
+      conn.execute(
+        "INSERT INTO answered_questions (id, chat_id, message_id, seq) SELECT rowid, ?, rowid, rowid"
+        " FROM answered_questions_fts WHERE rowid NOT IN (SELECT id FROM answered_questions)",
+        (self.legacy_chat_id,)
+      )
+
+  def _add(self, chat_id: int, message_id: int, question: str, reply: str) -> None:
+    with self.state.transaction() as conn:
+      seq = conn.execute("SELECT COALESCE(MAX(seq), 0) + 1 FROM answered_questions").fetchone()[0]
+      conn.execute(
+        "INSERT INTO answered_questions (chat_id, message_id, seq) VALUES (?, ?, ?)"
+        " ON CONFLICT (chat_id, message_id) DO UPDATE SET seq = excluded.seq", (chat_id, message_id, seq)
+      )
+      row_id = conn.execute(
+        "SELECT id FROM answered_questions WHERE chat_id = ? AND message_id = ?", (chat_id, message_id)
+      ).fetchone()[0]
+      conn.execute("DELETE FROM answered_questions_fts WHERE rowid = ?", (row_id,))
+      conn.execute(
+        "INSERT INTO answered_questions_fts (rowid, question, reply) VALUES (?, ?, ?)", (row_id, question, reply)
+      )
+
+  async def add(self, chat_id: int, message_id: int, question: str, reply: str) -> None:
+    """Indexes a question and its reply, replacing what was indexed for it before."""
+    await self.state.run(self._add, chat_id, message_id, question, reply)
+    await self.state.read(self._sync_vectors)
+
+  def _search(self, query: str, limit: int) -> List[SearchResult]:
+    terms = _TOKEN.findall(query)
+    if not terms:
+      return []
+    # quoted so user input is never parsed as FTS syntax
+    match = " OR ".join('"' + term + '"' for term in terms)
+    rows = self.state.reader.execute(
+      "SELECT chat_id, message_id,"
+      f" snippet(answered_questions_fts, 0, '{_MARK_START}', '{_MARK_END}', '…', 24),"
+      f" snippet(answered_questions_fts, 1, '{_MARK_START}', '{_MARK_END}', '…', 32)"
+      " FROM answered_questions_fts JOIN answered_questions ON id = answered_questions_fts.rowid"
+      " WHERE answered_questions_fts MATCH ?"
+      " ORDER BY bm25(answered_questions_fts) LIMIT ?",
+      (match, limit)
+    ).fetchall()
+    return [
+      SearchResult(chat_id, message_id, _highlight(question), _highlight(reply)) for chat_id, message_id, question, reply in rows
+    ]
+
+  async def search(self, query: str, limit: int = 5) -> List[SearchResult]:
+    return await self.state.read(self._search, query, limit)
+
+  def _sync_vectors(self) -> None:
+    rows = self.state.reader.execute(
+      "SELECT seq, id, question FROM answered_questions"
+      " JOIN answered_questions_fts ON answered_questions_fts.rowid = id WHERE seq > ? ORDER BY seq",
+      (self._synced_seq,)
+    ).fetchall()
+    if rows:
+      self._vectors.add_many((row_id, question) for _, row_id, question in rows)
+      self._synced_seq = rows[-1][0]
+
+  def _similar(self, text: str, limit: int, min_score: float) -> List[SearchResult]:
+    self._sync_vectors()
+    best = self._vectors.most_similar(text, limit, min_score)
+    if not best:
+      return []
+    placeholders = ", ".join("?" * len(best))
+    rows = {
+      row[0]: row[1:] for row in self.state.reader.execute(
+        "SELECT id, chat_id, message_id, question, reply FROM answered_questions"
+        f" JOIN answered_questions_fts ON answered_questions_fts.rowid = id WHERE id IN ({placeholders})",
+        [row_id for row_id, _ in best]
+      )
+    }
+    return [SearchResult(*rows[row_id]) for row_id, _ in best if row_id in rows]
+
+  async def similar(self, text: str, limit: int = 3, min_score: float = 0.5) -> List[SearchResult]:
+    """Answered questions worded like ``text``, as plain text, most similar first."""
+    return await self.state.read(self._similar, text, limit, min_score)
+
+  async def load(self) -> None:
+    """Builds the similarity vectors ahead of the first lookup."""
+    await self.state.read(self._sync_vectors)
+
+
+def _highlight(snippet: str) -> str:
+  return html.escape(snippet).replace(_MARK_START, "<b>").replace(_MARK_END, "</b>")
@@ -0,0 +1,96 @@
+import asyncio
+import hmac
+import logging
+import os
+
+import uvicorn
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, PlainTextResponse, Response
+from starlette.routing import Route
+from telegram import Bot, Update
+
+import main
+from wix import parse_questions
+
+logger = logging.getLogger(__name__)
+
+# Set WEB_CONCURRENCY to the number of worker processes, as on Koyeb/Heroku.
+WORKERS = int(os.environ.get("WEB_CONCURRENCY", 1))
+
+application = main.build_application(workers=WORKERS)
+
+
+async def telegram_webhook(request: Request) -> Response:
+  update = Update.de_json(await request.json(), application.bot)
+  await application.update_queue.put(update)
+  return Response()
+
+
+async def wix_questions(request: Request) -> Response:
+  """Takes a batch of questions from the website form.
+
+  Answers with the number given to each new question, the number already
+  given to each id that was sent before, and why any item was rejected. The
+  questions are posted to the group in digests by ``main.post_wix_digest``.
+  """
+  api_key = request.headers.get("x-api-key", "")
+  if not main.WIX_API_KEY or not hmac.compare_digest(api_key, main.WIX_API_KEY):
+    return JSONResponse({"error": "invalid API key"}, status_code=401)
+  try:
+    questions, rejected = parse_questions(await request.json())
+  except ValueError as exc:
+    return JSONResponse({"error": str(exc) or "invalid JSON"}, status_code=400)
+
+  accepted, duplicates = await main.wix_inbox.add(questions, application.bot_data.get("no_of_wix_questions", 0))
+  return JSONResponse({"accepted": accepted, "duplicates": duplicates, "rejected": rejected})
+
+
+async def metrics(request: Request) -> Response:
+  return PlainTextResponse(main.metrics.render(application), media_type="text/plain; version=0.0.4")
+
+
+async def startup() -> None:
+  await application.initialize()
+  if application.post_init:
+    await application.post_init(application)
+  await application.start()
+
+
+async def shutdown() -> None:
+  await application.stop()
+  if application.post_shutdown:
+    await application.post_shutdown(application)
+  await application.shutdown()
+
+
+app = Starlette(
+  routes=[
+    Route(f"/{main.TOKEN}", telegram_webhook, methods=["POST"]),
+    Route("/wix/questions", wix_questions, methods=["POST"]),
+    Route("/metrics", metrics),
+  ],
+  on_startup=[startup],
+  on_shutdown=[shutdown],
+)
+
+
+async def set_webhook() -> None:
+  async with Bot(main.TOKEN) as bot:
+    await bot.set_webhook(main.WEBHOOK_URL)
+
+
+def run() -> None:
+  """Runs the bot in WORKERS processes behind one webhook.
+
+  Done once here rather than in every worker: importing the old pickle and
+  registering the webhook.
+  """
+  main.prepare_state()
+  asyncio.run(set_webhook())
+  # uvicorn only needs the import string to start worker processes
+  uvicorn.run("server:app" if WORKERS > 1 else app, host="0.0.0.0", port=main.PORT, workers=WORKERS)
+
+
+if __name__ == "__main__":
+  run()
@@ -0,0 +1,133 @@
+import re
+import zlib
+from functools import lru_cache
+from typing import Iterable, List, Tuple
+
+import numpy as np
+
+# Feature hashing width. At 512 float32 columns a question takes 2 KiB, so
+# 30k questions need about 61 MB, in a matrix grown to 32,768 rows (67 MB).
+DIMENSIONS = 512
+# Share of new rows after which the cached TF-IDF row norms are recomputed
+_RENORM_GROWTH = 0.1
+
+_TOKEN = re.compile(r"\w+", re.UNICODE)
+
+
+@lru_cache(maxsize=65536)
+def _word_features(word: str) -> Tuple[int, ...]:
+  padded = f" {word} "
+  trigrams = (padded[i:i + 3] for i in range(len(padded) - 2))
+  return tuple(zlib.crc32(gram.encode()) % DIMENSIONS for gram in (word, *trigrams))
+
+
+def _features(text: str) -> List[int]:
+  """Hashed words plus character trigrams of each word, so that small typos
+  and different word forms still overlap."""
+  features = []
+  for word in _TOKEN.findall(text.lower()):
+    features.extend(_word_features(word))
+  return features
+
+
+def vectorize(text: str) -> np.ndarray:
+  """Log-scaled term frequencies of the hashed features of ``text``."""
+  vector = np.zeros(DIMENSIONS, dtype=np.float32)
+  features = _features(text)
+  if features:
+    np.add.at(vector, features, 1)
+    np.log1p(vector, out=vector)
+  return vector
+
+
+class VectorIndex:
+  """TF-IDF cosine similarity over a growing set of texts.
+
+  Rows are kept as hashed term frequencies in one preallocated NumPy matrix
+  that doubles when full, with document frequencies counted alongside, so
+  adding a text is O(DIMENSIONS) and a lookup is a single matrix-vector
+  product. Row norms under the IDF weights are cached and only recomputed
+  once the collection has grown by ``_RENORM_GROWTH``.
+  """
+
+  def __init__(self, capacity: int = 1024):
+    self.ids = np.zeros(capacity, dtype=np.int64)
+    self._tf = np.zeros((capacity, DIMENSIONS), dtype=np.float32)
+    self._df = np.zeros(DIMENSIONS, dtype=np.float64)
+    self._norms = np.zeros(capacity, dtype=np.float32)
+    self._weights = np.ones(DIMENSIONS, dtype=np.float32)
+    self._normed_at = 0
+    self._positions = {}
+    self.size = 0
+
+  def __len__(self) -> int:
+    return self.size
+
+  def __contains__(self, item_id: int) -> bool:
+    return item_id in self._positions
+
+  def _grow(self, needed: int) -> None:
+    capacity = len(self.ids)
+    if needed <= capacity:
+      return
+    while capacity < needed:
+      capacity *= 2
+    self.ids = np.resize(self.ids, capacity)
+    self._norms = np.resize(self._norms, capacity)
+    tf = np.zeros((capacity, DIMENSIONS), dtype=np.float32)
+    tf[:self.size] = self._tf[:self.size]
+    self._tf = tf
+
+  def _reweight(self) -> None:
+    # squared IDF, so that q . (d * w) equals the dot product of both TF-IDF vectors
+    idf = np.log((1 + self.size) / (1 + self._df)) + 1
+    self._weights = (idf * idf).astype(np.float32)
+    rows = self._tf[:self.size]
+    self._norms[:self.size] = np.sqrt((rows * rows) @ self._weights)
+    self._normed_at = self.size
+
+  def add_many(self, items: Iterable[Tuple[int, str]]) -> None:
+    items = [(item_id, text) for item_id, text in items if item_id not in self._positions]
+    if not items:
+      return
+    self._grow(self.size + len(items))
+    start = self.size
+    rows, columns = [], []
+    for item_id, text in items:
+      features = _features(text)
+      rows.extend([self.size] * len(features))
+      columns.extend(features)
+      self.ids[self.size] = item_id
+      self._positions[item_id] = self.size
+      self.size += 1
+    block = self._tf[start:self.size]
+    flat = (np.array(rows, dtype=np.int64) - start) * DIMENSIONS + np.array(columns, dtype=np.int64)
+    counts = np.bincount(flat, minlength=block.size).reshape(block.shape)
+    np.log1p(counts, out=block, casting="unsafe")
+    self._df += (block > 0).sum(axis=0)
+
+    if self.size - self._normed_at > self._normed_at * _RENORM_GROWTH:
+      self._reweight()
+    else:
+      self._norms[start:self.size] = np.sqrt((block * block) @ self._weights)
+
+  def add(self, item_id: int, text: str) -> None:
+    self.add_many([(item_id, text)])
+
+  def most_similar(self, text: str, limit: int = 3, min_score: float = 0.0) -> List[Tuple[int, float]]:
+    """The ids of up to ``limit`` texts with a cosine similarity to ``text``
+    of at least ``min_score``, best first."""
+    if not self.size:
+      return []
+    tf = vectorize(text)
+    query = tf * self._weights
+    query_norm = np.sqrt(query @ tf)
+    if not query_norm:
+      return []
+    norms = self._norms[:self.size]
+    scores = (self._tf[:self.size] @ query) / (np.maximum(norms, 1e-9) * query_norm)
+
+    limit = min(limit, self.size)
+    best = np.argpartition(-scores, limit - 1)[:limit]
+    best = best[np.argsort(-scores[best])]
+    return [(int(self.ids[i]), float(scores[i])) for i in best if scores[i] >= min_score]
@@ -0,0 +1,151 @@
+import asyncio
+import json
+import logging
+import sqlite3
+import time
+import uuid
+from typing import List, Optional
+
+from telegram import Bot, Update
+
+from persistence import StateFile
+
+logger = logging.getLogger(__name__)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS update_spool (
+  update_id INTEGER PRIMARY KEY,
+  payload TEXT NOT NULL,
+  queued_at REAL NOT NULL,
+  processed_at REAL,
+  owner TEXT
+);
+CREATE INDEX IF NOT EXISTS update_spool_unprocessed ON update_spool (queued_at) WHERE processed_at IS NULL;
+CREATE INDEX IF NOT EXISTS update_spool_processed ON update_spool (processed_at) WHERE processed_at IS NOT NULL;
+CREATE TABLE IF NOT EXISTS spool_workers (owner TEXT PRIMARY KEY, heartbeat REAL NOT NULL);
+"""
+
+# (table, column, declaration) added after the table was first released
+_ADDED_COLUMNS = [
+  ("update_spool", "owner", "TEXT"),
+]
+
+
+def _create_tables(conn: sqlite3.Connection) -> None:
+  conn.executescript(_SCHEMA)
+  for table, column, declaration in _ADDED_COLUMNS:
+    columns = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+    if column not in columns:
+      conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {declaration}")
+
+
+class UpdateSpool:
+  """Every update received from Telegram, kept on disk until it is handled.
+
+  Appends are committed with ``synchronous = FULL``, so an update that was
+  acknowledged survives a crash. The ``update_id`` is the primary key: an
+  update Telegram delivers again is recognised and dropped for as long as
+  processed updates are kept, see ``prune()``.
+
+  Each update is owned by the process that received or replayed it, and
+  every process checks in with ``beat()``, so other workers only take over
+  the updates of one that stopped.
+  """
+
+  def __init__(self, filepath: str):
+    self.state = StateFile.open(filepath)
+    self.owner = uuid.uuid4().hex
+    self.state.register(_create_tables)
+
+  def _append(self, update_id: int, payload: str) -> bool:
+    return self.state.conn.execute(
+      "INSERT OR IGNORE INTO update_spool (update_id, payload, queued_at, owner) VALUES (?, ?, ?, ?)",
+      (update_id, payload, time.time(), self.owner)
+    ).rowcount == 1
+
+  async def append(self, update: Update) -> bool:
+    """Saves an update, False if it was received before."""
+    return await self.state.run(self._append, update.update_id, update.to_json())
+
+  async def done(self, update_id: int) -> None:
+    await self.state.run(
+      self.state.conn.execute, "UPDATE update_spool SET processed_at = ? WHERE update_id = ?", (time.time(), update_id)
+    )
+
+  async def beat(self) -> None:
+    """Tells other workers that this one is still handling its updates."""
+    await self.state.run(
+      self.state.conn.execute,
+      "INSERT INTO spool_workers (owner, heartbeat) VALUES (?, ?)"
+      " ON CONFLICT (owner) DO UPDATE SET heartbeat = excluded.heartbeat", (self.owner, time.time())
+    )
+
+  def _unprocessed(self, queued_before: float, stale_before: Optional[float]) -> List[str]:
+    if stale_before is None:
+      owned_elsewhere, args = "", (queued_before,)
+    else:
+      owned_elsewhere = (
+        " AND (owner IS NULL OR owner NOT IN (SELECT owner FROM spool_workers WHERE heartbeat >= ? OR owner = ?))"
+      )
+      args = (queued_before, stale_before, self.owner)
+    with self.state.transaction() as conn:
+      rows = conn.execute(
+        "SELECT update_id, payload FROM update_spool WHERE processed_at IS NULL AND queued_at < ?"
+        f"{owned_elsewhere} ORDER BY update_id", args
+      ).fetchall()
+      # taken over by this process
+      conn.executemany(
+        "UPDATE update_spool SET queued_at = ?, owner = ? WHERE update_id = ?",
+        [(time.time(), self.owner, row[0]) for row in rows]
+      )
+    return [row[1] for row in rows]
+
+  async def unprocessed(self, bot: Bot, queued_before: float, stale_before: Optional[float] = None) -> List[Update]:
+    """Updates queued before ``queued_before`` that were never handled, in
+    the order Telegram sent them, which this process takes over. With
+    ``stale_before``, only those of workers that have not checked in since
+    then."""
+    payloads = await self.state.run(self._unprocessed, queued_before, stale_before)
+    return [Update.de_json(json.loads(payload), bot) for payload in payloads]
+
+  def _prune(self, processed_before: float) -> int:
+    with self.state.transaction() as conn:
+      conn.execute("DELETE FROM spool_workers WHERE heartbeat < ?", (processed_before,))
+      return conn.execute(
+        "DELETE FROM update_spool WHERE processed_at IS NOT NULL AND processed_at < ?", (processed_before,)
+      ).rowcount
+
+  async def prune(self, older_than: float) -> int:
+    """Forgets updates handled over ``older_than`` seconds ago."""
+    return await self.state.run(self._prune, time.time() - older_than)
+
+
+class SpoolQueue(asyncio.Queue):
+  """The application's update queue, writing each update to an
+  ``UpdateSpool`` before accepting it.
+
+  ``put()`` returns once the update is on disk, which is when the webhook
+  answers Telegram, and leaves out updates that were received before.
+  Whatever else is queued, like the application's stop signal, is passed
+  through.
+  """
+
+  def __init__(self, spool: UpdateSpool):
+    super().__init__()
+    self.spool = spool
+
+  async def put(self, item: object) -> None:
+    if isinstance(item, Update):
+      if not await self.spool.append(item):
+        logger.debug("Dropping update %s, it was received before", item.update_id)
+        return
+    await super().put(item)
+
+  async def replay(self, bot: Bot, queued_before: float, stale_before: Optional[float] = None) -> int:
+    """Queues the spooled updates that were never handled, e.g. because the
+    process stopped first, see ``UpdateSpool.unprocessed()``. Returns how
+    many there were."""
+    updates = await self.spool.unprocessed(bot, queued_before, stale_before)
+    for update in updates:
+      await super().put(update)
+    return len(updates)
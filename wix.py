@@ -0,0 +1,151 @@
+import logging
+import time
+from typing import Any, Dict, List, NamedTuple, Tuple
+
+from persistence import StateFile
+
+logger = logging.getLogger(__name__)
+
+MAX_BATCH_SIZE = 500
+MAX_ID_LENGTH = 128
+MAX_FIELD_LENGTH = 256
+MAX_QUESTION_LENGTH = 3000
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS wix_questions (
+  client_id TEXT PRIMARY KEY,
+  number INTEGER NOT NULL UNIQUE,
+  name TEXT NOT NULL,
+  email TEXT NOT NULL,
+  question TEXT NOT NULL,
+  received_at REAL NOT NULL,
+  posted_at REAL
+);
+CREATE INDEX IF NOT EXISTS wix_questions_unposted ON wix_questions (number) WHERE posted_at IS NULL;
+"""
+
+
+class WixQuestion(NamedTuple):
+  """A question submitted through the form on the website."""
+  client_id: str
+  name: str
+  email: str
+  question: str
+
+
+class NumberedWixQuestion(NamedTuple):
+  number: int
+  name: str
+  email: str
+  question: str
+  received_at: float
+
+
+def _text_field(item: Dict[str, Any], field: str, max_length: int) -> str:
+  value = item.get(field)
+  if not isinstance(value, str) or not value.strip():
+    raise ValueError(f"'{field}' must be a non-empty string")
+  value = value.strip()
+  if len(value) > max_length:
+    raise ValueError(f"'{field}' is longer than {max_length} characters")
+  return value
+
+
+def parse_questions(payload: Any) -> Tuple[List[WixQuestion], Dict[str, str]]:
+  """Validates a ``{"questions": [{"id", "name", "email", "question"}, ...]}``
+  batch.
+
+  Returns the valid questions, first occurrence of each id only, and the
+  reason every other item was rejected, keyed by its id (or its index when
+  it has no usable id). Raises ``ValueError`` if the batch itself is malformed.
+  """
+  if not isinstance(payload, dict) or not isinstance(payload.get("questions"), list):
+    raise ValueError("expected an object with a 'questions' list")
+  items = payload["questions"]
+  if len(items) > MAX_BATCH_SIZE:
+    raise ValueError(f"at most {MAX_BATCH_SIZE} questions per batch")
+
+  questions: Dict[str, WixQuestion] = {}
+  rejected: Dict[str, str] = {}
+  for index, item in enumerate(items):
+    key = f"#{index}"
+    try:
+      if not isinstance(item, dict):
+        raise ValueError("must be an object")
+      client_id = item.get("id")
+      if isinstance(client_id, int) and not isinstance(client_id, bool):
+        client_id = str(client_id)
+      client_id = _text_field({"id": client_id}, "id", MAX_ID_LENGTH)
+      key = client_id
+      if client_id in questions:
+        raise ValueError("duplicate id in batch")
+      email = _text_field(item, "email", MAX_FIELD_LENGTH)
+      if "@" not in email:
+        raise ValueError("'email' is not an email address")
+      questions[client_id] = WixQuestion(
+        client_id, _text_field(item, "name", MAX_FIELD_LENGTH), email,
+        _text_field(item, "question", MAX_QUESTION_LENGTH)
+      )
+    except ValueError as exc:
+      rejected[key] = str(exc)
+  return list(questions.values()), rejected
+
+
+class WixInbox:
+  """Questions from the website, numbered and waiting to be posted.
+
+  Lives in a table of the bot's state file, so every worker sees the same
+  ids and numbers: each batch is deduplicated and numbered in one
+  ``BEGIN IMMEDIATE`` transaction. Rows stay unposted until a digest that
+  contains them has been sent.
+  """
+
+  def __init__(self, filepath: str):
+    self.state = StateFile.open(filepath)
+    self.state.register(_SCHEMA)
+
+  def _add(self, questions: List[WixQuestion], first_number: int) -> Tuple[Dict[str, int], Dict[str, int]]:
+    now = time.time()
+    accepted: Dict[str, int] = {}
+    duplicates: Dict[str, int] = {}
+    with self.state.transaction() as conn:
+      number = max(first_number, conn.execute("SELECT COALESCE(MAX(number), 0) FROM wix_questions").fetchone()[0])
+      for question in questions:
+        row = conn.execute("SELECT number FROM wix_questions WHERE client_id = ?", (question.client_id,)).fetchone()
+        if row is not None:
+          duplicates[question.client_id] = row[0]
+          continue
+        number += 1
+        conn.execute(
+          "INSERT INTO wix_questions (client_id, number, name, email, question, received_at) VALUES (?, ?, ?, ?, ?, ?)",
+          (question.client_id, number, question.name, question.email, question.question, now)
+        )
+        accepted[question.client_id] = number
+    return accepted, duplicates
+
+  async def add(self, questions: List[WixQuestion], first_number: int = 0) -> Tuple[Dict[str, int], Dict[str, int]]:
+    """Stores the questions whose id has not been seen before, numbered from
+    after ``first_number`` or the highest number so far, whichever is larger.
+
+    Returns ``({id: number}, {id: number})`` of the new and the already
+    known questions.
+    """
+    return await self.state.run(self._add, questions, first_number)
+
+  def _unposted(self, limit: int) -> List[NumberedWixQuestion]:
+    rows = self.state.conn.execute(
+      "SELECT number, name, email, question, received_at FROM wix_questions"
+      " WHERE posted_at IS NULL ORDER BY number LIMIT ?", (limit,)
+    ).fetchall()
+    return [NumberedWixQuestion(*row) for row in rows]
+
+  async def unposted(self, limit: int = MAX_BATCH_SIZE) -> List[NumberedWixQuestion]:
+    return await self.state.run(self._unposted, limit)
+
+  def _mark_posted(self, numbers: List[int]) -> None:
+    now = time.time()
+    with self.state.transaction() as conn:
+      conn.executemany("UPDATE wix_questions SET posted_at = ? WHERE number = ?", [(now, n) for n in numbers])
+
+  async def mark_posted(self, numbers: List[int]) -> None:
+    await self.state.run(self._mark_posted, numbers)